@@ -0,0 +1,73 @@
+import logging
+from typing import List, Tuple
+
+import numpy as np
+
+from match_engine import MatchEngine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NEIGHBORS = 10
+DEFAULT_ROUNDS = 3
+
+
+def greedy_pairs(indices: np.ndarray, scores: np.ndarray, rows: np.ndarray) -> List[Tuple[int, int, float]]:
+    """
+    Greedy maximum-weight matching over a kNN graph.
+
+    `indices`/`scores` are the top-k neighbours of each of `rows`. Edges are
+    made undirected, sorted by score and taken whenever both endpoints are
+    still free, which yields at least half the optimal total weight.
+    """
+    sources = np.repeat(rows, indices.shape[1])
+    targets = indices.ravel()
+    weights = scores.ravel()
+    valid = targets >= 0
+    sources, targets, weights = sources[valid], targets[valid], weights[valid]
+    low, high = np.minimum(sources, targets), np.maximum(sources, targets)
+
+    order = np.argsort(-weights, kind='stable')
+    paired = set()
+    pairs = []
+    for a, b, weight in zip(low[order].tolist(), high[order].tolist(), weights[order].tolist()):
+        if a in paired or b in paired:
+            continue
+        paired.add(a)
+        paired.add(b)
+        pairs.append((a, b, weight))
+    return pairs
+
+
+def assign_roommates(engine: MatchEngine, neighbors: int = DEFAULT_NEIGHBORS,
+                     rounds: int = DEFAULT_ROUNDS) -> Tuple[List[Tuple[str, str, float]], List[str]]:
+    """
+    Pair every user with at most one roommate so that pairings are mutual.
+
+    The first round matches greedily over the engine's kNN graph, which
+    already honours its partitions and scorer. Users left over because all
+    their neighbours were taken are re-queried against the other leftovers
+    only, for up to `rounds` rounds in total.
+
+    Returns the (user_id, roommate_id, score) pairs and the unpaired user ids.
+    """
+    rows = np.arange(len(engine.ids))
+    pairs: List[Tuple[int, int, float]] = []
+    for round_number in range(rounds):
+        if len(rows) < 2:
+            break
+        if round_number == 0:
+            indices, scores = engine.top_k(neighbors, rows)
+        else:
+            indices, scores = engine.top_k_among(neighbors, rows)
+        round_pairs = greedy_pairs(indices, scores, rows)
+        if not round_pairs:
+            break
+        pairs.extend(round_pairs)
+        paired = np.array([row for a, b, _ in round_pairs for row in (a, b)])
+        rows = np.setdiff1d(rows, paired)
+        logger.info(f"Assignment round {round_number + 1}: {len(round_pairs)} pairs, {len(rows)} users left")
+
+    return (
+        [(engine.ids[a], engine.ids[b], score) for a, b, score in pairs],
+        [engine.ids[row] for row in rows]
+    )
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+class AsyncEmbeddingPipeline:
+    """
+    Run embed -> Supabase -> Pinecone as concurrent stages joined by bounded queues.
+
+    Each stage has its own number of workers, which caps the concurrent
+    calls to that service. The queues between stages hold at most
+    `queue_size` batches, so a slow database write holds back embedding
+    instead of piling up vectors in memory. The blocking clients run in a
+    dedicated thread pool; OpenAI pacing comes from the processor's rate
+    limiter, which every embedding worker shares.
+    """
+
+    def __init__(
+        self,
+        processor,
+        batch_size: int = 100,
+        embed_concurrency: int = 4,
+        supabase_concurrency: int = 2,
+        pinecone_concurrency: int = 2,
+        queue_size: int = 4
+    ):
+        self.processor = processor
+        self.batch_size = batch_size
+        self.embed_concurrency = embed_concurrency
+        self.supabase_concurrency = supabase_concurrency
+        self.pinecone_concurrency = pinecone_concurrency
+        self.queue_size = queue_size
+        self.stats = {'embedded': 0, 'embed_failed': 0, 'saved': 0, 'save_failed': 0, 'indexed': 0, 'index_failed': 0}
+
+    def make_batches(self, users: List[Dict]) -> List[List[Tuple[str, str]]]:
+        """Flatten responses and split them into small embedding batches."""
+        texts = {}
+        for user in users:
+            try:
+                texts[user['user_id']] = self.processor.flatten_responses(user['responses'])
+            except Exception as e:
+                logger.error(f"Error formatting responses for user {user['user_id']}: {str(e)}")
+        batches = []
+        for batch in self.processor.batcher.make_batches(list(texts.items())):
+            batches.extend(batch[start:start + self.batch_size] for start in range(0, len(batch), self.batch_size))
+        return batches
+
+    async def _run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _embed_worker(self, batches: asyncio.Queue, saves: asyncio.Queue, universities: Dict[str, str]):
+        while True:
+            try:
+                batch = batches.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            rows, failures = await self._run_blocking(self.processor.embed_rows, dict(batch))
+            for user_id, error in failures.items():
+                logger.error(f"Error generating embedding for user {user_id}: {error}")
+            self.stats['embedded'] += len(rows)
+            self.stats['embed_failed'] += len(failures)
+            if rows:
+                await saves.put([(row, universities.get(row['user_id'])) for row in rows])
+
+    async def _save_worker(self, saves: asyncio.Queue, indexes: asyncio.Queue):
+        while True:
+            batch = await saves.get()
+            if batch is _DONE:
+                return
+            rows = [row for row, _ in batch]
+            results = await self._run_blocking(self.processor.supabase_buffer.write, rows)
+            failed = {key for result in results for key in result.failed_keys}
+            self.stats['saved'] += sum(str(row['user_id']) not in failed for row in rows)
+            self.stats['save_failed'] += sum(str(row['user_id']) in failed for row in rows)
+            # Like the sequential path, only index what made it into Supabase
+            remaining = [item for item in batch if str(item[0]['user_id']) not in failed]
+            if remaining:
+                await indexes.put(remaining)
+
+    async def _index_worker(self, indexes: asyncio.Queue):
+        while True:
+            batch = await indexes.get()
+            if batch is _DONE:
+                return
+            # Each model's vectors go to that model's namespace
+            by_model: Dict[str, List[Dict]] = {}
+            for row, university_id in batch:
+                by_model.setdefault(row['model'], []).append(
+                    self.processor.pinecone_row(row['user_id'], row['embedding'], university_id)
+                )
+            for model, rows in by_model.items():
+                results = await self._run_blocking(self.processor.pinecone_buffers[model].write, rows)
+                failed = sum(len(result.failed_keys) for result in results)
+                self.stats['indexed'] += len(rows) - failed
+                self.stats['index_failed'] += failed
+
+    async def _finish_stages(self, embedders: List[asyncio.Task], savers: List[asyncio.Task],
+                             indexers: List[asyncio.Task], saves: asyncio.Queue, indexes: asyncio.Queue):
+        """Once a stage's workers are done, tell the next stage's workers there is no more input."""
+        await asyncio.gather(*embedders)
+        for _ in savers:
+            await saves.put(_DONE)
+        await asyncio.gather(*savers)
+        for _ in indexers:
+            await indexes.put(_DONE)
+        await asyncio.gather(*indexers)
+
+    async def run(self, users: List[Dict]) -> Dict[str, int]:
+        """Process the users through all three stages and return per-stage counts."""
+        universities = {user['user_id']: user.get('university_id') for user in users}
+        batches: asyncio.Queue = asyncio.Queue()
+        for batch in self.make_batches(users):
+            batches.put_nowait(batch)
+        saves: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        indexes: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+
+        workers = self.embed_concurrency + self.supabase_concurrency + self.pinecone_concurrency
+        with ThreadPoolExecutor(max_workers=workers) as self._executor:
+            embedders = [asyncio.create_task(self._embed_worker(batches, saves, universities))
+                         for _ in range(self.embed_concurrency)]
+            savers = [asyncio.create_task(self._save_worker(saves, indexes))
+                      for _ in range(self.supabase_concurrency)]
+            indexers = [asyncio.create_task(self._index_worker(indexes))
+                        for _ in range(self.pinecone_concurrency)]
+
+            stages = asyncio.create_task(self._finish_stages(embedders, savers, indexers, saves, indexes))
+            tasks = [stages, *embedders, *savers, *indexers]
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            finally:
+                # A failed worker would leave the other stages waiting on their queues forever
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+
+        logger.info(f"Async pipeline finished: {self.stats}")
+        return self.stats
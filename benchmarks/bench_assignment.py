@@ -0,0 +1,84 @@
+"""
+Benchmark mutual roommate assignment against the greedy top-k match lists.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_assignment --sizes 1000 10000 30000
+"""
+import time
+import argparse
+
+import numpy as np
+
+from assignment import assign_roommates
+from benchmarks.synthetic import clustered_embeddings
+from match_engine import MatchEngine
+
+TOP_K = 4
+
+
+def top_k_quality(indices: np.ndarray, scores: np.ndarray) -> dict:
+    """Reciprocity and popularity of one-directional top-k lists."""
+    n = len(indices)
+    valid = indices >= 0
+    sources = np.repeat(np.arange(n), indices.shape[1])[valid.ravel()]
+    targets = indices[valid]
+    edges = set(zip(sources.tolist(), targets.tolist()))
+    mutual = sum((b, a) in edges for a, b in edges)
+    in_degree = np.bincount(targets, minlength=n)
+    return {
+        'top1_score': float(scores[:, 0][valid[:, 0]].mean()),
+        'mutual_edges': mutual / max(len(edges), 1),
+        'max_in_degree': int(in_degree.max()),
+        'never_listed': float((in_degree == 0).mean()),
+    }
+
+
+def assignment_lists(ids, pairs) -> tuple:
+    """The assignment as one-entry match lists (-1 for unpaired), both directions of every pair."""
+    position = {user_id: row for row, user_id in enumerate(ids)}
+    indices = np.full((len(ids), 1), -1, dtype=np.int64)
+    scores = np.full((len(ids), 1), np.nan, dtype=np.float32)
+    for a, b, score in pairs:
+        for user_id, roommate_id in ((a, b), (b, a)):
+            indices[position[user_id], 0] = position[roommate_id]
+            scores[position[user_id], 0] = score
+    return indices, scores
+
+
+def run(n: int, dim: int, partitions: int) -> None:
+    vectors = clustered_embeddings(n, dim)
+    ids = [f"user-{i}" for i in range(n)]
+    universities = np.random.default_rng(1).integers(0, partitions, n) if partitions else None
+    engine = MatchEngine(ids, vectors, universities)
+
+    start = time.perf_counter()
+    indices, scores = engine.top_k(TOP_K)
+    top_k_seconds = time.perf_counter() - start
+    baseline = top_k_quality(indices, scores)
+
+    start = time.perf_counter()
+    pairs, unpaired = assign_roommates(engine)
+    assign_seconds = time.perf_counter() - start
+    assigned = top_k_quality(*assignment_lists(ids, pairs))
+
+    print(f"n={n:>7}  top-{TOP_K}: {top_k_seconds:6.2f}s  "
+          f"top-1 score {baseline['top1_score']:.3f}  mutual edges {baseline['mutual_edges']:.1%}  "
+          f"max in-degree {baseline['max_in_degree']}  never listed {baseline['never_listed']:.1%}")
+    print(f"{'':>9}  assignment: {assign_seconds:6.2f}s  "
+          f"pair score {assigned['top1_score']:.3f}  paired {1 - len(unpaired) / n:.1%}  "
+          f"mutual {assigned['mutual_edges']:.1%}  max in-degree {assigned['max_in_degree']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 30000])
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--partitions', type=int, default=19, help="number of universities (0 for none)")
+    args = parser.parse_args()
+    for n in args.sizes:
+        run(n, args.dim, args.partitions)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark sharded multiprocess matching against the in-process match engine.
+
+For every worker count the embedding matrix is shared with a fresh pool
+as a read-only memory map, every user is matched, and the results are
+checked against the single-process engine. Start-up (sharing the matrix
+and starting the workers) is reported separately from matching.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_parallel_matching --sizes 50000 200000 --workers 1 2 4 8
+    python -m benchmarks.bench_parallel_matching --universities 12 --shard-by university
+"""
+import os
+import time
+import argparse
+
+import numpy as np
+
+from benchmarks.synthetic import clustered_embeddings
+from match_engine import MatchEngine
+from parallel_matching import SHARD_BY_ROWS, SHARD_BY_UNIVERSITY, ParallelMatcher
+
+TOP_K = 4
+
+
+def run(n: int, dim: int, workers, universities: int, shard_by: str, quantization) -> None:
+    vectors = clustered_embeddings(n, dim)
+    partitions = np.random.default_rng(1).integers(0, universities, n) if universities else None
+    engine = MatchEngine([f"user-{i}" for i in range(n)], vectors, partitions,
+                         ann_threshold=None, copy=False, quantization=quantization)
+
+    start = time.perf_counter()
+    expected, _ = engine.top_k(TOP_K)
+    serial = time.perf_counter() - start
+    print(f"n={n:>8}  dim={dim}  cores={os.cpu_count()}  in-process {serial:8.2f}s  {n / serial:10.0f} users/s")
+
+    base = None
+    for count in workers:
+        start = time.perf_counter()
+        with ParallelMatcher(engine, count, shard_by) as matcher:
+            startup = time.perf_counter() - start
+            start = time.perf_counter()
+            indices, _ = matcher.top_k(TOP_K)
+            seconds = time.perf_counter() - start
+        base = base or seconds
+        same = (indices == expected).mean()
+        print(f"{'':>10}  workers={count:<3} start {startup:6.2f}s  match {seconds:8.2f}s  "
+              f"{n / seconds:10.0f} users/s  speedup x{base / seconds:5.2f}  "
+              f"(x{serial / seconds:5.2f} vs in-process)  same matches {same:.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50000])
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--universities', type=int, default=0, help="partition users into this many universities")
+    parser.add_argument('--shard-by', choices=[SHARD_BY_ROWS, SHARD_BY_UNIVERSITY], default=SHARD_BY_ROWS)
+    parser.add_argument('--quantization', choices=['float16', 'int8'])
+    args = parser.parse_args()
+    for n in args.sizes:
+        run(n, args.dim, args.workers, args.universities, args.shard_by, args.quantization)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Benchmark the embedding and match pipelines end to end against in-process fakes.
+
+Each stage runs in a fresh process on a synthetic survey population:
+
+    process_users     EmbeddingProcessor.process_users (embed_and_upsert.py)
+    generate          embedding_generator.generate_embeddings
+    match             MatchGenerator.generate_matches on pre-embedded users
+
+and reports throughput, p50/p99 per-user latency (from the start of the
+stage until the user's row is written), calls to each fake service and
+peak RSS. Pipeline settings come from the environment as usual, e.g.
+MATCH_QUANTIZATION or EMBEDDING_PIPELINE=async.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pipelines --sizes 1000 10000 100000 --json bench.json
+    python -m benchmarks.bench_pipelines --baseline bench.json   # exits 1 on a regression
+
+The fake Supabase keeps embeddings as pgvector text, so 100k users at
+1536 dimensions needs several GB of memory; use --dim to scale down.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List
+
+import numpy as np
+
+STAGES = ['process_users', 'generate', 'match']
+
+
+def seed_population(db, users: List[Dict]) -> None:
+    """Store synthetic users as profiles and pending surveys."""
+    db.load('profiles', [
+        {'id': user['user_id'], 'university': user['university'], 'profile_complete': False}
+        for user in users
+    ])
+    db.load('survey_responses', [
+        {'user_id': user['user_id'], 'responses': user['responses'], 'embedding_status': None}
+        for user in users
+    ])
+
+
+def users_without_embeddings(db, model: str):
+    """The `get_users_without_embeddings` RPC over the fake tables."""
+    def rpc() -> List[Dict]:
+        embedded = {row['user_id'] for row in db.rows('user_embeddings') if row.get('model') == model}
+        universities = {row['id']: row.get('university') for row in db.rows('profiles')}
+        return [
+            {'user_id': row['user_id'], 'responses': row['responses'],
+             'university_id': universities.get(row['user_id'])}
+            for row in db.rows('survey_responses') if row['user_id'] not in embedded
+        ]
+    return rpc
+
+
+def run_stage(stage: str, n: int, options: Dict) -> Dict:
+    """Run one stage on `n` synthetic users in this process and measure it."""
+    # Configure logging before the pipeline modules do, so their basicConfig calls are no-ops
+    logging.basicConfig(level=options['log_level'], format='%(asctime)s - %(levelname)s - %(message)s')
+    workdir = tempfile.mkdtemp(prefix='roomnet-bench-')
+    os.environ['EMBEDDING_CACHE_PATH'] = os.path.join(workdir, 'embedding_cache.sqlite')
+    os.environ['VECTOR_SNAPSHOT_PATH'] = os.path.join(workdir, 'snapshot')
+    os.environ['MATCH_STATE_PATH'] = os.path.join(workdir, 'match_state.json')
+    # Keep a local .env from pointing embedding_generator at the real services
+    os.environ['VITE_SUPABASE_URL'] = ''
+
+    from benchmarks.fakes import FakeOpenAI, FakePinecone, FakeSupabase
+    from benchmarks.synthetic import survey_population
+    from embedding_batcher import openai_embed_fn
+    from embedding_models import configured_model, embedding_row
+    from metrics import metrics
+    from survey_format import format_survey
+
+    openai = FakeOpenAI(options['dim'], options['latency'], options['latency_per_input'],
+                        options['rate_limit_rate'])
+    db = FakeSupabase(options['supabase_latency'])
+    pinecone = FakePinecone(options['pinecone_latency'])
+    users = survey_population(n)
+    seed_population(db, users)
+    db.functions['get_users_without_embeddings'] = users_without_embeddings(db, configured_model())
+    target = 'user_embeddings'
+
+    if stage == 'process_users':
+        import asyncio
+        from embed_and_upsert import EmbeddingProcessor
+        processor = EmbeddingProcessor(db, pinecone.Index(),
+                                       embed_fn_factory=lambda model: openai_embed_fn(openai, model))
+        metrics.reset()
+        start = time.perf_counter()
+        if os.getenv('EMBEDDING_PIPELINE', 'sequential') == 'async':
+            asyncio.run(processor.process_users_async())
+        else:
+            processor.process_users()
+    elif stage == 'generate':
+        import embedding_generator
+        from vector_snapshot import snapshot_writer_from_env
+        embedding_generator.init_clients(db, openai)
+        embedding_generator.snapshot_writes = snapshot_writer_from_env()
+        metrics.reset()
+        start = time.perf_counter()
+        embedding_generator.generate_embeddings()
+    else:
+        from generate_matches import MatchGenerator
+        model = configured_model()
+        db.load('user_embeddings', [
+            embedding_row(user['user_id'], openai.embed(model, format_survey(user['responses'])), model)
+            for user in users
+        ])
+        generator = MatchGenerator(db, pinecone.Index())
+        target = 'matches'
+        metrics.reset()
+        start = time.perf_counter()
+        generator.generate_matches()
+    seconds = time.perf_counter() - start
+
+    written = db.written_at.get(target, {})
+    latencies = np.array([written[user['user_id']] - start for user in users if user['user_id'] in written])
+    calls = {f"openai {name}": count for name, count in openai.calls.items()}
+    calls.update({f"supabase {name}": count for name, count in db.calls.items()})
+    calls.update({f"pinecone {name}": count for name, count in pinecone.calls.items()})
+    return {
+        'stage': stage,
+        'users': n,
+        'completed': len(latencies),
+        'seconds': seconds,
+        'throughput': len(latencies) / seconds if seconds else 0.0,
+        'p50_ms': float(np.percentile(latencies, 50) * 1000) if len(latencies) else None,
+        'p99_ms': float(np.percentile(latencies, 99) * 1000) if len(latencies) else None,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'calls': calls,
+        # Where the time went, slowest stage first (see metrics.py)
+        'stages': metrics.summary()['stages'],
+    }
+
+
+def print_result(result: Dict) -> None:
+    p50 = f"{result['p50_ms']:9.1f}" if result['p50_ms'] is not None else f"{'-':>9}"
+    p99 = f"{result['p99_ms']:9.1f}" if result['p99_ms'] is not None else f"{'-':>9}"
+    print(f"{result['stage']:<14} n={result['users']:>7}  done {result['completed']:>7}  "
+          f"{result['seconds']:8.2f}s  {result['throughput']:9.1f} users/s  "
+          f"p50 {p50} ms  p99 {p99} ms  peak RSS {result['peak_rss_mb']:8.1f} MB")
+    for stage in result['stages']:
+        print(f"    stage {stage['stage']:<34} {stage['total_seconds']:9.3f}s  {stage['items']:>8} items")
+    for name, count in sorted(result['calls'].items()):
+        print(f"    {name:<40} {count:>10}")
+
+
+def regressions(results: List[Dict], baseline: List[Dict], tolerance: float) -> List[str]:
+    """Compare results with a baseline run and describe everything that got worse than `tolerance`."""
+    previous = {(result['stage'], result['users']): result for result in baseline}
+    found = []
+    for result in results:
+        before = previous.get((result['stage'], result['users']))
+        if not before:
+            continue
+        name = f"{result['stage']} n={result['users']}"
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            found.append(f"{name}: throughput {before['throughput']:.1f} -> {result['throughput']:.1f} users/s")
+        for metric in ('p99_ms', 'peak_rss_mb'):
+            if before.get(metric) and result.get(metric) and result[metric] > before[metric] * (1 + tolerance):
+                found.append(f"{name}: {metric} {before[metric]:.1f} -> {result[metric]:.1f}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds per embeddings request")
+    parser.add_argument('--latency-per-input', type=float, default=0.0, help="extra seconds per embedded text")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="share of embeddings requests that get a 429")
+    parser.add_argument('--supabase-latency', type=float, default=0.0, help="seconds per Supabase request")
+    parser.add_argument('--pinecone-latency', type=float, default=0.0, help="seconds per Pinecone request")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="compare with results written by --json and exit 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative regression (default 0.2)")
+    args = parser.parse_args()
+    options = {
+        'dim': args.dim,
+        'latency': args.latency,
+        'latency_per_input': args.latency_per_input,
+        'rate_limit_rate': args.rate_limit_rate,
+        'supabase_latency': args.supabase_latency,
+        'pinecone_latency': args.pinecone_latency,
+        'log_level': args.log_level.upper(),
+    }
+
+    results = []
+    for n in args.sizes:
+        for stage in args.stages:
+            # A fresh process per stage keeps peak RSS and module state separate
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                result = executor.submit(run_stage, stage, n, options).result()
+            print_result(result)
+            results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
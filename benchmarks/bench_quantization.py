@@ -0,0 +1,95 @@
+"""
+Benchmark quantized similarity search against exact float32 search.
+
+The quantized engines run the way the match job does: on a compacted
+vector snapshot whose float32 rows and quantized codes are memory-mapped,
+so the sizes reported are what each engine holds in memory versus what it
+only maps from disk.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_quantization --sizes 10000 50000
+"""
+import time
+import argparse
+import tempfile
+from typing import Tuple
+
+import numpy as np
+
+from benchmarks.synthetic import clustered_embeddings
+from match_engine import MatchEngine
+from quantization import QUANTIZATIONS, recall_at_k
+from vector_snapshot import VectorSnapshot
+
+TOP_K = 4
+# Bytes per element of an embedding held as a list of Python floats
+PYTHON_FLOAT_BYTES = 32
+
+
+def timed_top_k(engine: MatchEngine, queries):
+    start = time.perf_counter()
+    indices, _ = engine.top_k(TOP_K, queries)
+    return indices, time.perf_counter() - start
+
+
+def engine_bytes(engine: MatchEngine) -> Tuple[int, int]:
+    """Bytes of the engine's vectors and codes held in memory, and memory-mapped from files."""
+    arrays = [engine.matrix]
+    if engine.quantized is not None:
+        arrays += [engine.quantized.codes, engine.quantized.scales]
+    resident = mapped = 0
+    for array in arrays:
+        if array is None:
+            continue
+        if isinstance(array, np.memmap):
+            mapped += array.nbytes
+        else:
+            resident += array.nbytes
+    return resident, mapped
+
+
+def describe(engine: MatchEngine) -> str:
+    resident, mapped = engine_bytes(engine)
+    return f"{resident / 1e6:8.1f} MB resident {mapped / 1e6:8.1f} MB mapped"
+
+
+def run(n: int, dim: int, queries: int, rerank_factors) -> None:
+    vectors = clustered_embeddings(n, dim)
+    ids = [f"user-{i}" for i in range(n)]
+    rows = range(min(queries, n))
+
+    exact = MatchEngine(ids, vectors, ann_threshold=None)
+    expected, seconds = timed_top_k(exact, rows)
+    print(f"n={n:>7}  python lists {n * dim * PYTHON_FLOAT_BYTES / 1e6:8.1f} MB")
+    print(f"{'':>9}  {'float32':<13} {describe(exact)}  {seconds:6.2f}s  recall@{TOP_K} 1.000")
+
+    for kind in QUANTIZATIONS:
+        with tempfile.TemporaryDirectory() as path:
+            snapshot = VectorSnapshot(path, quantization=kind)
+            snapshot.append(ids, exact.matrix, [None] * n)
+            snapshot.compact()
+            embeddings = snapshot.load()
+            for factor in rerank_factors:
+                engine = MatchEngine(embeddings.ids, embeddings.vectors, ann_threshold=None, normalized=True,
+                                     quantization=kind, rerank_factor=factor, quantized=embeddings.quantized)
+                actual, seconds = timed_top_k(engine, rows)
+                print(f"{'':>9}  {kind:<7} x{factor:<4} {describe(engine)}  {seconds:6.2f}s  "
+                      f"recall@{TOP_K} {recall_at_k(expected, actual):.3f}")
+                del engine
+            del embeddings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000])
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=2000, help="number of users to query")
+    parser.add_argument('--rerank-factors', type=int, nargs='+', default=[1, 4])
+    args = parser.parse_args()
+    for n in args.sizes:
+        run(n, args.dim, args.queries, args.rerank_factors)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark opening the local vector snapshot against parsing embeddings from JSON.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_snapshot --sizes 10000 50000
+"""
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from benchmarks.synthetic import clustered_embeddings
+from vector_snapshot import VectorSnapshot
+
+# Rows serialized to time JSON parsing; the total is extrapolated from them
+JSON_SAMPLE = 2000
+
+
+def run(n: int, dim: int) -> None:
+    vectors = clustered_embeddings(n, dim)
+    ids = [f"user-{i:08d}" for i in range(n)]
+    updated_at = ['2026-01-01T00:00:00+00:00'] * n
+
+    sample = [json.dumps(vector.tolist()) for vector in vectors[:JSON_SAMPLE]]
+    start = time.perf_counter()
+    for value in sample:
+        np.asarray(json.loads(value), dtype=np.float32)
+    json_seconds = (time.perf_counter() - start) * n / len(sample)
+
+    with tempfile.TemporaryDirectory() as path:
+        snapshot = VectorSnapshot(path)
+        start = time.perf_counter()
+        half = n // 2
+        snapshot.append(ids[:half], vectors[:half], updated_at[:half])
+        snapshot.append(ids[half:], vectors[half:], updated_at[half:])
+        append_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        merged = snapshot.load()
+        merged_seconds = time.perf_counter() - start
+        del merged
+
+        start = time.perf_counter()
+        snapshot.compact()
+        compact_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        embeddings = snapshot.load()
+        open_seconds = time.perf_counter() - start
+        assert len(embeddings) == n
+
+    print(f"n={n:>7}  parse JSON {json_seconds:7.2f}s (extrapolated)  "
+          f"append {append_seconds:6.2f}s  open 2 segments {merged_seconds:6.3f}s  "
+          f"compact {compact_seconds:6.2f}s  open compacted {open_seconds * 1000:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000])
+    parser.add_argument('--dim', type=int, default=1536)
+    args = parser.parse_args()
+    for n in args.sizes:
+        run(n, args.dim)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+"""
+In-process stand-ins for OpenAI, Supabase and Pinecone, so the pipelines can be benchmarked offline.
+
+Every fake counts its calls and can add a fixed latency per request. They
+implement only the parts of each client that this repository uses.
+"""
+import json
+import time
+import heapq
+import hashlib
+import threading
+from collections import Counter
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from embedding_batcher import estimate_tokens
+
+# Line vectors kept by FakeOpenAI; free-text lines beyond this are recomputed
+LINE_CACHE_SIZE = 4096
+
+
+class FakeRateLimitError(Exception):
+    """What FakeOpenAI raises for an injected 429."""
+    status_code = 429
+
+
+class FakeOpenAI:
+    """
+    Deterministic embedding server with the `client.embeddings.create` interface.
+
+    A text's embedding is the normalized sum of one pseudo-random vector per
+    line, seeded by the line and the model, so surveys sharing answers get
+    similar embeddings. Each request sleeps `latency` plus
+    `latency_per_input` per text, and fails with a 429 with probability
+    `rate_limit_rate`.
+    """
+
+    def __init__(self, dim: int = 1536, latency: float = 0.0, latency_per_input: float = 0.0,
+                 rate_limit_rate: float = 0.0, seed: int = 0):
+        self.dim = dim
+        self.latency = latency
+        self.latency_per_input = latency_per_input
+        self.rate_limit_rate = rate_limit_rate
+        self.calls = Counter()
+        self._rng = np.random.default_rng(seed)
+        self._lines: Dict[tuple, np.ndarray] = {}
+        self._lock = threading.Lock()
+        self.embeddings = SimpleNamespace(create=self.create)
+
+    def _line_vector(self, model: str, line: str) -> np.ndarray:
+        key = (model, line)
+        vector = self._lines.get(key)
+        if vector is None:
+            seed = int.from_bytes(hashlib.blake2b(f"{model}\0{line}".encode(), digest_size=8).digest(), 'little')
+            vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+            if len(self._lines) < LINE_CACHE_SIZE:
+                self._lines[key] = vector
+        return vector
+
+    def embed(self, model: str, text: str) -> List[float]:
+        vector = np.sum([self._line_vector(model, line) for line in text.splitlines() or ['']], axis=0)
+        return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+    def create(self, model: str, input: Sequence[str], encoding_format: Optional[str] = None, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input)
+        if self.latency or self.latency_per_input:
+            time.sleep(self.latency + self.latency_per_input * len(texts))
+        with self._lock:
+            self.calls['embeddings.create'] += 1
+            if self.rate_limit_rate and self._rng.random() < self.rate_limit_rate:
+                self.calls['rate_limited'] += 1
+                raise FakeRateLimitError("Rate limit reached for requests")
+            tokens = sum(estimate_tokens(text) for text in texts)
+            self.calls['inputs'] += len(texts)
+            self.calls['tokens'] += tokens
+        return SimpleNamespace(
+            data=[SimpleNamespace(index=i, embedding=self.embed(model, text)) for i, text in enumerate(texts)],
+            model=model,
+            usage=SimpleNamespace(prompt_tokens=tokens, total_tokens=tokens)
+        )
+
+
+class _Result:
+    def __init__(self, data: List[Dict]):
+        self.data = data
+
+
+def _coerce(value: str, like):
+    """Parse a PostgREST filter value to the type of the column it is compared with."""
+    if value == 'null':
+        return None
+    if isinstance(like, bool):
+        return value == 'true'
+    if isinstance(like, int):
+        return int(value)
+    if isinstance(like, float):
+        return float(value)
+    return value
+
+
+def _compare(op: str, column: str, value) -> Callable[[Dict], bool]:
+    if op == 'eq':
+        return lambda row: row.get(column) == value
+    if op == 'neq':
+        return lambda row: row.get(column) != value
+    if op == 'is':
+        return lambda row: row.get(column) is value
+    comparisons = {
+        'gt': lambda a, b: a > b,
+        'gte': lambda a, b: a >= b,
+        'lt': lambda a, b: a < b,
+        'lte': lambda a, b: a <= b,
+    }
+    compare = comparisons[op]
+    return lambda row: row.get(column) is not None and compare(row[column], value)
+
+
+class FakeQuery:
+    """One PostgREST request being built, as returned by `FakeSupabase.table`."""
+
+    def __init__(self, db: 'FakeSupabase', table: str):
+        self.db = db
+        self.table = table
+        self.op = 'select'
+        self.filters: List[Callable[[Dict], bool]] = []
+        self.key_lookup: Optional[set] = None
+        self.order_by: List[str] = []
+        self.descending = False
+        self.row_offset = 0
+        self.row_limit: Optional[int] = None
+        self.payload = None
+        self.on_conflict: Optional[str] = None
+
+    def select(self, columns: str = '*', **kwargs) -> 'FakeQuery':
+        return self
+
+    def order(self, column: str, desc: bool = False, **kwargs) -> 'FakeQuery':
+        if not self.order_by:
+            self.descending = desc
+        self.order_by.append(column)
+        return self
+
+    def limit(self, count: int) -> 'FakeQuery':
+        self.row_limit = count
+        return self
+
+    def range(self, start: int, end: int) -> 'FakeQuery':
+        self.row_offset = start
+        self.row_limit = end - start + 1
+        return self
+
+    def eq(self, column: str, value) -> 'FakeQuery':
+        self.filters.append(_compare('eq', column, value))
+        return self
+
+    def neq(self, column: str, value) -> 'FakeQuery':
+        self.filters.append(_compare('neq', column, value))
+        return self
+
+    def gt(self, column: str, value) -> 'FakeQuery':
+        self.filters.append(_compare('gt', column, value))
+        return self
+
+    def gte(self, column: str, value) -> 'FakeQuery':
+        self.filters.append(_compare('gte', column, value))
+        return self
+
+    def lt(self, column: str, value) -> 'FakeQuery':
+        self.filters.append(_compare('lt', column, value))
+        return self
+
+    def lte(self, column: str, value) -> 'FakeQuery':
+        self.filters.append(_compare('lte', column, value))
+        return self
+
+    def is_(self, column: str, value) -> 'FakeQuery':
+        self.filters.append(_compare('is', column, None if value in ('null', None) else value))
+        return self
+
+    def in_(self, column: str, values) -> 'FakeQuery':
+        values = set(values)
+        if self.db.keys.get(self.table) == (column,) and self.key_lookup is None:
+            self.key_lookup = {(value,) for value in values}
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def or_(self, expression: str) -> 'FakeQuery':
+        """Filters like `format_version.is.null,format_version.lt.2`."""
+        parsed = [part.split('.', 2) for part in expression.split(',')]
+
+        def matches(row: Dict) -> bool:
+            for column, op, value in parsed:
+                value = _coerce(value, row.get(column))
+                if _compare(op, column, value)(row):
+                    return True
+            return False
+        self.filters.append(matches)
+        return self
+
+    def insert(self, rows, **kwargs) -> 'FakeQuery':
+        self.op = 'insert'
+        self.payload = rows if isinstance(rows, list) else [rows]
+        return self
+
+    def upsert(self, rows, on_conflict: Optional[str] = None, **kwargs) -> 'FakeQuery':
+        self.op = 'upsert'
+        self.payload = rows if isinstance(rows, list) else [rows]
+        self.on_conflict = on_conflict
+        return self
+
+    def update(self, values: Dict) -> 'FakeQuery':
+        self.op = 'update'
+        self.payload = values
+        return self
+
+    def delete(self) -> 'FakeQuery':
+        self.op = 'delete'
+        return self
+
+    def _matching(self, rows: Dict[tuple, Dict]) -> List[tuple]:
+        keys = self.key_lookup if self.key_lookup is not None else rows.keys()
+        return [key for key in keys if key in rows and all(f(rows[key]) for f in self.filters)]
+
+    def execute(self) -> _Result:
+        self.db._request(f"{self.op} {self.table}")
+        with self.db._lock:
+            rows = self.db.tables.setdefault(self.table, {})
+            if self.op in ('insert', 'upsert'):
+                columns = tuple(self.on_conflict.split(',')) if self.on_conflict else None
+                for row in self.payload:
+                    self.db._store(self.table, row, columns)
+                return _Result(self.payload)
+
+            matching = self._matching(rows)
+            if self.op == 'update':
+                for key in matching:
+                    rows[key].update(self.payload)
+                return _Result([dict(rows[key]) for key in matching])
+            if self.op == 'delete':
+                return _Result([rows.pop(key) for key in matching])
+
+            selected = [rows[key] for key in matching]
+            if self.order_by:
+                sort_key = lambda row: tuple((row.get(column) is None, row.get(column)) for column in self.order_by)
+                if self.row_limit is not None:
+                    pick = heapq.nlargest if self.descending else heapq.nsmallest
+                    selected = pick(self.row_offset + self.row_limit, selected, key=sort_key)
+                else:
+                    selected.sort(key=sort_key, reverse=self.descending)
+            selected = selected[self.row_offset:]
+            if self.row_limit is not None:
+                selected = selected[:self.row_limit]
+            return _Result([dict(row) for row in selected])
+
+
+class FakeSupabase:
+    """
+    In-memory PostgREST stand-in with the `table(...)` query builder and `rpc(...)`.
+
+    Rows are stored by primary key (`keys`, default `user_id`), so upserts
+    replace rows like `on_conflict` does. Tables without a key just append.
+    Functions called through `rpc` are registered in `functions`.
+    `vector_columns` are stored as pgvector text, like PostgREST returns
+    them; other values are stored as given. `written_at` records when each
+    user's row was first inserted or upserted into each table.
+    """
+
+    DEFAULT_KEYS = {
+        'profiles': ('id',),
+        'survey_responses': ('user_id',),
+        'user_embeddings': ('user_id', 'model'),
+        'embedding_settings': ('key',),
+        'embedding_migrations': ('target_model',),
+        'matches': ('user_id', 'match_id'),
+        'match_cards': ('user_id', 'match_id'),
+        'match_card_refresh': ('user_id',),
+        'roommate_pairs': ('user_id',),
+    }
+
+    def __init__(self, latency: float = 0.0, keys: Optional[Dict[str, Optional[tuple]]] = None,
+                 vector_columns: Sequence[str] = ('embedding',)):
+        self.latency = latency
+        self.keys = {**self.DEFAULT_KEYS, **(keys or {})}
+        self.vector_columns = set(vector_columns)
+        self.tables: Dict[str, Dict[tuple, Dict]] = {}
+        self.written_at: Dict[str, Dict[str, float]] = {}
+        self.functions: Dict[str, Callable[..., List[Dict]]] = {}
+        self.calls = Counter()
+        self._lock = threading.RLock()
+        self._next_id = 0
+
+    def _request(self, name: str) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[name] += 1
+
+    def _store(self, table: str, row: Dict, columns: Optional[tuple] = None) -> None:
+        row = {
+            column: json.dumps(value, separators=(',', ':'))
+            if column in self.vector_columns and isinstance(value, list) else value
+            for column, value in row.items()
+        }
+        self.tables.setdefault(table, {}).setdefault(self._key(table, row, columns), {}).update(row)
+        if 'user_id' in row:
+            self.written_at.setdefault(table, {}).setdefault(str(row['user_id']), time.perf_counter())
+
+    def _key(self, table: str, row: Dict, columns: Optional[tuple] = None) -> tuple:
+        columns = columns or self.keys.get(table, ('user_id',))
+        if columns is None:
+            self._next_id += 1
+            return (self._next_id,)
+        return tuple(row.get(column) for column in columns)
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def rows(self, table: str) -> List[Dict]:
+        """Every row of a table, for seeding checks and reports."""
+        return list(self.tables.get(table, {}).values())
+
+    def load(self, table: str, rows: List[Dict]) -> None:
+        """Seed a table without counting requests."""
+        for row in rows:
+            self._store(table, row)
+        self.written_at.pop(table, None)
+
+    def rpc(self, name: str, params: Optional[Dict] = None):
+        db = self
+
+        class _Call:
+            def execute(self):
+                db._request(f"rpc {name}")
+                return _Result(db.functions[name](**(params or {})))
+        return _Call()
+
+
+class FakeIndex:
+    """Brute-force Pinecone index with `upsert` and `query` over normalized vectors."""
+
+    def __init__(self, pinecone: 'FakePinecone'):
+        self.pinecone = pinecone
+        self.namespaces: Dict[str, Dict[str, tuple]] = {}
+        self._matrices: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors: List[Dict], namespace: Optional[str] = None, batch_size: Optional[int] = None, **kwargs):
+        requests = -(-len(vectors) // batch_size) if batch_size else 1
+        for _ in range(requests):
+            self.pinecone._request('upsert')
+        with self._lock:
+            stored = self.namespaces.setdefault(namespace or '', {})
+            for vector in vectors:
+                stored[vector['id']] = (np.asarray(vector['values'], dtype=np.float32), vector.get('metadata') or {})
+            self._matrices.pop(namespace or '', None)
+        return SimpleNamespace(upserted_count=len(vectors))
+
+    def _matrix(self, namespace: str) -> tuple:
+        with self._lock:
+            if namespace not in self._matrices:
+                stored = self.namespaces.get(namespace, {})
+                ids = list(stored)
+                matrix = np.stack([stored[i][0] for i in ids]) if ids else np.empty((0, 0), dtype=np.float32)
+                norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                norms[norms == 0] = 1.0
+                self._matrices[namespace] = (ids, matrix / norms)
+            return self._matrices[namespace]
+
+    def query(self, vector: List[float], top_k: int = 10, include_metadata: bool = False,
+              namespace: Optional[str] = None, **kwargs):
+        self.pinecone._request('query')
+        ids, matrix = self._matrix(namespace or '')
+        if not ids:
+            return SimpleNamespace(matches=[])
+        query = np.asarray(vector, dtype=np.float32)
+        scores = matrix @ (query / (np.linalg.norm(query) or 1.0))
+        top = np.argsort(-scores)[:top_k]
+        stored = self.namespaces[namespace or '']
+        return SimpleNamespace(matches=[
+            SimpleNamespace(id=ids[i], score=float(scores[i]),
+                            metadata=stored[ids[i]][1] if include_metadata else None)
+            for i in top
+        ])
+
+
+class FakePinecone:
+    """Stand-in for the `Pinecone` client; every index name maps to one shared FakeIndex."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.index = FakeIndex(self)
+
+    def _request(self, name: str) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[name] += 1
+
+    def Index(self, name: Optional[str] = None, **kwargs) -> FakeIndex:
+        return self.index
@@ -0,0 +1,78 @@
+from typing import Dict, List
+
+import numpy as np
+
+from survey_format import FIELDS
+
+
+def clustered_embeddings(n: int, dim: int = 1536, clusters: int = 50, noise: float = 0.6,
+                         seed: int = 0) -> np.ndarray:
+    """Random float32 embeddings grouped around `clusters` centres, like real survey embeddings."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, n)
+    vectors = centres[labels] + noise * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors.astype(np.float32)
+
+
+# Option lists from src/pages/Quiz.jsx that survey_format doesn't label
+UNIVERSITIES = [
+    "University of New Hampshire", "Plymouth State University", "Keene State College",
+    "Dartmouth College", "Southern New Hampshire University", "New England College",
+    "Saint Anselm College", "Franklin Pierce University", "Rivier University",
+    "Colby-Sawyer College", "Granite State College", "Manchester Community College",
+]
+LANGUAGES = [
+    "English", "Spanish", "French", "German", "Chinese", "Japanese", "Korean",
+    "Arabic", "Russian", "Portuguese", "Italian", "Hindi", "Vietnamese",
+]
+COUNTRIES = [
+    "United States", "Canada", "United Kingdom", "China", "India", "Japan",
+    "South Korea", "Brazil", "Mexico", "France", "Germany", "Nigeria", "Vietnam",
+]
+HOBBIES = [
+    "Basketball", "Soccer", "Running", "Hiking", "Yoga", "Painting", "Photography",
+    "Writing", "Playing Guitar", "Singing", "Dancing", "Video Gaming", "Board Gaming",
+    "Programming", "Reading", "Chess", "Movies", "Anime", "Cooking", "Baking",
+    "Camping", "Gardening", "Meditation", "Volunteering",
+]
+ABOUT_ME = [
+    "I keep to myself during the week", "I love hosting game nights",
+    "I work part time on campus", "I'm on the varsity team", "I go home most weekends",
+    "I'm a light sleeper", "I play music in a band", "I'm pre-med and study a lot",
+]
+
+
+def survey_population(n: int, seed: int = 0, missing: float = 0.05) -> List[Dict]:
+    """
+    Synthetic users answering the Quiz.jsx survey, as `{'user_id', 'university', 'responses'}`.
+
+    Answers are drawn from the quiz's own options, and about `missing` of
+    them are left blank like a partly filled survey.
+    """
+    rng = np.random.default_rng(seed)
+    single = [(field, list(labels)) for field, _, labels in FIELDS if labels]
+
+    def pick(options, size=None):
+        return [options[i] for i in rng.choice(len(options), size=size, replace=False)]
+
+    users = []
+    for i in range(n):
+        university = UNIVERSITIES[rng.integers(len(UNIVERSITIES))]
+        responses = {field: options[rng.integers(len(options))] for field, options in single}
+        responses.update({
+            'fullName': f"Student {i}",
+            'university': [university],
+            'countryOfOrigin': COUNTRIES[rng.integers(len(COUNTRIES))],
+            'languages': pick(LANGUAGES, rng.integers(1, 4)),
+            'hobbies': pick(HOBBIES, rng.integers(1, 6)),
+            'additionalInfo': '. '.join(pick(ABOUT_ME, rng.integers(0, 3))),
+        })
+        for field in [field for field in responses if field != 'fullName' and rng.random() < missing]:
+            responses[field] = [] if isinstance(responses[field], list) else ''
+        users.append({
+            'user_id': f"00000000-0000-4000-8000-{seed:04d}{i:08d}",
+            'university': university,
+            'responses': responses,
+        })
+    return users
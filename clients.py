@@ -0,0 +1,221 @@
+import os
+import time
+import logging
+import threading
+from functools import lru_cache
+from typing import Callable, Optional
+
+import httpx
+from dotenv import load_dotenv
+from langchain_openai import OpenAIEmbeddings
+from openai import OpenAI
+from pinecone import Pinecone
+from supabase import create_client
+
+from embedding_batcher import EmbedFn, openai_embed_fn
+from metrics import metrics
+from rate_limiter import RateLimiter, rate_limited
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+DEFAULT_POOL_SIZE = 20
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit is open."""
+    # Looks like a 503 to retry logic, e.g. EmbeddingBatcher and WriteBuffer
+    status_code = 503
+
+
+def is_service_failure(error: Exception) -> bool:
+    """Whether an error means the service is unhealthy (network error, 5xx, 429) rather than a bad request."""
+    status = getattr(error, 'status_code', None) or getattr(error, 'status', None)
+    if isinstance(status, int):
+        return status >= 500 or status == 429
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    return type(error).__module__.split('.')[0] in ('httpx', 'httpcore', 'urllib3')
+
+
+class CircuitBreaker:
+    """
+    Fail fast while a service keeps failing.
+
+    After `failure_threshold` consecutive service failures the circuit
+    opens and calls raise CircuitOpenError without reaching the service.
+    Once `reset_timeout` seconds have passed, one trial call is let through:
+    if it succeeds the circuit closes, otherwise it opens again. Errors
+    that are the caller's fault (e.g. a 4xx) count as the service being up.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def _before_call(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._trial or time.monotonic() - self._opened_at < self.reset_timeout:
+                metrics.inc('circuit_rejected_total', service=self.name)
+                raise CircuitOpenError(f"{self.name} circuit is open after {self._failures} failures")
+            self._trial = True
+
+    def _after_call(self, error: Optional[Exception]) -> None:
+        with self._lock:
+            self._trial = False
+            if error is None or not is_service_failure(error):
+                if self._opened_at is not None:
+                    logger.info(f"{self.name} circuit closed")
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(f"{self.name} circuit opened after {self._failures} failures: {str(error)}")
+                    metrics.inc('circuit_opened_total', service=self.name)
+                self._opened_at = time.monotonic()
+
+    def call(self, func: Callable, *args, **kwargs):
+        """Call `func` through the breaker."""
+        self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self._after_call(e)
+            raise
+        self._after_call(None)
+        return result
+
+
+class GuardedQuery:
+    """
+    Wrap a Supabase client or query builder so every `execute()` goes through a circuit breaker.
+
+    Builder methods return wrapped builders, so chains like
+    `client.table(...).select(...).eq(...).execute()` work unchanged.
+    """
+
+    _PLAIN = (str, bytes, int, float, bool, dict, list, tuple, type(None))
+
+    def __init__(self, target, breaker: CircuitBreaker):
+        self._target = target
+        self._breaker = breaker
+
+    def _wrap(self, value):
+        return value if isinstance(value, self._PLAIN) else GuardedQuery(value, self._breaker)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._target, name)
+        if name == 'execute':
+            return lambda *args, **kwargs: self._breaker.call(attr, *args, **kwargs)
+        if callable(attr):
+            return lambda *args, **kwargs: self._wrap(attr(*args, **kwargs))
+        return self._wrap(attr)
+
+
+class GuardedIndex:
+    """Wrap a Pinecone index so every request goes through a circuit breaker."""
+
+    def __init__(self, index, breaker: CircuitBreaker):
+        self._index = index
+        self._breaker = breaker
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._index, name)
+        if callable(attr):
+            return lambda *args, **kwargs: self._breaker.call(attr, *args, **kwargs)
+        return attr
+
+
+def _breaker(name: str) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        failure_threshold=int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', str(DEFAULT_FAILURE_THRESHOLD))),
+        reset_timeout=float(os.getenv('CIRCUIT_RESET_TIMEOUT', str(DEFAULT_RESET_TIMEOUT)))
+    )
+
+
+@lru_cache(maxsize=None)
+def openai_rate_limiter() -> RateLimiter:
+    """
+    The process-wide OpenAI limiter.
+
+    OPENAI_RPM and OPENAI_TPM cap it (0 = only what the API advertises);
+    every response's rate-limit headers tune it from there.
+    """
+    return RateLimiter(float(os.getenv('OPENAI_RPM', '0')) or None,
+                       float(os.getenv('OPENAI_TPM', '0')) or None)
+
+
+@lru_cache(maxsize=None)
+def openai_http_client():
+    """Pooled keep-alive HTTP client for OpenAI that feeds rate-limit headers to the limiter."""
+    pool_size = int(os.getenv('HTTP_POOL_SIZE', str(DEFAULT_POOL_SIZE)))
+    limiter = openai_rate_limiter()
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        timeout=httpx.Timeout(float(os.getenv('HTTP_TIMEOUT', str(DEFAULT_TIMEOUT))), connect=10.0),
+        event_hooks={'response': [lambda response: limiter.observe_headers(response.headers)]}
+    )
+
+
+@lru_cache(maxsize=None)
+def openai_client(api_key: Optional[str] = None):
+    """
+    The shared OpenAI client.
+
+    Its own retries are off: EmbeddingBatcher retries transient errors and
+    the limiter honours Retry-After, so a 429 isn't retried twice.
+    """
+    return OpenAI(api_key=api_key or os.getenv('VITE_OPENAI_API_KEY'),
+                  http_client=openai_http_client(), max_retries=0)
+
+
+def langchain_embeddings(model: str, api_key: Optional[str] = None):
+    """LangChain `OpenAIEmbeddings` for a model, on the shared HTTP pool."""
+    return OpenAIEmbeddings(openai_api_key=api_key or os.getenv('VITE_OPENAI_API_KEY'), model=model,
+                            http_client=openai_http_client(), max_retries=0)
+
+
+def embed_fn(model: str, client=None) -> EmbedFn:
+    """An embed function for a model, paced by the shared limiter."""
+    return rate_limited(openai_embed_fn(client or openai_client(), model), openai_rate_limiter())
+
+
+@lru_cache(maxsize=None)
+def supabase_client(url: Optional[str] = None, key: Optional[str] = None):
+    """
+    The shared Supabase client for a project, with a circuit breaker on every request.
+
+    One client per process keeps its PostgREST session, and the
+    connections in it, alive across every query.
+    """
+    url = url or os.getenv('VITE_SUPABASE_URL')
+    key = key or os.getenv('VITE_SUPABASE_SERVICE_ROLE_KEY')
+    return GuardedQuery(create_client(url, key), _breaker('supabase'))
+
+
+@lru_cache(maxsize=None)
+def pinecone_index(name: Optional[str] = None, api_key: Optional[str] = None):
+    """The shared Pinecone index handle, with a circuit breaker on every request."""
+    pool_size = int(os.getenv('HTTP_POOL_SIZE', str(DEFAULT_POOL_SIZE)))
+    client = Pinecone(api_key=api_key or os.getenv('PINECONE_API_KEY'), pool_threads=pool_size)
+    index = client.Index(name or os.getenv('PINECONE_INDEX'), pool_threads=pool_size)
+    return GuardedIndex(index, _breaker('pinecone'))
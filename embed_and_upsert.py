@@ -1,13 +1,22 @@
 import os
 import json
+import asyncio
 import logging
-from datetime import datetime, timezone
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
-from pinecone import Pinecone
 from dotenv import load_dotenv
-from langchain_openai import OpenAIEmbeddings
-from supabase import create_client, Client
+from supabase import Client
+
+import clients
+from embedding_batcher import EmbedFn, EmbeddingBatcher, langchain_embed_fn
+from embedding_cache import cache_from_env
+from embedding_models import embed_for_models, model_batchers, pinecone_namespace, write_models
+from async_pipeline import AsyncEmbeddingPipeline
+from metrics import export_metrics, metrics
+from rate_limiter import rate_limited
+from survey_format import format_survey
+from vector_snapshot import snapshot_writer_from_env
+from write_buffer import PineconeUpsertBuffer, SupabaseUpsertBuffer
 
 # Configure logging
 logging.basicConfig(
@@ -17,7 +26,12 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 class EmbeddingProcessor:
-    def __init__(self):
+    def __init__(self, supabase: Optional[Client] = None, pinecone_index=None,
+                 embed_fn_factory: Optional[Callable[[str], EmbedFn]] = None):
+        """
+        Clients are built from the environment unless given; `embed_fn_factory`
+        returns the embed function for a model (see benchmarks/fakes.py).
+        """
         # Load environment variables
         load_dotenv()
         self.openai_api_key = os.getenv('VITE_OPENAI_API_KEY')
@@ -26,80 +40,107 @@ class EmbeddingProcessor:
         self.pinecone_api_key = os.getenv('PINECONE_API_KEY')
         self.pinecone_env = os.getenv('PINECONE_ENVIRONMENT')
         self.pinecone_index_name = os.getenv('PINECONE_INDEX')
+        self.pinecone_namespace = os.getenv('PINECONE_NAMESPACE')
+        self.write_chunk_size = int(os.getenv('WRITE_CHUNK_SIZE', '500'))
+        self.write_flush_interval = float(os.getenv('WRITE_FLUSH_INTERVAL', '5'))
 
-        # Validate environment variables
-        self._validate_env_vars()
+        # Validate environment variables for the clients we have to build
+        self._validate_env_vars(
+            (['VITE_SUPABASE_URL', 'VITE_SUPABASE_SERVICE_ROLE_KEY'] if supabase is None else [])
+            + (['PINECONE_API_KEY', 'PINECONE_ENVIRONMENT', 'PINECONE_INDEX'] if pinecone_index is None else [])
+            + (['VITE_OPENAI_API_KEY'] if embed_fn_factory is None else [])
+        )
 
         # Initialize clients
-        self.supabase: Client = create_client(self.supabase_url, self.supabase_key)
-        self.embeddings = OpenAIEmbeddings(
-            openai_api_key=self.openai_api_key,
-            model="text-embedding-3-small"  # 1024-dimensional embeddings
-        )
+        self.supabase: Client = supabase if supabase is not None else \
+            clients.supabase_client(self.supabase_url, self.supabase_key)
+        if embed_fn_factory is None:
+            embed_fn_factory = lambda model: langchain_embed_fn(
+                clients.langchain_embeddings(model, self.openai_api_key)
+            )
+
+        # One batcher per model being written (the active model plus any
+        # migration target), all sharing the process-wide OpenAI rate limiter
+        self.models = write_models(self.supabase)
+        self.rate_limiter = clients.openai_rate_limiter()
+        self.batchers = model_batchers(self.models, lambda model: EmbeddingBatcher(
+            rate_limited(embed_fn_factory(model), self.rate_limiter),
+            cache=cache_from_env(model)
+        ))
+        self.batcher = self.batchers[self.models[0]]
         
         # Initialize Pinecone
-        self.pc = Pinecone(api_key=self.pinecone_api_key)
-        self.pinecone_index = self.pc.Index(self.pinecone_index_name)
-
-    def _validate_env_vars(self):
-        """Validate that all required environment variables are set."""
-        required_vars = [
-            'VITE_OPENAI_API_KEY',
-            'VITE_SUPABASE_URL',
-            'VITE_SUPABASE_SERVICE_ROLE_KEY',
-            'PINECONE_API_KEY',
-            'PINECONE_ENVIRONMENT',
-            'PINECONE_INDEX'
-        ]
+        if pinecone_index is None:
+            pinecone_index = clients.pinecone_index(self.pinecone_index_name, self.pinecone_api_key)
+        self.pinecone_index = pinecone_index
+
+        # Write-behind buffers for bulk upserts; stored embeddings also go to the local snapshot
+        self.supabase_buffer = SupabaseUpsertBuffer(
+            self.supabase, 'user_embeddings',
+            on_conflict='user_id,model',
+            chunk_size=self.write_chunk_size,
+            flush_interval=self.write_flush_interval,
+            on_written=snapshot_writer_from_env()
+        )
+        # Each model's vectors live in their own Pinecone namespace
+        self.pinecone_buffers = {
+            model: PineconeUpsertBuffer(
+                self.pinecone_index,
+                namespace=pinecone_namespace(model, self.pinecone_namespace),
+                chunk_size=self.write_chunk_size,
+                flush_interval=self.write_flush_interval
+            )
+            for model in self.models
+        }
+        self.pinecone_buffer = self.pinecone_buffers[self.models[0]]
+
+    def _validate_env_vars(self, required_vars: List[str]):
+        """Validate that the given environment variables are set."""
         missing_vars = [var for var in required_vars if not os.getenv(var)]
         if missing_vars:
             raise ValueError(f"Missing required environment variables: {', '.join(missing_vars)}")
 
     def flatten_responses(self, responses: Dict) -> str:
-        """Convert responses JSON into a flat string format."""
-        flattened = []
-        for key, value in responses.items():
-            flattened.append(f"{key}: {value}")
-        return "\n".join(flattened)
+        """Convert responses JSON into the text that gets embedded."""
+        return format_survey(responses)
 
     def get_users_without_embeddings(self) -> List[Dict]:
         """Get users that don't have embeddings using the RPC function."""
         try:
-            result = self.supabase.rpc(
-                'get_users_without_embeddings'
-            ).execute()
+            with metrics.stage('fetch', items=0, table='get_users_without_embeddings') as stage:
+                result = self.supabase.rpc(
+                    'get_users_without_embeddings'
+                ).execute()
+                stage['items'] = len(result.data)
             return result.data
         except Exception as e:
             logger.error(f"Error fetching users without embeddings: {str(e)}")
             raise
 
-    def save_to_supabase(self, user_id: str, embedding: List[float]) -> None:
-        """Save embedding to Supabase."""
-        try:
-            self.supabase.table('user_embeddings').upsert({
-                'user_id': user_id,
-                'embedding': embedding,
-                'updated_at': datetime.now(timezone.utc).isoformat()
-            }).execute()
-            logger.info(f"Saved embedding to Supabase for user {user_id}")
-        except Exception as e:
-            logger.error(f"Error saving to Supabase for user {user_id}: {str(e)}")
-            raise
+    def embed_rows(self, texts: Dict[str, str]) -> Tuple[List[Dict], Dict[str, str]]:
+        """Embed texts with every model being written and build their `user_embeddings` rows."""
+        return embed_for_models(self.batchers, texts)
 
-    def save_to_pinecone(self, user_id: str, embedding: List[float], university_id: Optional[str]) -> None:
-        """Save embedding to Pinecone."""
-        try:
-            self.pinecone_index.upsert(
-                vectors=[{
-                    'id': user_id,
-                    'values': embedding,
-                    'metadata': {'university_id': university_id} if university_id else {}
-                }]
-            )
-            logger.info(f"Saved embedding to Pinecone for user {user_id}")
-        except Exception as e:
-            logger.error(f"Error saving to Pinecone for user {user_id}: {str(e)}")
-            raise
+    def pinecone_row(self, user_id: str, embedding: List[float], university_id: Optional[str]) -> Dict:
+        """Build the Pinecone vector for an embedding."""
+        return {
+            'id': user_id,
+            'values': embedding,
+            'metadata': {'university_id': university_id} if university_id else {}
+        }
+
+    def save_to_pinecone(self, user_id: str, embedding: List[float], university_id: Optional[str],
+                         model: Optional[str] = None) -> None:
+        """Queue an embedding for the next bulk upsert to its model's Pinecone namespace."""
+        self.pinecone_buffers[model or self.models[0]].add(self.pinecone_row(user_id, embedding, university_id))
+
+    def flush_writes(self) -> None:
+        """Flush all write buffers and log any rows that failed."""
+        for buffer in [self.supabase_buffer, *self.pinecone_buffers.values()]:
+            buffer.flush()
+            failed = buffer.failed_keys()
+            if failed:
+                logger.error(f"Failed to write {len(failed)} rows to {buffer.target}: {', '.join(sorted(failed))}")
 
     def process_users(self) -> None:
         """Main function to process all users without embeddings."""
@@ -108,38 +149,74 @@ class EmbeddingProcessor:
             users = self.get_users_without_embeddings()
             logger.info(f"Found {len(users)} users to process")
 
+            # Flatten responses into strings
+            texts = {}
             for user in users:
                 try:
-                    # Flatten responses into string
-                    flattened_text = self.flatten_responses(user['responses'])
-                    
-                    # Generate embedding
-                    embedding = self.embeddings.embed_query(flattened_text)
-                    
-                    # Save to both databases
-                    self.save_to_supabase(user['user_id'], embedding)
+                    texts[user['user_id']] = self.flatten_responses(user['responses'])
+                except Exception as e:
+                    logger.error(f"Error formatting responses for user {user['user_id']}: {str(e)}")
+
+            # Generate embeddings in batches
+            rows, failures = self.embed_rows(texts)
+            for user_id, error in failures.items():
+                logger.error(f"Error generating embedding for user {user_id}: {error}")
+
+            # Store in Supabase first; only users stored there are indexed in Pinecone
+            for row in rows:
+                self.supabase_buffer.add(row)
+            self.supabase_buffer.flush()
+            failed = self.supabase_buffer.failed_keys()
+
+            universities = {user['user_id']: user.get('university_id') for user in users}
+            for row in rows:
+                if str(row['user_id']) in failed:
+                    continue
+                try:
                     self.save_to_pinecone(
-                        user['user_id'], 
-                        embedding,
-                        user.get('university_id')
+                        row['user_id'],
+                        row['embedding'],
+                        universities.get(row['user_id']),
+                        row['model']
                     )
                     
                 except Exception as e:
-                    logger.error(f"Error processing user {user['user_id']}: {str(e)}")
+                    logger.error(f"Error processing user {row['user_id']}: {str(e)}")
                     continue
 
+            self.flush_writes()
+
         except Exception as e:
             logger.error(f"Error in process_users: {str(e)}")
             raise
 
+    async def process_users_async(self) -> Dict[str, int]:
+        """Process all users without embeddings with the concurrent embed -> persist -> index pipeline."""
+        users = self.get_users_without_embeddings()
+        logger.info(f"Found {len(users)} users to process")
+        pipeline = AsyncEmbeddingPipeline(
+            self,
+            batch_size=int(os.getenv('PIPELINE_BATCH_SIZE', '100')),
+            embed_concurrency=int(os.getenv('PIPELINE_EMBED_CONCURRENCY', '4')),
+            supabase_concurrency=int(os.getenv('PIPELINE_SUPABASE_CONCURRENCY', '2')),
+            pinecone_concurrency=int(os.getenv('PIPELINE_PINECONE_CONCURRENCY', '2')),
+            queue_size=int(os.getenv('PIPELINE_QUEUE_SIZE', '4'))
+        )
+        return await pipeline.run(users)
+
 def main():
     try:
         processor = EmbeddingProcessor()
-        processor.process_users()
+        if os.getenv('EMBEDDING_PIPELINE', 'sequential') == 'async':
+            asyncio.run(processor.process_users_async())
+        else:
+            processor.process_users()
         logger.info("Embedding generation completed successfully")
     except Exception as e:
         logger.error(f"Error in main: {str(e)}")
         raise
+    finally:
+        export_metrics()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
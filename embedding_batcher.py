@@ -0,0 +1,188 @@
+import time
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from embedding_cache import EmbeddingCache
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# OpenAI accepts up to 2048 inputs and 300k tokens per embeddings request;
+# keep some headroom because token counts are only estimated here.
+MAX_INPUTS_PER_BATCH = 2048
+MAX_TOKENS_PER_BATCH = 250_000
+
+EmbedFn = Callable[[List[str]], List[List[float]]]
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the token count of a text (~4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+# Statuses for a request the API rejected because of what was in it
+PAYLOAD_ERROR_STATUSES = (400, 413, 422)
+
+
+def _is_transient(error: Exception) -> bool:
+    """Whether an API error is worth retrying as-is (rate limits, 5xx, network)."""
+    status = getattr(error, 'status_code', None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    return type(error).__name__ in ('APIConnectionError', 'APITimeoutError') \
+        or type(error).__module__.split('.')[0] in ('httpx', 'httpcore')
+
+
+def _is_payload_error(error: Exception) -> bool:
+    """Whether an error is down to the inputs themselves, so smaller batches may succeed."""
+    return getattr(error, 'status_code', None) in PAYLOAD_ERROR_STATUSES or isinstance(error, ValueError)
+
+
+def openai_embed_fn(client, model: str) -> EmbedFn:
+    """Build an embed function backed by `client.embeddings.create`."""
+    def embed(texts: List[str]) -> List[List[float]]:
+        response = client.embeddings.create(
+            model=model,
+            input=texts,
+            encoding_format="float"
+        )
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            metrics.inc('embedding_tokens_total', usage.total_tokens, model=model)
+        # The API tags each result with the index of its input
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    return embed
+
+
+def langchain_embed_fn(embeddings) -> EmbedFn:
+    """Build an embed function backed by a LangChain `Embeddings` instance."""
+    return embeddings.embed_documents
+
+
+class EmbeddingBatcher:
+    """Embed many texts in token-aware batches, retrying only what failed."""
+
+    def __init__(
+        self,
+        embed_fn: EmbedFn,
+        max_tokens_per_batch: int = MAX_TOKENS_PER_BATCH,
+        max_inputs_per_batch: int = MAX_INPUTS_PER_BATCH,
+        max_retries: int = 3,
+        retry_backoff: float = 1.0,
+        cache: Optional[EmbeddingCache] = None
+    ):
+        self.embed_fn = embed_fn
+        self.cache = cache
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.max_inputs_per_batch = max_inputs_per_batch
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+    def make_batches(self, items: List[Tuple[str, str]]) -> List[List[Tuple[str, str]]]:
+        """Group (key, text) pairs into batches that respect the token and input limits."""
+        batches = []
+        current = []
+        current_tokens = 0
+        for key, text in items:
+            tokens = estimate_tokens(text)
+            if current and (
+                current_tokens + tokens > self.max_tokens_per_batch
+                or len(current) >= self.max_inputs_per_batch
+            ):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append((key, text))
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _embed_batch(
+        self,
+        batch: List[Tuple[str, str]],
+        embeddings: Dict[str, List[float]],
+        failures: Dict[str, str],
+        attempt: int = 0
+    ) -> None:
+        tokens = sum(estimate_tokens(text) for _, text in batch)
+        try:
+            with metrics.stage('embed', items=0, tokens=tokens, attempt=attempt) as stage:
+                metrics.inc('embedding_requests_total')
+                metrics.inc('embedding_estimated_tokens_total', tokens)
+                vectors = self.embed_fn([text for _, text in batch])
+                if len(vectors) != len(batch):
+                    raise ValueError(f"Expected {len(batch)} embeddings, got {len(vectors)}")
+                stage['items'] = len(batch)
+        except Exception as e:
+            if getattr(e, 'status_code', None) == 429:
+                metrics.inc('rate_limited_total')
+            if _is_transient(e):
+                if attempt < self.max_retries:
+                    metrics.inc('embedding_retries_total')
+                    time.sleep(self.retry_backoff * (2 ** attempt))
+                    self._embed_batch(batch, embeddings, failures, attempt + 1)
+                    return
+                # Splitting wouldn't help an overloaded or rate-limited API, it would only multiply the calls
+                logger.error(f"Giving up on a batch of {len(batch)} embeddings after {attempt} retries: {str(e)}")
+            elif _is_payload_error(e) and len(batch) > 1:
+                # Split the batch so a single bad input can't fail its neighbours
+                logger.warning(f"Embedding batch of {len(batch)} failed, splitting: {str(e)}")
+                middle = len(batch) // 2
+                self._embed_batch(batch[:middle], embeddings, failures)
+                self._embed_batch(batch[middle:], embeddings, failures)
+                return
+            else:
+                logger.error(f"Giving up on a batch of {len(batch)} embeddings: {str(e)}")
+            for key, _ in batch:
+                failures[key] = str(e)
+            return
+
+        for (key, _), vector in zip(batch, vectors):
+            embeddings[key] = vector
+
+    def embed(self, texts: Dict[str, str]) -> Tuple[Dict[str, List[float]], Dict[str, str]]:
+        """
+        Embed texts keyed by an id (e.g. user_id).
+
+        Returns the embeddings by id, and the error message for every id that
+        could not be embedded after retries.
+        """
+        cached = self.cache.get_many(texts) if self.cache else {}
+
+        # Only embed each distinct uncached text once
+        keys_by_text: Dict[str, List[str]] = {}
+        for key, text in texts.items():
+            if key not in cached:
+                keys_by_text.setdefault(text, []).append(key)
+        unique = {keys[0]: text for text, keys in keys_by_text.items()}
+
+        embeddings: Dict[str, List[float]] = {}
+        failures: Dict[str, str] = {}
+        batches = self.make_batches(list(unique.items()))
+        for batch in batches:
+            self._embed_batch(batch, embeddings, failures)
+        if self.cache:
+            self.cache.put_many(unique, embeddings)
+
+        for keys in keys_by_text.values():
+            for key in keys[1:]:
+                if keys[0] in embeddings:
+                    embeddings[key] = embeddings[keys[0]]
+                else:
+                    failures[key] = failures[keys[0]]
+        embeddings.update(cached)
+        logger.info(
+            f"Embedded {len(embeddings) - len(cached)} texts in {len(batches)} batches "
+            f"({len(cached)} cached, {len(failures)} failed)"
+        )
+        return embeddings, failures
+
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """Embed a list of texts, raising if any of them fails."""
+        embeddings, failures = self.embed({str(i): text for i, text in enumerate(texts)})
+        if failures:
+            raise RuntimeError(f"Failed to embed {len(failures)} of {len(texts)} texts")
+        return [embeddings[str(i)] for i in range(len(texts))]
@@ -0,0 +1,108 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = '.embedding_cache.sqlite'
+DEFAULT_MAX_ENTRIES = 100_000
+
+
+def cache_key(model: str, text: str) -> str:
+    """Hash of the model name and the exact text that was embedded."""
+    return hashlib.sha256(f"{model}\n{text}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent SQLite cache of embeddings keyed by hash(model, text).
+
+    Vectors are stored as float32 blobs. Every hit refreshes the entry's
+    last-used time, and once the cache holds more than `max_entries`
+    embeddings the least recently used ones are evicted.
+    """
+
+    def __init__(self, path: str, model: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.model = model
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self._conn.commit()
+
+    def get_many(self, texts: Dict[str, str]) -> Dict[str, List[float]]:
+        """Return cached embeddings for whichever of the keyed texts are present."""
+        keys = {key: cache_key(self.model, text) for key, text in texts.items()}
+        hashes = list(set(keys.values()))
+        found: Dict[str, bytes] = {}
+        with self._lock:
+            # Stay under SQLite's limit on bound parameters
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                found.update(self._conn.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})', chunk
+                ).fetchall())
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    'UPDATE embeddings SET last_used = ? WHERE key = ?',
+                    [(now, h) for h in found]
+                )
+                self._conn.commit()
+        return {
+            key: np.frombuffer(found[h], dtype=np.float32).tolist()
+            for key, h in keys.items()
+            if h in found
+        }
+
+    def put_many(self, texts: Dict[str, str], embeddings: Dict[str, List[float]]) -> None:
+        """Store the embeddings of the keyed texts, evicting old entries past the size cap."""
+        now = time.time()
+        rows = [
+            (cache_key(self.model, texts[key]), np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for key, vector in embeddings.items()
+        ]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)', rows
+            )
+            (count,) = self._conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    'DELETE FROM embeddings WHERE key IN '
+                    '(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)',
+                    (count - self.max_entries,)
+                )
+                logger.info(f"Evicted {count - self.max_entries} embeddings from the cache")
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def cache_from_env(model: str) -> Optional[EmbeddingCache]:
+    """Open the embedding cache configured by EMBEDDING_CACHE_PATH (empty disables it)."""
+    path = os.getenv('EMBEDDING_CACHE_PATH', DEFAULT_CACHE_PATH)
+    if not path:
+        return None
+    max_entries = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', str(DEFAULT_MAX_ENTRIES)))
+    return EmbeddingCache(path, model, max_entries)
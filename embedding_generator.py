@@ -1,184 +1,346 @@
 import os
-from typing import List, Dict
+import logging
+from datetime import datetime, timezone
+from typing import List, Dict, Iterator, Optional, Set
 from dotenv import load_dotenv
-from supabase import create_client, Client
-from openai import OpenAI
-from langchain.prompts import PromptTemplate
+from supabase import Client
+
+import clients
+from embedding_batcher import EmbeddingBatcher
+from embedding_cache import cache_from_env
+from embedding_models import embed_for_models, model_batchers, write_models
+from job_queue import COMPLETED, DEAD, JobQueue, SQLiteJobQueue, default_worker_id, queue_from_env
+from metrics import export_metrics, metrics
+from survey_format import FORMAT_VERSION, format_survey
+from vector_loader import iter_keyset_pages
+from vector_snapshot import snapshot_writer_from_env
+from write_buffer import SupabaseUpdateBuffer, SupabaseUpsertBuffer
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
-# Initialize Supabase client
-supabase: Client = create_client(
-    os.getenv("VITE_SUPABASE_URL"),
-    os.getenv("VITE_SUPABASE_SERVICE_ROLE_KEY")
-)
+# Chunk size and flush interval for buffered writes
+WRITE_CHUNK_SIZE = int(os.getenv("WRITE_CHUNK_SIZE", "500"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "5"))
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=os.getenv("VITE_OPENAI_API_KEY"))
+# Number of pending surveys fetched and processed at a time
+SURVEY_PAGE_SIZE = int(os.getenv("SURVEY_PAGE_SIZE", "500"))
 
-def format_survey_responses(responses: dict) -> str:
-    """
-    Format survey responses into a natural language string using LangChain.
-    """
-    template = """User Profile Summary:
-    - Age: {age}
-    - Gender: {gender}
-    - Location: {location}
-    - Interests: {interests}
-    - Preferred Room Types: {preferred_room_types}
-    - Budget Range: {budget_range}
-    - Additional Preferences: {additional_preferences}
+def init_clients(supabase_client: Optional[Client] = None, openai_client=None) -> None:
     """
+    Set up the module's clients and the batcher for every model being written
+    (the active model plus the target of any running migration).
     
-    prompt = PromptTemplate(
-        input_variables=["age", "gender", "location", "interests", 
-                        "preferred_room_types", "budget_range", "additional_preferences"],
-        template=template
+    They are built from the environment unless given, e.g. by the benchmark fakes.
+    """
+    global supabase, EMBEDDING_MODELS, embedding_batchers
+    supabase = supabase_client if supabase_client is not None else clients.supabase_client()
+    EMBEDDING_MODELS = write_models(supabase)
+    embedding_batchers = model_batchers(
+        EMBEDDING_MODELS,
+        lambda model: EmbeddingBatcher(clients.embed_fn(model, openai_client), cache=cache_from_env(model))
     )
-    
-    # Fill in any missing values with "Not specified"
-    for key in prompt.input_variables:
-        if key not in responses:
-            responses[key] = "Not specified"
-    
-    return prompt.format(**responses)
 
-def get_embedding(text: str) -> List[float]:
+# Set by init_clients(), called from main() or by whoever drives this module
+supabase: Optional[Client] = None
+EMBEDDING_MODELS: List[str] = []
+embedding_batchers: Dict[str, EmbeddingBatcher] = {}
+
+# Stored embeddings are also appended to the local vector snapshot read by the match job
+snapshot_writes = snapshot_writer_from_env()
+
+def iter_pending_surveys(page_size: int = SURVEY_PAGE_SIZE) -> Iterator[List[Dict]]:
     """
-    Generate embedding using OpenAI's text-embedding-ada-002 model.
+    Stream pages of surveys that don't have an embedding status yet.
     """
-    response = openai_client.embeddings.create(
-        model="text-embedding-ada-002",
-        input=text
+    return iter_keyset_pages(
+        supabase, "survey_responses", "user_id, responses",
+        page_size=page_size,
+        apply_filters=lambda query: query.is_("embedding_status", "null")
     )
-    return response.data[0].embedding
 
-def update_user_profile_status(user_id: str) -> None:
+def get_existing_ids(table: str, column: str, ids: List[str]) -> Set[str]:
     """
-    Update the profile completion status.
+    Return which of the given ids exist in a table column.
     """
-    try:
-        supabase.table("profiles") \
-            .update({"profile_complete": True}) \
-            .eq("id", user_id) \
+    with metrics.stage("fetch", items=len(ids), table=table):
+        response = supabase.table(table) \
+            .select(column) \
+            .in_(column, ids) \
             .execute()
-        print(f"Updated profile completion status for user {user_id}")
-    except Exception as e:
-        print(f"Error updating profile status for user {user_id}: {str(e)}")
+    return {row[column] for row in response.data}
+
+def process_survey_page(surveys: List[Dict], embedding_writes: SupabaseUpsertBuffer,
+                        status_writes: SupabaseUpdateBuffer,
+                        profile_writes: SupabaseUpdateBuffer) -> List[Dict]:
+    """
+    Embed one page of pending surveys and queue their writes.
+    """
+    user_ids = [survey["user_id"] for survey in surveys]
+    
+    # Get existing embeddings to avoid duplicates
+    existing_user_ids = get_existing_ids("user_embeddings", "user_id", user_ids)
+    
+    # Get valid users from the profiles table
+    valid_user_ids = get_existing_ids("profiles", "id", user_ids)
+    
+    results = []
+    pending_texts = {}
+    
+    for survey in surveys:
+        # Skip if user doesn't exist in profiles table
+        if survey["user_id"] not in valid_user_ids:
+            metrics.log_sampled(logger, "survey_without_profile",
+                                f"User {survey['user_id']} not found in profiles table, skipping...")
+            status_writes.add({
+                "user_id": survey["user_id"],
+                "embedding_status": "error",
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            })
+            continue
+        
+        # Skip if embedding already exists
+        if survey["user_id"] in existing_user_ids:
+            metrics.log_sampled(logger, "embedding_exists",
+                                f"Embedding already exists for user {survey['user_id']}, skipping...")
+            # Mark as completed since embedding exists
+            status_writes.add({"user_id": survey["user_id"], "embedding_status": "completed"})
+            continue
+            
+        if not survey["responses"]:
+            metrics.log_sampled(logger, "survey_empty", f"No responses found for user {survey['user_id']}, skipping...")
+            # Mark as error since no responses found
+            status_writes.add({"user_id": survey["user_id"], "embedding_status": "error"})
+            continue
+        
+        try:
+            # Format survey responses into natural language
+            pending_texts[survey["user_id"]] = format_survey(survey["responses"])
+        except Exception as e:
+            logger.error(f"Error formatting survey for user {survey['user_id']}: {str(e)}")
+            status_writes.add({
+                "user_id": survey["user_id"],
+                "embedding_status": "error",
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            })
+    
+    # Generate embeddings for the page in batches
+    rows, failures = embed_for_models(embedding_batchers, pending_texts)
+    
+    # Store embeddings in user_embeddings table
+    for row in rows:
+        embedding_writes.add(row)
+    embedding_writes.flush()
+    failed_writes = embedding_writes.failed_keys()
+    
+    failed = 0
+    for user_id in pending_texts:
+        if user_id in failures or user_id in failed_writes:
+            error = failures.get(user_id, "failed to store embedding")
+            metrics.log_sampled(logger, "embedding_failed", f"Error processing survey for user {user_id}: {error}")
+            failed += 1
+            # Update status to error
+            status_writes.add({
+                "user_id": user_id,
+                "embedding_status": "error",
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            })
+            continue
+        
+        # Update profile completion status and mark survey as completed
+        profile_writes.add({"id": user_id, "profile_complete": True})
+        status_writes.add({"user_id": user_id, "embedding_status": "completed"})
+        results.append({"user_id": user_id})
+    
+    if failed:
+        logger.error(f"Failed to embed or store {failed} of {len(pending_texts)} surveys in this page")
+    return results
 
 def generate_embeddings() -> List[Dict]:
     """
     Main function to generate embeddings for users who completed the survey.
+    
+    Pending surveys are streamed a page at a time, so memory stays flat no
+    matter how many are waiting. Returns the ids of the users whose
+    embeddings were stored.
     """
     try:
-        # Get survey responses that don't have an embedding status yet
-        query = supabase.table("survey_responses") \
-            .select("user_id, responses") \
-            .is_("embedding_status", "null") \
-            .execute()
-        
-        if not query.data:
-            print("No new surveys found to process")
-            return []
-
-        # Get existing embeddings to avoid duplicates
-        embeddings_query = supabase.table("user_embeddings") \
-            .select("user_id") \
-            .execute()
-        existing_user_ids = [emb["user_id"] for emb in embeddings_query.data]
-        
-        # Get valid users from the profiles table
-        profiles_query = supabase.table("profiles") \
-            .select("id") \
-            .execute()
-        valid_user_ids = [profile["id"] for profile in profiles_query.data]
+        # Writes are buffered and flushed as chunked bulk requests
+        buffer_options = {
+            "chunk_size": WRITE_CHUNK_SIZE,
+            "flush_interval": WRITE_FLUSH_INTERVAL
+        }
+        embedding_writes = SupabaseUpsertBuffer(supabase, "user_embeddings", on_conflict="user_id,model",
+                                                on_written=snapshot_writes, **buffer_options)
+        status_writes = SupabaseUpdateBuffer(supabase, "survey_responses", **buffer_options)
+        profile_writes = SupabaseUpdateBuffer(supabase, "profiles", key_column="id", **buffer_options)
         
         results = []
+        surveys_seen = 0
         
-        for survey in query.data:
-            # Skip if user doesn't exist in profiles table
-            if survey["user_id"] not in valid_user_ids:
-                print(f"User {survey['user_id']} not found in profiles table, skipping...")
-                supabase.table("survey_responses") \
-                    .update({
-                        "embedding_status": "error",
-                        "updated_at": "NOW()"
-                    }) \
-                    .eq("user_id", survey["user_id"]) \
-                    .execute()
-                continue
-            
-            # Skip if embedding already exists
-            if survey["user_id"] in existing_user_ids:
-                print(f"Embedding already exists for user {survey['user_id']}, skipping...")
-                # Mark as completed since embedding exists
-                supabase.table("survey_responses") \
-                    .update({"embedding_status": "completed"}) \
-                    .eq("user_id", survey["user_id"]) \
-                    .execute()
-                continue
-                
-            if not survey["responses"]:
-                print(f"No responses found for user {survey['user_id']}, skipping...")
-                # Mark as error since no responses found
-                supabase.table("survey_responses") \
-                    .update({"embedding_status": "error"}) \
-                    .eq("user_id", survey["user_id"]) \
-                    .execute()
-                continue
-            
-            try:
-                # Format survey responses into natural language
-                text = format_survey_responses(survey["responses"])
-                
-                # Generate embedding
-                embedding = get_embedding(text)
-                
-                # Store embedding in user_embeddings table
-                supabase.table("user_embeddings") \
-                    .upsert({
-                        "user_id": survey["user_id"],
-                        "embedding": embedding,
-                        "updated_at": "NOW()"
-                    }) \
-                    .execute()
-                
-                # Update profile completion status
-                update_user_profile_status(survey["user_id"])
-                
-                # Mark survey as completed
-                supabase.table("survey_responses") \
-                    .update({"embedding_status": "completed"}) \
-                    .eq("user_id", survey["user_id"]) \
-                    .execute()
+        for surveys in iter_pending_surveys():
+            surveys_seen += len(surveys)
+            with metrics.span("survey_page", surveys=len(surveys)):
+                results.extend(process_survey_page(surveys, embedding_writes, status_writes, profile_writes))
                 
-                # Add to results
-                results.append({
-                    "user_id": survey["user_id"],
-                    "embedding": embedding
-                })
-                
-                print(f"Successfully processed survey and generated embedding for user {survey['user_id']}")
-                
-            except Exception as e:
-                print(f"Error processing survey for user {survey['user_id']}: {str(e)}")
-                # Update status to error
-                supabase.table("survey_responses") \
-                    .update({
-                        "embedding_status": "error",
-                        "updated_at": "NOW()"
-                    }) \
-                    .eq("user_id", survey["user_id"]) \
-                    .execute()
+                for writes in (profile_writes, status_writes):
+                    for chunk in writes.flush():
+                        if not chunk.ok:
+                            logger.error(f"Failed to update {chunk.target} for {len(chunk.failed_keys)} users: {chunk.error}")
+        
+        if not surveys_seen:
+            logger.info("No new surveys found to process")
+            return []
         
+        logger.info(f"Successfully processed surveys and generated embeddings for {len(results)} users")
         return results
     
     except Exception as e:
-        print(f"Error in generate_embeddings: {str(e)}")
+        logger.error(f"Error in generate_embeddings: {str(e)}")
         return []
 
+def process_claimed_jobs(queue: JobQueue, worker_id: str, batch_size: int = SURVEY_PAGE_SIZE) -> int:
+    """
+    Claim one batch of embedding jobs, process it and report each outcome to the queue.
+    
+    Returns the number of jobs claimed, so callers can stop once the queue is drained.
+    """
+    jobs = queue.claim(worker_id, batch_size)
+    if not jobs:
+        return 0
+    
+    valid_user_ids = get_existing_ids("profiles", "id", [job.user_id for job in jobs])
+    pending = {}
+    texts = {}
+    for job in jobs:
+        if job.user_id not in valid_user_ids:
+            queue.fail(worker_id, job, "user not found in profiles table", retryable=False)
+        elif not job.responses:
+            queue.fail(worker_id, job, "no survey responses", retryable=False)
+        else:
+            try:
+                texts[job.user_id] = format_survey(job.responses)
+                pending[job.user_id] = job
+            except Exception as e:
+                queue.fail(worker_id, job, f"error formatting survey: {str(e)}", retryable=False)
+    
+    rows, failures = embed_for_models(embedding_batchers, texts)
+    writes = SupabaseUpsertBuffer(supabase, "user_embeddings", on_conflict="user_id,model",
+                                  chunk_size=WRITE_CHUNK_SIZE, on_written=snapshot_writes)
+    failed_writes = {key for chunk in writes.write(rows) for key in chunk.failed_keys}
+    
+    completed = []
+    for user_id, job in pending.items():
+        if user_id in failures or user_id in failed_writes:
+            queue.fail(worker_id, job, failures.get(user_id, "failed to store embedding"))
+        else:
+            completed.append(user_id)
+    
+    SupabaseUpdateBuffer(supabase, "profiles", key_column="id", chunk_size=WRITE_CHUNK_SIZE) \
+        .write([{"id": user_id, "profile_complete": True} for user_id in completed])
+    queue.complete(worker_id, completed)
+    logger.info(f"Worker {worker_id} completed {len(completed)} of {len(jobs)} claimed jobs")
+    return len(jobs)
+
+def sync_local_queue(queue: JobQueue) -> int:
+    """
+    Copy Supabase's pending surveys into a local SQLite queue; a no-op for other queues.
+    
+    Jobs the local queue already finished have their status written back
+    to `survey_responses`, so they stop showing up as pending. Returns the
+    number of surveys still waiting in the local queue.
+    """
+    if not isinstance(queue, SQLiteJobQueue):
+        return 0
+    waiting = 0
+    with SupabaseUpdateBuffer(supabase, "survey_responses", chunk_size=WRITE_CHUNK_SIZE) as status_writes:
+        for surveys in iter_pending_surveys():
+            for survey in surveys:
+                if survey["responses"]:
+                    queue.enqueue(survey["user_id"], survey["responses"])
+            statuses = queue.statuses([survey["user_id"] for survey in surveys])
+            for survey in surveys:
+                status = statuses.get(survey["user_id"])
+                if status in (COMPLETED, DEAD):
+                    status_writes.add({"user_id": survey["user_id"], "embedding_status": status})
+                else:
+                    waiting += 1
+    return waiting
+
+def run_embedding_worker(queue: JobQueue, worker_id: str = None, batch_size: int = SURVEY_PAGE_SIZE) -> None:
+    """
+    Process claimed batches until no more jobs can be claimed.
+    
+    Several workers can run this at once, in any number of processes or
+    hosts (on one host only with the SQLite queue).
+    """
+    worker_id = worker_id or default_worker_id()
+    sync_local_queue(queue)
+    while process_claimed_jobs(queue, worker_id, batch_size):
+        pass
+
+def iter_stale_embeddings(page_size: int = SURVEY_PAGE_SIZE) -> Iterator[List[Dict]]:
+    """
+    Stream pages of embeddings built with an older survey text format.
+    """
+    return iter_keyset_pages(
+        supabase, "user_embeddings", "user_id",
+        page_size=page_size,
+        apply_filters=lambda query: query
+            .eq("model", EMBEDDING_MODELS[0])
+            .or_(f"format_version.is.null,format_version.lt.{FORMAT_VERSION}")
+    )
+
+def reembed_stale_formats(page_size: int = SURVEY_PAGE_SIZE) -> int:
+    """
+    Re-embed only the users whose embedding predates the current FORMAT_VERSION.
+    
+    Stale rows are handled a page at a time: their surveys are fetched in
+    one query, formatted, embedded in batches and upserted in chunks.
+    Returns the number of embeddings replaced.
+    """
+    writes = SupabaseUpsertBuffer(supabase, "user_embeddings", on_conflict="user_id,model",
+                                  chunk_size=WRITE_CHUNK_SIZE, on_written=snapshot_writes)
+    total = 0
+    for page in iter_stale_embeddings(page_size):
+        surveys = supabase.table("survey_responses") \
+            .select("user_id, responses") \
+            .in_("user_id", [row["user_id"] for row in page]) \
+            .execute().data
+        texts = {survey["user_id"]: format_survey(survey["responses"]) for survey in surveys if survey.get("responses")}
+        
+        rows, failures = embed_for_models(embedding_batchers, texts)
+        for user_id, error in failures.items():
+            metrics.log_sampled(logger, "reembed_failed", f"Error re-embedding survey for user {user_id}: {error}")
+        if failures:
+            logger.error(f"Failed to re-embed {len(failures)} of {len(texts)} stale surveys in this page")
+        
+        failed = {key for chunk in writes.write(rows) for key in chunk.failed_keys}
+        # A user is only re-embedded once every model's row for them is stored
+        replaced = len(set(texts) - set(failures) - failed)
+        total += replaced
+        logger.info(f"Re-embedded {replaced} of {len(page)} stale embeddings")
+    return total
+
+def main():
+    init_clients()
+    if os.getenv("EMBEDDING_QUEUE", "").lower() == "true":
+        logger.info("Starting embedding worker...")
+        run_embedding_worker(queue_from_env(supabase), os.getenv("EMBEDDING_WORKER_ID"))
+    else:
+        logger.info("Starting embedding generation...")
+        embeddings = generate_embeddings()
+        logger.info(f"Generated and stored embeddings for {len(embeddings)} users")
+    if os.getenv("EMBEDDING_REEMBED_STALE", "").lower() == "true":
+        logger.info(f"Re-embedding surveys formatted before version {FORMAT_VERSION}...")
+        logger.info(f"Re-embedded {reembed_stale_formats()} users")
+    export_metrics()
+
 if __name__ == "__main__":
-    print("Starting embedding generation...")
-    embeddings = generate_embeddings()
-    print(f"Generated and stored embeddings for {len(embeddings)} users")
+    main()
@@ -0,0 +1,152 @@
+import os
+import logging
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from embedding_batcher import EmbeddingBatcher
+from survey_format import FORMAT_VERSION
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = 'text-embedding-3-small'
+# Embeddings written before vectors were tagged; their model is unknown
+LEGACY_MODEL = 'legacy'
+
+# embedding_migrations.status values
+RUNNING = 'running'
+BACKFILLED = 'backfilled'
+COMPLETED = 'completed'
+
+
+def configured_model() -> str:
+    """The model the embedding pipelines are configured to write with."""
+    return os.getenv('EMBEDDING_MODEL', DEFAULT_MODEL)
+
+
+def active_model(supabase) -> str:
+    """
+    The model the match job reads, from the `embedding_settings` table.
+
+    Switching models is a single-row update there, so every match run sees
+    either the old model's vectors or the new one's, never a mix.
+    """
+    try:
+        rows = supabase.table('embedding_settings') \
+            .select('value') \
+            .eq('key', 'active_model') \
+            .execute().data
+        if rows and rows[0].get('value'):
+            return rows[0]['value']
+    except Exception as e:
+        logger.error(f"Error reading the active embedding model: {str(e)}")
+    return configured_model()
+
+
+def set_active_model(supabase, model: str) -> None:
+    supabase.table('embedding_settings').upsert({
+        'key': 'active_model',
+        'value': model,
+        'updated_at': datetime.now(timezone.utc).isoformat()
+    }).execute()
+    logger.info(f"Active embedding model is now {model}")
+
+
+def migration_targets(supabase) -> List[str]:
+    """Models that an unfinished migration is re-embedding the corpus into."""
+    try:
+        rows = supabase.table('embedding_migrations') \
+            .select('target_model') \
+            .in_('status', [RUNNING, BACKFILLED]) \
+            .execute().data
+        return [row['target_model'] for row in rows]
+    except Exception as e:
+        logger.error(f"Error reading embedding migrations: {str(e)}")
+        return []
+
+
+def write_models(supabase, configured: Optional[str] = None) -> List[str]:
+    """
+    Every model new embeddings must be written with, primary first.
+
+    That is the active model, the configured model and the target of any
+    running migration, so a switch never leaves users without a vector in
+    the model being read. While the untagged legacy set is still active,
+    new users keep getting a legacy vector too (see `api_model`), so the
+    match job sees them before the first migration switches models.
+    """
+    models = [active_model(supabase), configured or configured_model()] + migration_targets(supabase)
+    unique = []
+    for model in models:
+        if model not in unique:
+            unique.append(model)
+    return unique
+
+
+def api_model(model: str) -> str:
+    """The OpenAI model vectors for a model tag are made with; new legacy vectors use the configured model."""
+    return configured_model() if model == LEGACY_MODEL else model
+
+
+def model_batchers(models: List[str], make_batcher: Callable[[str], EmbeddingBatcher]) -> Dict[str, EmbeddingBatcher]:
+    """
+    A batcher for each model tag, built by `make_batcher(api_model)`.
+
+    Tags made with the same OpenAI model share one batcher, so
+    `embed_for_models` embeds each text once for both of them.
+    """
+    built: Dict[str, EmbeddingBatcher] = {}
+    batchers = {}
+    for model in models:
+        name = api_model(model)
+        if name not in built:
+            built[name] = make_batcher(name)
+        batchers[model] = built[name]
+    return batchers
+
+
+def pinecone_namespace(model: str, prefix: Optional[str] = None) -> Optional[str]:
+    """Pinecone namespace holding a model's vectors; legacy vectors stay where they were."""
+    if model == LEGACY_MODEL:
+        return prefix
+    return f"{prefix}-{model}" if prefix else model
+
+
+def embedding_row(user_id: str, embedding: List[float], model: str) -> Dict:
+    """Build the `user_embeddings` row for an embedding, tagged with its model and dimensions."""
+    return {
+        'user_id': user_id,
+        'model': model,
+        'dimensions': len(embedding),
+        'embedding': embedding,
+        'format_version': FORMAT_VERSION,
+        'updated_at': datetime.now(timezone.utc).isoformat()
+    }
+
+
+def embed_for_models(batchers: Dict[str, EmbeddingBatcher], texts: Dict[str, str]) -> Tuple[List[Dict], Dict[str, str]]:
+    """
+    Embed texts with every model in `batchers` and build their rows.
+
+    The first batcher is the primary model and its failures are returned.
+    The other models only embed what the primary managed to; a user missing
+    a secondary vector is picked up by the migration's catch-up pass.
+    """
+    rows: List[Dict] = []
+    failures: Dict[str, str] = {}
+    # Tags sharing a batcher (see model_batchers) reuse its results
+    results: Dict[int, Tuple[Dict[str, List[float]], Dict[str, str]]] = {}
+    for i, (model, batcher) in enumerate(batchers.items()):
+        if id(batcher) not in results:
+            results[id(batcher)] = batcher.embed(texts)
+        embeddings, model_failures = results[id(batcher)]
+        embeddings = {user_id: embeddings[user_id] for user_id in texts if user_id in embeddings}
+        if i == 0:
+            failures = model_failures
+            texts = {user_id: texts[user_id] for user_id in embeddings}
+        else:
+            for user_id, error in model_failures.items():
+                if user_id not in texts:
+                    continue
+                logger.warning(f"Error embedding user {user_id} with {model}: {error}")
+        rows.extend(embedding_row(user_id, embedding, model) for user_id, embedding in embeddings.items())
+    return rows, failures
@@ -1,11 +1,19 @@
 import os
 import logging
-from datetime import datetime, timezone
-from typing import Dict, Any
 
-import openai
+from typing import Dict, Optional
+
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from supabase import Client
+
+import clients
+from embedding_batcher import EmbeddingBatcher
+from embedding_cache import cache_from_env
+from embedding_models import embed_for_models, model_batchers, write_models
+from metrics import export_metrics, metrics
+from survey_format import format_survey
+from vector_snapshot import snapshot_writer_from_env
+from write_buffer import SupabaseUpsertBuffer
 
 # Configure logging
 logging.basicConfig(
@@ -19,35 +27,43 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv('VITE_OPENAI_API_KEY')
 SUPABASE_URL = os.getenv('VITE_SUPABASE_URL')
 SUPABASE_SERVICE_ROLE_KEY = os.getenv('VITE_SUPABASE_SERVICE_ROLE_KEY')
+WRITE_CHUNK_SIZE = int(os.getenv('WRITE_CHUNK_SIZE', '500'))
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', '5'))
+
 
-if not all([OPENAI_API_KEY, SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY]):
-    raise ValueError("Missing required environment variables. Please check your .env file.")
+def init_clients(supabase_client: Optional[Client] = None, openai_client=None) -> None:
+    """
+    Set up the module's clients and one batcher per model being written, the primary model first.
 
-# Initialize clients
-openai.api_key = OPENAI_API_KEY
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+    They are built from the environment unless given.
+    """
+    global supabase, embedding_batchers, embedding_batcher
+    if supabase_client is None and not all([OPENAI_API_KEY, SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY]):
+        raise ValueError("Missing required environment variables. Please check your .env file.")
+    supabase = supabase_client if supabase_client is not None else \
+        clients.supabase_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+    embedding_batchers = model_batchers(
+        write_models(supabase),
+        lambda model: EmbeddingBatcher(clients.embed_fn(model, openai_client), cache=cache_from_env(model))
+    )
+    embedding_batcher = next(iter(embedding_batchers.values()))
 
-def format_responses_to_text(responses: Dict[str, Any]) -> str:
-    """Format JSON responses into a plain text string."""
-    formatted_text = []
-    for question, answer in responses.items():
-        formatted_text.append(f"question: {question}\nanswer: {answer}")
-    return "\n\n".join(formatted_text)
+# Set by init_clients(), called from main()
+supabase: Optional[Client] = None
+embedding_batchers: Dict[str, EmbeddingBatcher] = {}
+embedding_batcher: Optional[EmbeddingBatcher] = None
 
 def generate_embedding(text: str) -> list[float]:
     """Generate embedding using OpenAI's API."""
-    response = openai.embeddings.create(
-        model="text-embedding-3-small",
-        input=text,
-        encoding_format="float"
-    )
-    return response.data[0].embedding
+    return embedding_batcher.embed_texts([text])[0]
 
 def process_users():
     """Process users who don't have embeddings."""
     try:
         # Fetch users without embeddings
-        response = supabase.rpc('get_users_without_embeddings').execute()
+        with metrics.stage('fetch', items=0, table='get_users_without_embeddings') as stage:
+            response = supabase.rpc('get_users_without_embeddings').execute()
+            stage['items'] = len(response.data)
         users = response.data
 
         if not users:
@@ -56,36 +72,45 @@ def process_users():
 
         logger.info(f"Found {len(users)} users without embeddings.")
 
+        # Format responses to text
+        texts = {}
         for user in users:
             try:
-                user_id = user['user_id']
-                responses = user['responses']
-                
-                logger.info(f"Processing user: {user_id}")
-                
-                # Format responses to text
-                text = format_responses_to_text(responses)
-                
-                # Generate embedding
-                embedding = generate_embedding(text)
-                
-                # Store embedding in database
-                supabase.table('user_embeddings').upsert({
-                    'user_id': user_id,
-                    'embedding': embedding,
-                    'updated_at': datetime.now(timezone.utc).isoformat()
-                }).execute()
-                
-                logger.info(f"Successfully processed user: {user_id}")
-                
+                texts[user['user_id']] = format_survey(user['responses'])
             except Exception as e:
-                logger.error(f"Error processing user {user_id}: {str(e)}")
-                continue
+                logger.error(f"Error formatting responses for user {user['user_id']}: {str(e)}")
+
+        # Generate embeddings in batches
+        rows, failures = embed_for_models(embedding_batchers, texts)
+        for user_id, error in failures.items():
+            logger.error(f"Error generating embedding for user {user_id}: {error}")
+
+        # Store embeddings in database with chunked bulk upserts
+        writes = SupabaseUpsertBuffer(
+            supabase, 'user_embeddings',
+            on_conflict='user_id,model',
+            chunk_size=WRITE_CHUNK_SIZE,
+            flush_interval=WRITE_FLUSH_INTERVAL,
+            on_written=snapshot_writer_from_env()
+        )
+        for row in rows:
+            writes.add(row)
+        writes.flush()
+
+        failed = writes.failed_keys()
+        for user_id in failed:
+            logger.error(f"Error storing embedding for user {user_id}")
+        logger.info(f"Successfully processed {len(set(texts) - set(failures) - failed)} users")
 
     except Exception as e:
         logger.error(f"Error fetching users: {str(e)}")
 
-if __name__ == "__main__":
+def main():
+    init_clients()
     logger.info("Starting embedding generation process...")
     process_users()
-    logger.info("Embedding generation process completed.") 
\ No newline at end of file
+    logger.info("Embedding generation process completed.")
+    export_metrics()
+
+if __name__ == "__main__":
+    main() 
\ No newline at end of file
@@ -1,140 +1,516 @@
 import os
 import json
+import uuid
 import logging
-from typing import List, Dict, Optional
-from datetime import datetime, timezone
+from typing import Collection, Dict, List, Optional, Set, Tuple
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from pinecone import Pinecone
-from supabase import create_client, Client
+from supabase import Client
+
+import numpy as np
+
+import clients
+from assignment import assign_roommates
+from embedding_models import active_model, pinecone_namespace
+from match_cards import MatchCards
+from match_engine import DEFAULT_ANN_THRESHOLD, DEFAULT_RERANK_FACTOR, MatchEngine
+from match_writer import MatchWriter
+from metrics import export_metrics, metrics
+from parallel_matching import SHARD_BY_ROWS, SHARD_BY_UNIVERSITY, ParallelMatcher
+from scoring import CompatibilityScorer, StructuredProfiles
+from vector_loader import DEFAULT_PAGE_SIZE, EmbeddingSet, VectorLoader, iter_keyset_pages, parse_timestamp
+from vector_snapshot import snapshot_from_env, snapshot_overlap_since
+from write_buffer import SupabaseUpsertBuffer
 
 logging.basicConfig(level=logging.INFO,
                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 class MatchGenerator:
-    def __init__(self):
+    def __init__(self, supabase: Optional[Client] = None, pinecone_index=None):
+        """Clients are built from the environment unless given."""
         load_dotenv()
         self.pinecone_api_key = os.getenv('PINECONE_API_KEY')
         self.pinecone_index = os.getenv('PINECONE_INDEX')
         self.supabase_url = os.getenv('SUPABASE_URL')
         self.supabase_key = os.getenv('SUPABASE_KEY')
+        # 'local' computes matches in-process, 'pinecone' queries the index per user
+        self.match_engine = os.getenv('MATCH_ENGINE', 'local')
+        self.partition_by_university = os.getenv('MATCH_PARTITION_BY_UNIVERSITY', 'false').lower() == 'true'
+        self.ann_threshold = int(os.getenv('MATCH_ANN_THRESHOLD', str(DEFAULT_ANN_THRESHOLD)))
+        self.top_k = 5
+        # 'float16' or 'int8' searches a quantized copy of the vectors and re-ranks in float32
+        self.quantization = os.getenv('MATCH_QUANTIZATION') or None
+        self.rerank_factor = int(os.getenv('MATCH_RERANK_FACTOR', str(DEFAULT_RERANK_FACTOR)))
+        # Hybrid scoring adds hard filters and structured penalties from the survey answers
+        self.hybrid_scoring = os.getenv('MATCH_HYBRID_SCORING', 'false').lower() == 'true'
+        # Assignment mode also pairs every user with one mutual roommate
+        self.assign_roommates = os.getenv('MATCH_ASSIGN_ROOMMATES', 'false').lower() == 'true'
+        # Incremental runs only rematch users whose embeddings changed since the last run
+        self.incremental = os.getenv('MATCH_INCREMENTAL', 'false').lower() == 'true'
+        self.state_path = os.getenv('MATCH_STATE_PATH', '.match_state.json')
+        self.page_size = int(os.getenv('MATCH_PAGE_SIZE', str(DEFAULT_PAGE_SIZE)))
+        self.write_chunk_size = int(os.getenv('WRITE_CHUNK_SIZE', '500'))
+        # Worker processes for local matching; smaller query sets aren't worth starting them for
+        self.match_workers = int(os.getenv('MATCH_WORKERS', '1'))
+        self.parallel_min_users = int(os.getenv('MATCH_PARALLEL_MIN_USERS', '10000'))
+        # 'rows' or 'university' (the default when partitioning by university)
+        self.shard_by = os.getenv('MATCH_SHARD_BY') or None
+        self.shared_dir = os.getenv('MATCH_SHARED_DIR') or None
+        # Check the local engine against Pinecone for a sample of users after each local run
+        self.verify_sample = int(os.getenv('MATCH_VERIFY_SAMPLE', '0'))
+        self.verify_min_recall = float(os.getenv('MATCH_VERIFY_MIN_RECALL', '0.9'))
 
         # Initialize clients
-        self.supabase: Client = create_client(self.supabase_url, self.supabase_key)
-        self.pinecone_client = Pinecone(api_key=self.pinecone_api_key)
-        self.index = self.pinecone_client.Index(name=self.pinecone_index)
+        self.supabase: Client = supabase if supabase is not None else \
+            clients.supabase_client(self.supabase_url, self.supabase_key)
+        if pinecone_index is None:
+            pinecone_index = clients.pinecone_index(self.pinecone_index, self.pinecone_api_key)
+        self.index = pinecone_index
+        # Denormalized cards the Matches page reads, written alongside the matches
+        self.match_cards = MatchCards(self.supabase, self.write_chunk_size)
+        # Only vectors from the active model are matched; see model_migration.py
+        self.embedding_model = active_model(self.supabase)
+        self.pinecone_namespace = pinecone_namespace(self.embedding_model, os.getenv('PINECONE_NAMESPACE'))
+        logging.info(f"Matching on {self.embedding_model} embeddings")
+        self.vector_loader = VectorLoader(self.supabase, page_size=self.page_size, model=self.embedding_model)
+        # Local memory-mapped copy of the embeddings; only changes since it was written are fetched
+        self.snapshot = snapshot_from_env(self.embedding_model)
+        self.snapshot_overlap = float(os.getenv('MATCH_SNAPSHOT_OVERLAP', '300'))
+        # Users dropped from the embeddings by the last load, whose listers need rematching
+        self.deleted_ids: Set[str] = set()
+        # Users whose new matches failed to write in the last run, retried by the next one
+        self.failed_ids: Set[str] = set()
+        # Each user's written match count and lowest match score, kept in the match state
+        self.match_floors: Dict[str, List] = {}
+        # The match state last read or written, and its file's mtime
+        self._state: Optional[Tuple[int, Dict]] = None
 
-    def get_users_without_matches(self) -> List[Dict]:
-        """Get users who need matches generated."""
-        try:
-            # Get users with embeddings but no matches
-            response = self.supabase.table('user_embeddings').select(
-                "*"
-            ).execute()
-            
-            users_with_embeddings = response.data
-            logging.info(f"Found {len(users_with_embeddings)} users with embeddings")
-            return users_with_embeddings
-            
-        except Exception as e:
-            logging.error(f"Error getting users without matches: {str(e)}")
-            return []
+    def refresh_active_model(self) -> bool:
+        """Pick up a switch of the active embedding model; return whether it changed."""
+        model = active_model(self.supabase)
+        if model == self.embedding_model:
+            return False
+        logging.info(f"Active embedding model switched from {self.embedding_model} to {model}")
+        self.embedding_model = model
+        self.pinecone_namespace = pinecone_namespace(model, os.getenv('PINECONE_NAMESPACE'))
+        self.vector_loader.model = model
+        self.snapshot = snapshot_from_env(model)
+        return True
 
-    def get_user_embedding(self, user_id: str) -> Optional[List[float]]:
-        """Get a user's embedding from Supabase."""
+    def load_snapshot(self) -> EmbeddingSet:
+        """
+        Open the local vector snapshot after bringing it up to date with Supabase.
+
+        The first run seeds the snapshot with a full load. Later runs fetch
+        only rows updated since a little before the snapshot's watermark,
+        which also picks up writes the embedding pipelines didn't append,
+        and the ids still in `user_embeddings`: deleted users are compacted
+        out of the snapshot and recorded in `deleted_ids`, so the users who
+        listed them get rematched. With MATCH_QUANTIZATION set, a run that
+        appended also compacts, so matching scans the snapshot's memory-mapped
+        codes and re-ranks from its mapped float32 rows instead of merging
+        segments into memory.
+        """
+        self.deleted_ids = set()
+        watermark = self.snapshot.watermark
+        if watermark is None:
+            embeddings = self.vector_loader.load()
+            self.snapshot.append(embeddings.ids, embeddings.vectors, embeddings.updated_at)
+            self.snapshot.compact()
+            return self.snapshot.load()
+
+        embeddings = self.snapshot.load()
+        delta = self.vector_loader.load(snapshot_overlap_since(watermark, self.snapshot_overlap))
+        known = dict(zip(embeddings.ids, embeddings.updated_at))
+        stale = [i for i, user_id in enumerate(delta.ids) if known.get(user_id) != delta.updated_at[i]]
+        deleted = set(embeddings.ids) - self.embedding_ids()
+        compact = deleted or len(self.snapshot.segments) >= self.snapshot.compact_after
+        # Quantized matching wants a single segment with its codes mapped alongside
+        unmapped = self.snapshot.quantization and embeddings.quantized is None
+        if not stale and not compact and not unmapped:
+            return embeddings
+        compact = compact or self.snapshot.quantization
+        self.snapshot.append([delta.ids[i] for i in stale], delta.vectors[stale], [delta.updated_at[i] for i in stale])
+        if compact:
+            if deleted:
+                logging.info(f"Dropping {len(deleted)} deleted users from the vector snapshot")
+            self.snapshot.wait_for_compaction()
+            self.snapshot.compact(deleted)
+        self.deleted_ids = deleted
+        # A compaction that lost a race with another keeps them on disk until the next run
+        return self.snapshot.load().without(deleted)
+
+    def embedding_ids(self) -> Set[str]:
+        """Ids of every user with an embedding from the active model."""
+        pages = iter_keyset_pages(
+            self.supabase, 'user_embeddings', 'user_id',
+            page_size=self.page_size,
+            apply_filters=lambda query: query.eq('model', self.embedding_model)
+        )
+        return {str(row['user_id']) for page in pages for row in page}
+
+    def load_embeddings(self) -> EmbeddingSet:
+        """Load every user's embedding into memory for the run."""
         try:
-            result = self.supabase.table('user_embeddings') \
-                .select('embedding') \
-                .eq('user_id', user_id) \
-                .execute()
-            
-            if result.data and len(result.data) > 0:
-                return result.data[0]['embedding']
-            return None
+            embeddings = self.load_snapshot() if self.snapshot is not None else self.vector_loader.load()
+            logging.info(f"Found {len(embeddings)} users with embeddings")
+            return embeddings
             
         except Exception as e:
-            logging.error(f"Error getting embedding for user {user_id}: {str(e)}")
-            return None
+            logging.error(f"Error loading embeddings: {str(e)}")
+            return EmbeddingSet([], np.empty((0, 0), dtype=np.float32), [])
 
-    def clear_existing_matches(self, user_ids: List[str]) -> bool:
-        """Clear existing matches for the given users."""
+    def get_user_universities(self) -> Dict[str, str]:
+        """Get each user's university from their profile."""
         try:
-            # Delete matches where user is either user1 or user2
-            self.supabase.table('matches') \
-                .delete() \
-                .in_('user_id', user_ids) \
-                .execute()
-            
-            logging.info(f"Cleared existing matches for {len(user_ids)} users")
-            
-            return True
-            
+            universities = {}
+            for page in iter_keyset_pages(self.supabase, 'profiles', 'id, university',
+                                          key='id', page_size=self.page_size):
+                for profile in page:
+                    if profile.get('university'):
+                        universities[str(profile['id'])] = profile['university']
+            return universities
         except Exception as e:
-            logging.error(f"Error clearing existing matches: {str(e)}")
-            return False
+            logging.error(f"Error getting user universities: {str(e)}")
+            return {}
+
+    def build_match_engine(self, embeddings: EmbeddingSet) -> MatchEngine:
+        """Load every embedding into an in-process match engine."""
+        partitions = None
+        if self.partition_by_university:
+            universities = self.get_user_universities()
+            partitions = [universities.get(user_id) for user_id in embeddings.ids]
+        scorer = None
+        if self.hybrid_scoring:
+            profiles = StructuredProfiles.load(self.supabase, embeddings.ids, self.page_size)
+            scorer = CompatibilityScorer(profiles)
+        engine = MatchEngine(
+            embeddings.ids,
+            embeddings.vectors,
+            partitions,
+            ann_threshold=self.ann_threshold,
+            copy=False,
+            normalized=embeddings.normalized,
+            scorer=scorer,
+            quantization=self.quantization,
+            rerank_factor=self.rerank_factor,
+            quantized=embeddings.quantized if self.quantization else None
+        )
+        logging.info(f"Loaded {len(engine.ids)} embeddings into the match engine")
+        return engine
+
+    def verify_against_pinecone(self, engine: MatchEngine, sample_size: int = 50) -> float:
+        """Compare the local engine's matches with Pinecone's for a sample of users and return the recall."""
+        sample = engine.ids[:sample_size]
+        local = engine.matches(self.top_k - 1, [engine.index_of[user_id] for user_id in sample])
+        hits = total = 0
+        for user_id in sample:
+            query_response = self.index.query(
+                vector=engine.matrix[engine.index_of[user_id]].tolist(),
+                top_k=self.top_k,
+                namespace=self.pinecone_namespace
+            )
+            expected = {match.id for match in query_response.matches if match.id != user_id}
+            hits += len(expected & {match_id for match_id, _ in local[user_id]})
+            total += len(expected)
+        recall = hits / total if total else 1.0
+        logging.info(f"Local engine matched {recall:.1%} of Pinecone's top-{self.top_k} for {len(sample)} users")
+        return recall
+
+    def verify_engine(self, engine: MatchEngine) -> None:
+        """Warn when the local engine's matches drift from Pinecone's for MATCH_VERIFY_SAMPLE users."""
+        if engine.partitions is not None or engine.scorer is not None:
+            # Pinecone knows nothing about university partitions or hybrid scoring
+            logging.info("Skipping Pinecone verification: the local engine is partitioned or rescored")
+            return
+        recall = self.verify_against_pinecone(engine, self.verify_sample)
+        if recall < self.verify_min_recall:
+            logging.warning(
+                f"Local engine recall against Pinecone is {recall:.1%}, below MATCH_VERIFY_MIN_RECALL "
+                f"{self.verify_min_recall:.0%}; check that both hold the same {self.embedding_model} embeddings"
+            )
 
-    def save_match(self, user_id: str, match_id: str, match_score: float) -> bool:
-        """Save a match to the database."""
+    def load_watermark(self) -> Optional[Tuple[datetime, Dict[str, str], Set[str]]]:
+        """
+        Load the newest embedding timestamp covered by the last successful run.
+
+        Also returns the `updated_at` of every user matched within the
+        overlap window before it, so rows committed late with an older
+        timestamp can be told apart from ones already matched, and the
+        users whose matches failed to write, who still need a rematch.
+        Every user's match count and lowest score are loaded into
+        `match_floors`. A run on a different embedding model doesn't count,
+        since every score changes when the model does.
+        """
         try:
-            # Insert the match
-            self.supabase.table('matches').insert({
-                'user_id': user_id,
-                'match_id': match_id,
-                'match_score': match_score,
-                'created_at': datetime.now(timezone.utc).isoformat()
-            }).execute()
-            
-            logging.info(f"Saved match between users {user_id} and {match_id}")
-            
-            return True
-            
+            mtime = os.stat(self.state_path).st_mtime_ns
+            # The state is only re-read when another process wrote it
+            if self._state is None or self._state[0] != mtime:
+                with open(self.state_path) as f:
+                    self._state = mtime, json.load(f)
+            state = self._state[1]
+            if state.get('model', self.embedding_model) != self.embedding_model:
+                logging.info(f"Last match run used {state['model']} embeddings")
+                return None
+            if 'floors' not in state:
+                logging.info("Last match run didn't record users' lowest match scores")
+                return None
+            self.match_floors = state['floors']
+            return parse_timestamp(state['watermark']), state.get('recent', {}), set(state.get('retry', []))
+        except FileNotFoundError:
+            return None
         except Exception as e:
-            logging.error(f"Error saving match: {str(e)}")
-            return False
+            logging.error(f"Error loading match state from {self.state_path}: {str(e)}")
+            return None
+
+    def save_watermark(self, embeddings: EmbeddingSet, failed: Collection[str] = ()) -> None:
+        """
+        Record the newest embedding timestamp among the users just matched, and who was matched near it.
+
+        The `failed` users, whose matches didn't get written, are recorded
+        for the next incremental run to retry, along with `match_floors`.
+        """
+        timestamps = [(parse_timestamp(updated_at), user_id, updated_at)
+                      for user_id, updated_at in zip(embeddings.ids, embeddings.updated_at) if updated_at]
+        if not timestamps:
+            return
+        watermark = max(timestamps)[0]
+        since = watermark - timedelta(seconds=self.snapshot_overlap)
+        recent = {user_id: updated_at for parsed, user_id, updated_at in timestamps if parsed > since}
+        retry = sorted(set(failed).intersection(embeddings.ids))
+        if retry:
+            logging.warning(f"Recording {len(retry)} users whose matches failed to write for a retry")
+        for user_id in self.match_floors.keys() - set(embeddings.ids):
+            del self.match_floors[user_id]
+        state = {'watermark': watermark.isoformat(), 'model': self.embedding_model,
+                 'recent': recent, 'retry': retry, 'floors': self.match_floors}
+        with open(self.state_path, 'w') as f:
+            json.dump(state, f)
+        self._state = os.stat(self.state_path).st_mtime_ns, state
+
+    def get_listing_users(self, match_ids: Collection[str]) -> Set[str]:
+        """Ids of the users whose current matches include any of the given users."""
+        match_ids = sorted(match_ids)
+        listing = set()
+        for start in range(0, len(match_ids), self.write_chunk_size):
+            chunk = match_ids[start:start + self.write_chunk_size]
+            # Only the user ids are needed, so keyset paging on user_id may skip a user's other rows
+            pages = iter_keyset_pages(
+                self.supabase, 'matches', 'user_id',
+                page_size=self.page_size,
+                apply_filters=lambda query: query.in_('match_id', chunk)
+            )
+            listing.update(str(row['user_id']) for page in pages for row in page)
+        return listing
+
+    def record_floors(self, writer: MatchWriter, full: bool = False) -> None:
+        """Update `match_floors` with the match sets a writer replaced, starting afresh for a `full` run."""
+        if full:
+            self.match_floors = {}
+        for user_id, matches in writer.replaced.items():
+            self.match_floors[user_id] = [len(matches), min((score for _, score in matches), default=None)]
+
+    def find_affected_users(self, engine: MatchEngine, changed_rows: np.ndarray,
+                            removed: Collection[str] = ()) -> np.ndarray:
+        """
+        Find unchanged users whose top-k lists the changed embeddings would alter.
+
+        That is anyone who currently lists a changed or `removed` user (their
+        score moved or they are gone), anyone with a short list, and anyone
+        for whom some changed embedding now scores above the weakest match
+        on their list. Only the rows listing changed users are read from
+        `matches`; list lengths and weakest scores come from `match_floors`.
+        """
+        k = self.top_k - 1
+        listing = self.get_listing_users({engine.ids[row] for row in changed_rows} | set(removed))
+        unchanged_rows = np.setdiff1d(np.arange(len(engine.ids)), changed_rows)
+        thresholds = np.full(len(unchanged_rows), -np.inf, dtype=np.float32)
+        forced = np.ones(len(unchanged_rows), dtype=bool)
+        for i, row in enumerate(unchanged_rows):
+            user_id = engine.ids[row]
+            floor = self.match_floors.get(user_id)
+            if floor is None:
+                continue
+            count, lowest = floor
+            forced[i] = count < k or user_id in listing
+            if lowest is not None:
+                thresholds[i] = lowest
+        best = engine.best_scores(unchanged_rows, changed_rows)
+        return unchanged_rows[forced | (best > thresholds)]
+
+    def generate_incremental_matches(self, embeddings: EmbeddingSet, removed: Collection[str] = ()) -> MatchEngine:
+        """
+        Rematch only new or changed users and the existing users they displace; return the engine used.
+
+        `removed` are users dropped from the embeddings since the last run;
+        whoever listed them is rematched too, as is anyone whose matches
+        failed to write last time.
+        """
+        state = self.load_watermark()
+        if state is None:
+            logging.info("No previous match run recorded, running a full rematch")
+            engine = self.generate_local_matches(embeddings)
+            self.save_watermark(embeddings, self.failed_ids)
+            return engine
+
+        watermark, recent, retry = state
+        # Reach back over the overlap window for rows committed after the last run with older timestamps
+        since = watermark - timedelta(seconds=self.snapshot_overlap)
+        engine = self.build_match_engine(embeddings)
+        # Engine rows line up with the embedding set
+        changed_rows = np.array([
+            row
+            for row, (user_id, updated_at) in enumerate(zip(embeddings.ids, embeddings.updated_at))
+            if not updated_at or (parse_timestamp(updated_at) > since and recent.get(user_id) != updated_at)
+        ], dtype=np.int64)
+        retry_rows = np.array([row for row, user_id in enumerate(embeddings.ids) if user_id in retry], dtype=np.int64)
+        if not len(changed_rows) and not removed and not len(retry_rows):
+            logging.info(f"No embeddings changed since {watermark.isoformat()}")
+            return engine
+
+        affected_rows = self.find_affected_users(engine, changed_rows, removed)
+        rows = np.union1d(np.concatenate([changed_rows, affected_rows]), retry_rows)
+        logging.info(f"Rematching {len(changed_rows)} changed and {len(affected_rows)} affected users, "
+                     f"and {len(retry_rows)} whose matches failed to write last time")
+
+        self.generate_local_matches(embeddings, engine, rows)
+        self.save_watermark(embeddings, self.failed_ids)
+        return engine
+
+    def compute_matches(self, engine: MatchEngine, rows: Optional[np.ndarray] = None):
+        """Top matches for the given engine rows, spread over MATCH_WORKERS processes for large query sets."""
+        count = len(rows) if rows is not None else len(engine.ids)
+        if self.match_workers <= 1 or count < max(self.parallel_min_users, 1):
+            return engine.matches(self.top_k - 1, rows)
+        shard_by = self.shard_by or (SHARD_BY_UNIVERSITY if engine.partitions is not None else SHARD_BY_ROWS)
+        with ParallelMatcher(engine, self.match_workers, shard_by, self.shared_dir) as matcher:
+            return matcher.matches(self.top_k - 1, rows)
+
+    def generate_local_matches(self, embeddings: EmbeddingSet, engine: Optional[MatchEngine] = None,
+                               rows: Optional[np.ndarray] = None) -> MatchEngine:
+        """Generate matches for users (or the given engine rows) with the in-process match engine; return the engine."""
+        if engine is None:
+            engine = self.build_match_engine(embeddings)
+        # Pinecone's top-k includes the user themselves, so it yields top_k - 1 matches
+        with metrics.stage('query', items=len(rows) if rows is not None else len(engine.ids)):
+            results = self.compute_matches(engine, rows)
+        writer = MatchWriter(self.supabase, self.write_chunk_size, cards=self.match_cards)
+        for user_id, matches in results.items():
+            writer.stage(user_id, matches)
+        writer.commit()
+        self.failed_ids = writer.failed
+        self.record_floors(writer, full=rows is None)
+        logging.info("Match generation completed successfully")
+        return engine
+
+    def generate_assignments(self, embeddings: EmbeddingSet, engine: Optional[MatchEngine] = None):
+        """
+        Pair users into mutual roommate assignments and store both directions of each pair.
+
+        Like MatchWriter, the pairs are upserted on user_id tagged with a
+        run_id and then rows from earlier runs are deleted, so users who
+        are now unpaired or gone lose their old pair. When some upserts
+        failed, only the users written by this run have their rows replaced.
+        See sql/roommate_pairs.sql.
+        """
+        if engine is None:
+            engine = self.build_match_engine(embeddings)
+        pairs, unpaired = assign_roommates(engine)
+        run_id = str(uuid.uuid4())
+        now = datetime.now(timezone.utc).isoformat()
+
+        writes = SupabaseUpsertBuffer(self.supabase, 'roommate_pairs', on_conflict='user_id',
+                                      chunk_size=self.write_chunk_size)
+        rows = [
+            {'user_id': user_id, 'roommate_id': roommate_id, 'match_score': score,
+             'run_id': run_id, 'created_at': now}
+            for a, b, score in pairs
+            for user_id, roommate_id in ((a, b), (b, a))
+        ]
+        failed = {key for result in writes.write(rows) for key in result.failed_keys}
+        stale = f'run_id.is.null,run_id.neq.{run_id}'
+        if not failed:
+            with metrics.stage('supabase_write', items=0, target='roommate_pairs'):
+                self.supabase.table('roommate_pairs').delete().or_(stale).execute()
+        else:
+            logging.error(f"Kept previous roommate pairs for {len(failed)} users whose new pairs failed to write")
+            replaced = [user_id for user_id in engine.ids if user_id not in failed]
+            for start in range(0, len(replaced), self.write_chunk_size):
+                chunk = replaced[start:start + self.write_chunk_size]
+                with metrics.stage('supabase_write', items=len(chunk), target='roommate_pairs'):
+                    self.supabase.table('roommate_pairs') \
+                        .delete() \
+                        .in_('user_id', chunk) \
+                        .or_(stale) \
+                        .execute()
+        logging.info(f"Assigned {len(pairs)} roommate pairs, {len(unpaired)} users unpaired (run {run_id})")
+
+    def generate_pinecone_matches(self, embeddings: EmbeddingSet):
+        """Generate matches for users by querying Pinecone once per user."""
+        writer = MatchWriter(self.supabase, self.write_chunk_size, cards=self.match_cards)
+        failed_queries = set()
+        for user_id, embedding in zip(embeddings.ids, embeddings.vectors):
+            try:
+                # Query Pinecone for similar vectors
+                with metrics.stage('query', span=False):
+                    query_response = self.index.query(
+                        vector=embedding.tolist(),
+                        top_k=5,
+                        include_metadata=True,
+                        namespace=self.pinecone_namespace
+                    )
+                
+                # Stage matches; users whose query fails keep their previous matches
+                writer.stage(user_id, [
+                    (match.id, float(match.score))
+                    for match in query_response.matches
+                    if match.id != str(user_id)  # Don't match with self
+                ])
+                
+                metrics.log_sampled(logger, 'user_matched', f"Generated matches for user {user_id}")
+                
+            except Exception as e:
+                logging.error(f"Error generating matches for user {user_id}: {str(e)}")
+                failed_queries.add(str(user_id))
+                continue
+                
+        writer.commit()
+        self.failed_ids = writer.failed | failed_queries
+        self.record_floors(writer, full=True)
+        self.save_watermark(embeddings, self.failed_ids)
+        logging.info("Match generation completed successfully")
 
     def generate_matches(self):
         """Generate matches for users."""
         try:
-            users = self.get_users_without_matches()
+            embeddings = self.load_embeddings()
             
-            if not users:
+            if not len(embeddings):
                 logging.info("No users found to generate matches for")
                 return
             
-            user_ids = [user['user_id'] for user in users]
-            self.clear_existing_matches(user_ids)
+            if self.incremental and self.match_engine != 'local':
+                logging.warning("Incremental matching requires MATCH_ENGINE=local, running a full rematch")
             
-            for user in users:
-                try:
-                    user_id = user['user_id']
-                    embedding = self.get_user_embedding(user_id)
-                    
-                    if not embedding:
-                        logging.warning(f"No embedding found for user {user_id}")
-                        continue
-                    
-                    # Query Pinecone for similar vectors
-                    query_response = self.index.query(
-                        vector=embedding,
-                        top_k=5,
-                        include_metadata=True
-                    )
-                    
-                    # Process and save matches
-                    for match in query_response.matches:
-                        if match.id != str(user_id):  # Don't match with self
-                            self.save_match(
-                                user_id=user_id,
-                                match_id=match.id,
-                                match_score=float(match.score)
-                            )
-                    
-                    logging.info(f"Generated matches for user {user_id}")
-                    
-                except Exception as e:
-                    logging.error(f"Error generating matches for user {user_id}: {str(e)}")
-                    continue
-                    
-            logging.info("Match generation completed successfully")
+            # The assignment reuses the local engine rather than building another
+            engine = None
+            if self.incremental and self.match_engine == 'local':
+                engine = self.generate_incremental_matches(embeddings, self.deleted_ids)
+            elif self.match_engine == 'local':
+                engine = self.generate_local_matches(embeddings)
+                self.save_watermark(embeddings, self.failed_ids)
+            else:
+                self.generate_pinecone_matches(embeddings)
+            
+            if self.verify_sample and engine is not None:
+                self.verify_engine(engine)
+
+            if self.assign_roommates:
+                self.generate_assignments(embeddings, engine)
+
+            # Cards showing users whose profile changed since they were written
+            self.match_cards.refresh_queued()
             
         except Exception as e:
             logging.error(f"Error in generate_matches: {str(e)}")
@@ -146,6 +522,8 @@ def main():
         generator.generate_matches()
     except Exception as e:
         logging.error(f"Error in main: {str(e)}")
+    finally:
+        export_metrics()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
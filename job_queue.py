@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+# embedding_status values; a NULL status means the survey is waiting to be claimed
+CLAIMED = 'claimed'
+COMPLETED = 'completed'
+ERROR = 'error'
+DEAD = 'dead'
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF_SECONDS = 30.0
+
+
+@dataclass
+class Job:
+    """A claimed embedding job: one user's survey responses."""
+    user_id: str
+    responses: Dict
+    attempts: int
+
+
+def default_worker_id() -> str:
+    """Identify this worker by host and process id."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class JobQueue(ABC):
+    """
+    Claim/lease work queue over survey embedding jobs.
+
+    `claim` atomically hands a batch of jobs to one worker and leases them
+    for `lease_seconds`; a job whose worker dies without completing it can
+    be claimed again once the lease expires. Every claim counts as an
+    attempt. Failed jobs are retried with exponential backoff until they
+    reach `max_attempts`, after which they are dead-lettered. Only the
+    worker holding a job's lease can complete or fail it.
+    """
+
+    def __init__(self, lease_seconds: int = DEFAULT_LEASE_SECONDS, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 backoff_seconds: float = DEFAULT_BACKOFF_SECONDS):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+
+    def backoff(self, attempts: int) -> float:
+        """Seconds to wait before retrying a job that has failed `attempts` times."""
+        return self.backoff_seconds * (2 ** (attempts - 1))
+
+    @abstractmethod
+    def claim(self, worker_id: str, batch_size: int) -> List[Job]:
+        """Lease up to `batch_size` claimable jobs to the worker."""
+
+    @abstractmethod
+    def complete(self, worker_id: str, user_ids: List[str]) -> None:
+        """Mark the worker's leased jobs for these users as completed."""
+
+    @abstractmethod
+    def fail(self, worker_id: str, job: Job, error: str, retryable: bool = True) -> None:
+        """Schedule a retry of the worker's leased job, or dead-letter it when not retryable or out of attempts."""
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    Job queue in a local SQLite database.
+
+    A stand-in for the Postgres queue on a single host, selected with
+    EMBEDDING_QUEUE_BACKEND=sqlite (see `queue_from_env`). Jobs are copied
+    in from Supabase's pending surveys by
+    embedding_generator.sync_local_queue. Claims take SQLite's write lock,
+    so they are atomic across processes sharing the file.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS embedding_jobs (
+                user_id TEXT PRIMARY KEY,
+                responses TEXT NOT NULL,
+                embedding_status TEXT,
+                claimed_by TEXT,
+                lease_expires_at REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL,
+                last_error TEXT
+            )
+        ''')
+
+    def enqueue(self, user_id: str, responses: Dict) -> None:
+        """Add a job, or reset it when the user resubmitted different responses."""
+        with self._lock:
+            self._conn.execute('''
+                INSERT INTO embedding_jobs (user_id, responses) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    responses = excluded.responses, embedding_status = NULL, claimed_by = NULL,
+                    lease_expires_at = NULL, attempts = 0, next_attempt_at = NULL, last_error = NULL
+                WHERE embedding_jobs.responses != excluded.responses
+            ''', (user_id, json.dumps(responses, sort_keys=True)))
+
+    def statuses(self, user_ids: List[str]) -> Dict[str, str]:
+        """The status of each of the given users' jobs; pending jobs are left out."""
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT user_id, embedding_status FROM embedding_jobs '
+                f'WHERE embedding_status IS NOT NULL AND user_id IN ({", ".join("?" * len(user_ids))})',
+                user_ids
+            ).fetchall() if user_ids else []
+        return dict(rows)
+
+    def claim(self, worker_id: str, batch_size: int) -> List[Job]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Expired leases on jobs that have used up their attempts are dead-lettered
+                self._conn.execute('''
+                    UPDATE embedding_jobs SET embedding_status = ?, claimed_by = NULL
+                    WHERE embedding_status = ? AND lease_expires_at <= ? AND attempts >= ?
+                ''', (DEAD, CLAIMED, now, self.max_attempts))
+                rows = self._conn.execute('''
+                    SELECT user_id, responses, attempts FROM embedding_jobs
+                    WHERE embedding_status IS NULL
+                       OR (embedding_status = ? AND next_attempt_at <= ?)
+                       OR (embedding_status = ? AND lease_expires_at <= ?)
+                    ORDER BY user_id
+                    LIMIT ?
+                ''', (ERROR, now, CLAIMED, now, batch_size)).fetchall()
+                self._conn.executemany('''
+                    UPDATE embedding_jobs
+                    SET embedding_status = ?, claimed_by = ?, lease_expires_at = ?, attempts = attempts + 1
+                    WHERE user_id = ?
+                ''', [(CLAIMED, worker_id, now + self.lease_seconds, row[0]) for row in rows])
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return [Job(user_id, json.loads(responses), attempts + 1) for user_id, responses, attempts in rows]
+
+    def complete(self, worker_id: str, user_ids: List[str]) -> None:
+        with self._lock:
+            self._conn.executemany('''
+                UPDATE embedding_jobs SET embedding_status = ?, claimed_by = NULL, lease_expires_at = NULL
+                WHERE user_id = ? AND claimed_by = ?
+            ''', [(COMPLETED, user_id, worker_id) for user_id in user_ids])
+
+    def fail(self, worker_id: str, job: Job, error: str, retryable: bool = True) -> None:
+        dead = not retryable or job.attempts >= self.max_attempts
+        with self._lock:
+            self._conn.execute('''
+                UPDATE embedding_jobs
+                SET embedding_status = ?, claimed_by = NULL, lease_expires_at = NULL,
+                    next_attempt_at = ?, last_error = ?
+                WHERE user_id = ? AND claimed_by = ?
+            ''', (DEAD if dead else ERROR, None if dead else time.time() + self.backoff(job.attempts),
+                  error, job.user_id, worker_id))
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs in each state."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT COALESCE(embedding_status, \'pending\'), COUNT(*) FROM embedding_jobs GROUP BY 1'
+            ).fetchall()
+        return dict(rows)
+
+
+class SupabaseJobQueue(JobQueue):
+    """
+    Job queue over the `survey_responses` table.
+
+    Claims go through the `claim_embedding_jobs` RPC (see
+    sql/embedding_jobs.sql), which locks rows with FOR UPDATE SKIP LOCKED so
+    concurrent workers on any host never claim the same survey.
+    """
+
+    def __init__(self, supabase, **kwargs):
+        super().__init__(**kwargs)
+        self.supabase = supabase
+
+    def claim(self, worker_id: str, batch_size: int) -> List[Job]:
+        result = self.supabase.rpc('claim_embedding_jobs', {
+            'p_worker_id': worker_id,
+            'p_batch_size': batch_size,
+            'p_lease_seconds': self.lease_seconds,
+            'p_max_attempts': self.max_attempts
+        }).execute()
+        return [Job(row['user_id'], row['responses'], row['attempts']) for row in result.data]
+
+    def complete(self, worker_id: str, user_ids: List[str]) -> None:
+        if not user_ids:
+            return
+        self.supabase.table('survey_responses') \
+            .update({'embedding_status': COMPLETED, 'claimed_by': None, 'lease_expires_at': None}) \
+            .in_('user_id', user_ids) \
+            .eq('claimed_by', worker_id) \
+            .execute()
+
+    def fail(self, worker_id: str, job: Job, error: str, retryable: bool = True) -> None:
+        dead = not retryable or job.attempts >= self.max_attempts
+        next_attempt_at = None
+        if not dead:
+            next_attempt_at = (datetime.now(timezone.utc) + timedelta(seconds=self.backoff(job.attempts))).isoformat()
+        self.supabase.table('survey_responses') \
+            .update({
+                'embedding_status': DEAD if dead else ERROR,
+                'claimed_by': None,
+                'lease_expires_at': None,
+                'next_attempt_at': next_attempt_at,
+                'last_error': error
+            }) \
+            .eq('user_id', job.user_id) \
+            .eq('claimed_by', worker_id) \
+            .execute()
+
+
+def queue_from_env(supabase) -> JobQueue:
+    """
+    The job queue selected by EMBEDDING_QUEUE_BACKEND: 'supabase' (the
+    default) or 'sqlite', stored at EMBEDDING_QUEUE_PATH.
+    """
+    options = {
+        'lease_seconds': int(os.getenv('EMBEDDING_QUEUE_LEASE_SECONDS', str(DEFAULT_LEASE_SECONDS))),
+        'max_attempts': int(os.getenv('EMBEDDING_QUEUE_MAX_ATTEMPTS', str(DEFAULT_MAX_ATTEMPTS))),
+        'backoff_seconds': float(os.getenv('EMBEDDING_QUEUE_BACKOFF_SECONDS', str(DEFAULT_BACKOFF_SECONDS))),
+    }
+    backend = os.getenv('EMBEDDING_QUEUE_BACKEND', 'supabase')
+    if backend == 'sqlite':
+        return SQLiteJobQueue(os.getenv('EMBEDDING_QUEUE_PATH', '.embedding_jobs.sqlite'), **options)
+    if backend != 'supabase':
+        raise ValueError(f"Unknown EMBEDDING_QUEUE_BACKEND {backend!r}, expected 'supabase' or 'sqlite'")
+    return SupabaseJobQueue(supabase, **options)
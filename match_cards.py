@@ -0,0 +1,173 @@
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+from metrics import metrics
+from survey_format import CLEANLINESS_LABELS, SLEEP_TIME_LABELS
+from write_buffer import DEFAULT_CHUNK_SIZE, SupabaseUpsertBuffer
+
+logger = logging.getLogger(__name__)
+
+PROFILE_COLUMNS = 'id, full_name, university, profile_image_url'
+
+
+def match_percentage(score: float) -> int:
+    """A cosine match score as the whole percentage shown on a card."""
+    return int(round(min(max(score, 0.0), 1.0) * 100))
+
+
+def card_fields(profile: Dict, responses: Optional[Dict]) -> Dict:
+    """The profile and survey fields a match card shows."""
+    responses = responses or {}
+    interests = responses.get('hobbies') or []
+    return {
+        'name': profile.get('full_name') or responses.get('fullName') or None,
+        'university': profile.get('university') or None,
+        'sleep_habits': SLEEP_TIME_LABELS.get(responses.get('sleepTime'), responses.get('sleepTime')),
+        'cleanliness': CLEANLINESS_LABELS.get(responses.get('cleanliness'), responses.get('cleanliness')),
+        'interests': interests if isinstance(interests, list) else [interests],
+        'image_url': profile.get('profile_image_url') or None,
+    }
+
+
+class MatchCards:
+    """
+    The `match_cards` read model behind the Matches page.
+
+    One row per (user_id, match_id) holds the match's rank and percentage
+    and the matched user's card fields, so the page loads a user's cards
+    with a single indexed lookup instead of joining `matches`, `profiles`
+    and `survey_responses`. `write` is called by MatchWriter in the same
+    pass as the matches themselves; `refresh_queued` rewrites the cards
+    showing users whose profile or survey changed since (see
+    sql/match_cards.sql for the queue the triggers fill).
+    """
+
+    def __init__(self, supabase, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.supabase = supabase
+        self.chunk_size = chunk_size
+        self.writes = SupabaseUpsertBuffer(
+            supabase, 'match_cards',
+            on_conflict='user_id,match_id',
+            chunk_size=chunk_size
+        )
+
+    def _fetch(self, table: str, columns: str, key: str, keys: List[str]) -> List[Dict]:
+        rows = []
+        for start in range(0, len(keys), self.chunk_size):
+            with metrics.stage('fetch', items=0, table=table) as stage:
+                page = self.supabase.table(table) \
+                    .select(columns) \
+                    .in_(key, keys[start:start + self.chunk_size]) \
+                    .execute().data
+                stage['items'] = len(page)
+            rows.extend(page)
+        return rows
+
+    def _fetch_cards(self, match_ids: List[str]) -> List[Dict]:
+        """
+        Every card showing one of the given users.
+
+        A popular user shows up on many cards, so each chunk of users is
+        read in pages ordered by the card key; one unpaged request would be
+        cut off at PostgREST's max-rows without any error.
+        """
+        cards = []
+        for start in range(0, len(match_ids), self.chunk_size):
+            chunk = match_ids[start:start + self.chunk_size]
+            offset = 0
+            while True:
+                with metrics.stage('fetch', items=0, table='match_cards') as stage:
+                    page = self.supabase.table('match_cards') \
+                        .select('*') \
+                        .in_('match_id', chunk) \
+                        .order('user_id') \
+                        .order('match_id') \
+                        .range(offset, offset + self.chunk_size - 1) \
+                        .execute().data
+                    stage['items'] = len(page)
+                cards.extend(page)
+                if len(page) < self.chunk_size:
+                    break
+                offset += len(page)
+        return cards
+
+    def card_details(self, user_ids: List[str]) -> Dict[str, Dict]:
+        """Card fields for each of the given users, from their profile and survey."""
+        profiles = {str(row['id']): row for row in self._fetch('profiles', PROFILE_COLUMNS, 'id', user_ids)}
+        surveys = {
+            str(row['user_id']): row.get('responses')
+            for row in self._fetch('survey_responses', 'user_id, responses', 'user_id', user_ids)
+        }
+        return {user_id: card_fields(profiles.get(user_id, {}), surveys.get(user_id)) for user_id in user_ids}
+
+    def write(self, match_sets: Dict[str, List[Tuple[str, float]]], run_id: str) -> Set[str]:
+        """Upsert the cards for the given users' ranked match sets; return the users whose cards failed."""
+        match_ids = sorted({match_id for matches in match_sets.values() for match_id, _ in matches})
+        details = self.card_details(match_ids)
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [
+            {
+                'user_id': user_id,
+                'match_id': match_id,
+                'rank': rank,
+                'match_percentage': match_percentage(score),
+                **details[match_id],
+                'run_id': run_id,
+                'updated_at': now
+            }
+            for user_id, matches in match_sets.items()
+            for rank, (match_id, score) in enumerate(sorted(matches, key=lambda match: -match[1]), start=1)
+        ]
+        return {key for result in self.writes.write(rows) for key in result.failed_keys}
+
+    def delete_stale(self, user_ids: List[str], run_id: str) -> None:
+        """Delete the given users' cards that weren't written by this run."""
+        for start in range(0, len(user_ids), self.chunk_size):
+            chunk = user_ids[start:start + self.chunk_size]
+            with metrics.stage('supabase_write', items=len(chunk), target='match_cards'):
+                self.supabase.table('match_cards') \
+                    .delete() \
+                    .in_('user_id', chunk) \
+                    .or_(f'run_id.is.null,run_id.neq.{run_id}') \
+                    .execute()
+
+    def refresh_users(self, user_ids: List[str]) -> int:
+        """Rewrite every card showing one of the given users; return how many cards changed."""
+        if not user_ids:
+            return 0
+        cards = self._fetch_cards(user_ids)
+        if not cards:
+            return 0
+        details = self.card_details(sorted({str(card['match_id']) for card in cards}))
+        now = datetime.now(timezone.utc).isoformat()
+        self.writes.write([
+            {**card, **details[str(card['match_id'])], 'updated_at': now}
+            for card in cards
+        ])
+        return len(cards)
+
+    def refresh_queued(self) -> int:
+        """Refresh the cards of everyone in the `match_card_refresh` queue and dequeue them."""
+        total = 0
+        while True:
+            queued = self.supabase.table('match_card_refresh') \
+                .select('user_id, queued_at') \
+                .order('queued_at') \
+                .limit(self.chunk_size) \
+                .execute().data
+            if not queued:
+                break
+            user_ids = [str(row['user_id']) for row in queued]
+            total += self.refresh_users(user_ids)
+            # Users queued again while we refreshed have a later queued_at and stay queued
+            self.supabase.table('match_card_refresh') \
+                .delete() \
+                .in_('user_id', user_ids) \
+                .lte('queued_at', max(row['queued_at'] for row in queued)) \
+                .execute()
+            if len(queued) < self.chunk_size:
+                break
+        if total:
+            logger.info(f"Refreshed {total} match cards for changed profiles")
+        return total
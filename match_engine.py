@@ -0,0 +1,292 @@
+import json
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from quantization import QuantizedMatrix
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 1024
+# Above this many vectors the engine switches to the IVF index
+DEFAULT_ANN_THRESHOLD = 200_000
+# Quantized search shortlists this many candidates per wanted match for float32 re-ranking
+DEFAULT_RERANK_FACTOR = 4
+RERANK_CHUNK_SIZE = 64
+
+
+def parse_embedding(value) -> np.ndarray:
+    """Parse an embedding as returned by PostgREST (pgvector text or a JSON list)."""
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalize the rows of a float32 matrix in place."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def select_top_k(scores: np.ndarray, indices: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Keep the k best scores of each row, sorted in descending order.
+
+    `indices` holds the candidate index for every score and is either a row
+    vector shared by all rows or a matrix the same shape as `scores`.
+    """
+    indices = np.broadcast_to(indices, scores.shape)
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        indices = np.take_along_axis(indices, part, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    scores = np.take_along_axis(scores, order, axis=1)
+    indices = np.take_along_axis(indices, order, axis=1)
+    if scores.shape[1] < k:
+        pad = k - scores.shape[1]
+        scores = np.pad(scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+        indices = np.pad(indices, ((0, 0), (0, pad)), constant_values=-1)
+    indices = np.where(np.isneginf(scores), -1, indices)
+    return indices, scores
+
+
+class IVFIndex:
+    """Inverted-file ANN index: k-means lists over normalized vectors, probed at query time."""
+
+    def __init__(self, matrix: np.ndarray, nlist: Optional[int] = None, nprobe: int = 8,
+                 iterations: int = 10, seed: int = 0):
+        self.matrix = matrix
+        self.nlist = nlist or max(1, int(np.sqrt(len(matrix))))
+        self.nprobe = min(nprobe, self.nlist)
+        self.centroids = self._train(iterations, np.random.default_rng(seed))
+        assignments = self._assign(matrix)
+        self.lists = [np.flatnonzero(assignments == c) for c in range(self.nlist)]
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), DEFAULT_BLOCK_SIZE):
+            block = vectors[start:start + DEFAULT_BLOCK_SIZE]
+            assignments[start:start + len(block)] = np.argmax(block @ self.centroids.T, axis=1)
+        return assignments
+
+    def _train(self, iterations: int, rng) -> np.ndarray:
+        sample_size = min(len(self.matrix), self.nlist * 64)
+        sample = self.matrix[rng.choice(len(self.matrix), sample_size, replace=False)]
+        self.centroids = sample[rng.choice(sample_size, self.nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = self._assign(sample)
+            for c in range(self.nlist):
+                members = sample[assignments == c]
+                if len(members):
+                    self.centroids[c] = members.mean(axis=0)
+            normalize_rows(self.centroids)
+        return self.centroids
+
+    def __getstate__(self):
+        # The matrix is shared with worker processes separately, see parallel_matching.py
+        state = dict(self.__dict__)
+        state['matrix'] = None
+        return state
+
+    def probe(self, queries: np.ndarray) -> np.ndarray:
+        """Return the `nprobe` closest lists for each query."""
+        scores = queries @ self.centroids.T
+        if self.nprobe >= self.nlist:
+            return np.broadcast_to(np.arange(self.nlist), scores.shape)
+        return np.argpartition(-scores, self.nprobe - 1, axis=1)[:, :self.nprobe]
+
+
+class MatchEngine:
+    """
+    In-process top-k cosine matching over every user embedding.
+
+    Embeddings are held in one contiguous, L2-normalized float32 matrix so
+    cosine similarity is a plain dot product. Queries run in blocks of
+    `block_size` rows against the whole matrix (or against the IVF index
+    when there are at least `ann_threshold` vectors), excluding the query
+    user and, when partitions are given, anyone in a different partition.
+    An optional scorer rescores each block of candidates before top-k
+    selection, e.g. to apply hard filters and structured penalties.
+
+    With `quantization` set to 'float16' or 'int8', exact search scans a
+    compressed copy of the matrix instead, shortlists `rerank_factor * k`
+    candidates per query and re-ranks them against the float32 rows. Passing
+    `normalized=True` uses already-normalized vectors as they are, so the
+    float32 rows can stay in a read-only memory map and only the
+    shortlisted rows are ever paged in. `quantized` passes codes already
+    computed for those normalized vectors, such as the ones memory-mapped
+    from a vector snapshot, instead of quantizing them again in memory.
+    """
+
+    def __init__(
+        self,
+        ids: Sequence[str],
+        vectors: np.ndarray,
+        partitions: Optional[Sequence] = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        ann_threshold: Optional[int] = DEFAULT_ANN_THRESHOLD,
+        nprobe: int = 8,
+        copy: bool = True,
+        scorer=None,
+        normalized: bool = False,
+        quantization: Optional[str] = None,
+        rerank_factor: int = DEFAULT_RERANK_FACTOR,
+        quantized: Optional[QuantizedMatrix] = None
+    ):
+        self.ids = [str(user_id) for user_id in ids]
+        self.index_of = {user_id: i for i, user_id in enumerate(self.ids)}
+        if normalized:
+            self.matrix = vectors
+        else:
+            # With copy=False a float32 C-contiguous matrix is normalized in place
+            if copy:
+                vectors = np.array(vectors, dtype=np.float32, order='C')
+            else:
+                vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+            self.matrix = normalize_rows(vectors)
+        self.block_size = block_size
+        self.quantized = quantized
+        self.rerank_factor = rerank_factor
+        if quantized is not None:
+            logger.info(f"Using precomputed {quantized.kind} codes for {len(self.ids)} vectors")
+        elif quantization and len(self.ids):
+            self.quantized = QuantizedMatrix.from_float(self.matrix, quantization)
+            logger.info(
+                f"Quantized {len(self.ids)} vectors to {quantization} "
+                f"({self.quantized.nbytes / 1e6:.1f} MB, float32 is {len(self.ids) * self.matrix.shape[1] * 4 / 1e6:.1f} MB)"
+            )
+        # Optional object whose adjust(scores, rows, candidates) rescores blocks in place
+        self.scorer = scorer
+        self.partitions = None
+        if partitions is not None:
+            _, codes = np.unique(np.array([str(p) for p in partitions]), return_inverse=True)
+            self.partitions = codes
+        self.ivf = None
+        if ann_threshold is not None and len(self.ids) >= ann_threshold:
+            logger.info(f"Building IVF index over {len(self.ids)} vectors")
+            self.ivf = IVFIndex(self.matrix, nprobe=nprobe)
+
+    def _mask(self, scores: np.ndarray, rows: np.ndarray, candidates: np.ndarray) -> None:
+        """Exclude each query's own row and other partitions from its scores, then apply the scorer."""
+        if self.scorer is not None:
+            self.scorer.adjust(scores, rows, candidates)
+        scores[rows[:, None] == candidates[None, :]] = -np.inf
+        if self.partitions is not None:
+            scores[self.partitions[rows][:, None] != self.partitions[candidates][None, :]] = -np.inf
+
+    def _exact_block(self, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if self.quantized is not None:
+            return self._quantized_block(rows, k)
+        candidates = np.arange(len(self.ids))
+        scores = self.matrix[rows] @ self.matrix.T
+        self._mask(scores, rows, candidates)
+        return select_top_k(scores, candidates, k)
+
+    def _quantized_block(self, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Shortlist candidates on the quantized matrix, then re-rank them in float32."""
+        queries = np.asarray(self.matrix[rows], dtype=np.float32)
+        candidates = np.arange(len(self.ids))
+        scores = self.quantized.dot(queries)
+        self._mask(scores, rows, candidates)
+        shortlist, shortlist_scores = select_top_k(scores, candidates, k * self.rerank_factor)
+
+        # The masks and scorer adjustments are kept as the gap between the
+        # adjusted and raw quantized scores and carried over to the float32 score
+        safe = np.where(shortlist >= 0, shortlist, 0)
+        reranked = np.empty(shortlist.shape, dtype=np.float32)
+        for start in range(0, len(rows), RERANK_CHUNK_SIZE):
+            block = slice(start, start + RERANK_CHUNK_SIZE)
+            exact = np.einsum('bd,bmd->bm', queries[block], self.matrix[safe[block]])
+            approx = np.einsum('bd,bmd->bm', queries[block], self.quantized.dequantize(safe[block]))
+            reranked[block] = exact + (shortlist_scores[block] - approx)
+        reranked[shortlist < 0] = -np.inf
+        return select_top_k(reranked, shortlist, k)
+
+    def _ivf_block(self, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = self.matrix[rows]
+        probes = self.ivf.probe(queries)
+        best_scores = np.full((len(rows), k), -np.inf, dtype=np.float32)
+        best_indices = np.full((len(rows), k), -1, dtype=np.int64)
+        for c, members in enumerate(self.ivf.lists):
+            hit = np.flatnonzero((probes == c).any(axis=1))
+            if not len(hit) or not len(members):
+                continue
+            scores = queries[hit] @ self.matrix[members].T
+            self._mask(scores, rows[hit], members)
+            best_indices[hit], best_scores[hit] = select_top_k(
+                np.hstack([best_scores[hit], scores]),
+                np.hstack([best_indices[hit], np.broadcast_to(members, scores.shape)]),
+                k
+            )
+        return best_indices, best_scores
+
+    def top_k(self, k: int, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the indices and scores of the k best matches for each query row.
+
+        `rows` defaults to every user. Missing matches (fewer than k
+        candidates) are reported as index -1 with score -inf.
+        """
+        if rows is None:
+            rows = np.arange(len(self.ids))
+        rows = np.asarray(rows, dtype=np.int64)
+        indices = np.full((len(rows), k), -1, dtype=np.int64)
+        scores = np.full((len(rows), k), -np.inf, dtype=np.float32)
+        search = self._ivf_block if self.ivf is not None else self._exact_block
+        for start in range(0, len(rows), self.block_size):
+            block = rows[start:start + self.block_size]
+            indices[start:start + len(block)], scores[start:start + len(block)] = search(block, k)
+        return indices, scores
+
+    def top_k_among(self, k: int, rows: np.ndarray,
+                    candidates: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact top-k for each of `rows`, considering only `candidates` (default: `rows` themselves)."""
+        rows = np.asarray(rows, dtype=np.int64)
+        candidates = rows if candidates is None else np.asarray(candidates, dtype=np.int64)
+        indices = np.full((len(rows), k), -1, dtype=np.int64)
+        scores = np.full((len(rows), k), -np.inf, dtype=np.float32)
+        candidate_matrix = self.matrix[candidates]
+        for start in range(0, len(rows), self.block_size):
+            block = rows[start:start + self.block_size]
+            block_scores = self.matrix[block] @ candidate_matrix.T
+            self._mask(block_scores, block, candidates)
+            indices[start:start + len(block)], scores[start:start + len(block)] = \
+                select_top_k(block_scores, candidates, k)
+        return indices, scores
+
+    def best_scores(self, rows: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+        """Return each query row's highest score against the given candidate rows."""
+        rows = np.asarray(rows, dtype=np.int64)
+        candidates = np.asarray(candidates, dtype=np.int64)
+        best = np.full(len(rows), -np.inf, dtype=np.float32)
+        if not len(candidates):
+            return best
+        candidate_matrix = self.matrix[candidates]
+        for start in range(0, len(rows), self.block_size):
+            block = rows[start:start + self.block_size]
+            scores = self.matrix[block] @ candidate_matrix.T
+            self._mask(scores, block, candidates)
+            best[start:start + len(block)] = scores.max(axis=1)
+        return best
+
+    def matches(self, k: int, rows: Optional[np.ndarray] = None) -> Dict[str, List[Tuple[str, float]]]:
+        """Return the k best (match_id, score) pairs for each query user."""
+        if rows is None:
+            rows = np.arange(len(self.ids))
+        indices, scores = self.top_k(k, rows)
+        return self.results(rows, indices, scores)
+
+    def results(self, rows: np.ndarray, indices: np.ndarray, scores: np.ndarray) -> Dict[str, List[Tuple[str, float]]]:
+        """Map top-k rows, indices and scores to (match_id, score) lists by user id."""
+        results = {}
+        for row, row_indices, row_scores in zip(rows, indices, scores):
+            results[self.ids[row]] = [
+                (self.ids[i], float(score))
+                for i, score in zip(row_indices, row_scores)
+                if i >= 0
+            ]
+        return results
@@ -0,0 +1,89 @@
+import uuid
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from match_cards import MatchCards
+from metrics import metrics
+from write_buffer import DEFAULT_CHUNK_SIZE, SupabaseUpsertBuffer
+
+logger = logging.getLogger(__name__)
+
+
+class MatchWriter:
+    """
+    Replace users' match sets in the `matches` table without ever emptying it.
+
+    New matches are staged per user and written by `commit` in two passes:
+    chunked bulk upserts keyed on (user_id, match_id) that tag every row
+    with this run's `run_id`, then one delete per chunk of users for their
+    rows from earlier runs. Readers see either a user's old matches or
+    their new ones, never an empty list, and pairs that survive a rematch
+    are updated in place. Users whose upserts failed keep their old rows
+    and are listed in `failed` after the commit, so callers can retry them;
+    the match sets that were written are kept in `replaced`.
+    See sql/matches_run_id.sql for the constraint the upserts rely on.
+
+    With `cards`, the same pass also replaces the users' `match_cards`
+    read model the same way.
+    """
+
+    def __init__(self, supabase, chunk_size: int = DEFAULT_CHUNK_SIZE, run_id: Optional[str] = None,
+                 cards: Optional[MatchCards] = None):
+        self.supabase = supabase
+        self.chunk_size = chunk_size
+        self.run_id = run_id or str(uuid.uuid4())
+        self.cards = cards
+        self.writes = SupabaseUpsertBuffer(
+            supabase, 'matches',
+            on_conflict='user_id,match_id',
+            chunk_size=chunk_size
+        )
+        self.staged: Dict[str, List[Tuple[str, float]]] = {}
+        # Users whose matches or cards failed to write in the last commit
+        self.failed: Set[str] = set()
+        # Match sets the last commit wrote
+        self.replaced: Dict[str, List[Tuple[str, float]]] = {}
+
+    def stage(self, user_id: str, matches: Iterable[Tuple[str, float]]) -> None:
+        """Stage a user's complete new match set; an empty set clears their matches."""
+        self.staged[str(user_id)] = [(str(match_id), float(score)) for match_id, score in matches]
+
+    def delete_stale(self, user_ids: List[str]) -> None:
+        """Delete the given users' matches that weren't written by this run."""
+        for start in range(0, len(user_ids), self.chunk_size):
+            chunk = user_ids[start:start + self.chunk_size]
+            with metrics.stage('supabase_write', items=len(chunk), target='matches'):
+                self.supabase.table('matches') \
+                    .delete() \
+                    .in_('user_id', chunk) \
+                    .or_(f'run_id.is.null,run_id.neq.{self.run_id}') \
+                    .execute()
+
+    def commit(self) -> int:
+        """Write every staged match set and return how many users' matches were replaced."""
+        staged, self.staged = self.staged, {}
+        self.failed = set()
+        self.replaced = {}
+        if not staged:
+            return 0
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [
+            {'user_id': user_id, 'match_id': match_id, 'match_score': score,
+             'run_id': self.run_id, 'created_at': now}
+            for user_id, matches in staged.items()
+            for match_id, score in matches
+        ]
+        failed = {key for result in self.writes.write(rows) for key in result.failed_keys}
+        replaced = [user_id for user_id in staged if user_id not in failed]
+        self.delete_stale(replaced)
+        failed_cards: Set[str] = set()
+        if self.cards is not None:
+            failed_cards = self.cards.write({user_id: staged[user_id] for user_id in replaced}, self.run_id)
+            self.cards.delete_stale([user_id for user_id in replaced if user_id not in failed_cards], self.run_id)
+        self.failed = (failed | failed_cards) & staged.keys()
+        self.replaced = {user_id: staged[user_id] for user_id in replaced}
+        if failed:
+            logger.error(f"Kept previous matches for {len(failed)} users whose new matches failed to write")
+        logger.info(f"Replaced matches for {len(replaced)} users ({len(rows)} rows, run {self.run_id})")
+        return len(replaced)
@@ -0,0 +1,334 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+import itertools
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'roomnet'
+# Seconds; spans from a cache hit (~1 ms) up to a stalled API call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DEFAULT_SPAN_LIMIT = 1000
+DEFAULT_LOG_SAMPLE_EVERY = 1000
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(values: Dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in values.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = [(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in pairs]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram, as Prometheus exposes it."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by interpolating inside the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+
+class Metrics:
+    """
+    Counters, latency histograms and spans for one process.
+
+    `stage` times a pipeline stage (fetch, format, embed, supabase_write,
+    pinecone_write, query) and counts the items and errors it
+    saw. Stages and `span`s nest per thread, and the most recent
+    `span_limit` of them are kept with their attributes. Everything can be
+    exported as Prometheus text or as a JSON run summary.
+    """
+
+    def __init__(self, span_limit: int = DEFAULT_SPAN_LIMIT,
+                 log_sample_every: int = DEFAULT_LOG_SAMPLE_EVERY):
+        self.log_sample_every = log_sample_every
+        self.started_at = datetime.now(timezone.utc)
+        self._started = time.perf_counter()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._help: Dict[str, str] = {}
+        self._spans = deque(maxlen=span_limit)
+        self._span_ids = itertools.count(1)
+        self._active = threading.local()
+        self._lock = threading.Lock()
+
+    def reset(self) -> None:
+        """Drop everything recorded so far and restart the run clock."""
+        with self._lock:
+            self.started_at = datetime.now(timezone.utc)
+            self._started = time.perf_counter()
+            self._counters.clear()
+            self._histograms.clear()
+            self._spans.clear()
+
+    def describe(self, name: str, text: str) -> None:
+        """Set the HELP text of a metric."""
+        self._help[name] = text
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Add to a counter."""
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """Record a duration in a histogram."""
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(seconds)
+
+    def _stack(self) -> List[int]:
+        if not hasattr(self._active, 'stack'):
+            self._active.stack = []
+        return self._active.stack
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Dict]:
+        """
+        Time a block as a span nested under the current one.
+
+        Yields the span's attributes, so the block can add to them (e.g.
+        the number of tokens once a response arrives).
+        """
+        stack = self._stack()
+        span_id = next(self._span_ids)
+        parent_id = stack[-1] if stack else None
+        stack.append(span_id)
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attributes
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            self.observe('span_seconds', seconds, span=name)
+            record = {'id': span_id, 'parent_id': parent_id, 'name': name,
+                      'start': start - self._started, 'seconds': seconds, **attributes}
+            if error:
+                record['error'] = error
+            with self._lock:
+                self._spans.append(record)
+
+    @contextmanager
+    def stage(self, name: str, items: int = 1, span: bool = True, **attributes) -> Iterator[Dict]:
+        """
+        Time one pass through a pipeline stage covering `items` users or rows.
+
+        The block can correct `items` through the yielded attributes once it
+        knows, e.g. after a fetch returns. Per-user stages pass `span=False`
+        to skip the span record.
+        """
+        start = time.perf_counter()
+        recorded = {'items': items, **attributes}
+        try:
+            if span:
+                with self.span(name, **recorded) as recorded:
+                    yield recorded
+            else:
+                yield recorded
+        except Exception:
+            self.inc('stage_errors_total', stage=name)
+            raise
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=name)
+            self.inc('stage_items_total', recorded.get('items', 0), stage=name)
+
+    def log_sampled(self, log: logging.Logger, event: str, message: str) -> None:
+        """
+        Count a per-user event and log it at debug level for one in every `log_sample_every`.
+
+        Keeps big runs from writing a line per user while the counter still
+        sees every event.
+        """
+        key = _labels({'event': event})
+        with self._lock:
+            series = self._counters.setdefault('log_events_total', {})
+            count = series[key] = series.get(key, 0) + 1
+        if self.log_sample_every <= 1 or count % self.log_sample_every == 1:
+            log.debug(f"{message} ({event} #{int(count)})")
+
+    def counter(self, name: str, **labels) -> float:
+        """Current value of a counter."""
+        with self._lock:
+            return self._counters.get(name, {}).get(_labels(labels), 0)
+
+    def prometheus_text(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                full = f"{PREFIX}_{name}"
+                if name in self._help:
+                    lines.append(f"# HELP {full} {self._help[name]}")
+                lines.append(f"# TYPE {full} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{full}{_format_labels(labels)} {value:g}")
+            for name, series in sorted(self._histograms.items()):
+                full = f"{PREFIX}_{name}"
+                if name in self._help:
+                    lines.append(f"# HELP {full} {self._help[name]}")
+                lines.append(f"# TYPE {full} histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{full}_bucket{_format_labels(labels, ('le', f'{bound:g}'))} {cumulative}")
+                    lines.append(f"{full}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram.count}")
+                    lines.append(f"{full}_sum{_format_labels(labels)} {histogram.sum:.6f}")
+                    lines.append(f"{full}_count{_format_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> Dict:
+        """
+        A JSON-serializable summary of the run.
+
+        Stages are listed by total time, so the first one is where the run
+        spent most of its time.
+        """
+        def series_name(name: str, labels: Labels) -> str:
+            return name + _format_labels(labels)
+
+        with self._lock:
+            counters = {series_name(name, labels): value
+                        for name, series in self._counters.items() for labels, value in series.items()}
+            histograms = {
+                series_name(name, labels): {
+                    'count': histogram.count,
+                    'total_seconds': round(histogram.sum, 6),
+                    'p50_seconds': round(histogram.quantile(0.5), 6),
+                    'p99_seconds': round(histogram.quantile(0.99), 6),
+                    'max_seconds': round(histogram.max, 6),
+                }
+                for name, series in self._histograms.items() for labels, histogram in series.items()
+            }
+            stage_items = {dict(labels)['stage']: value
+                           for labels, value in self._counters.get('stage_items_total', {}).items()}
+            stages = sorted(
+                (
+                    {'stage': dict(labels)['stage'], 'items': stage_items.get(dict(labels)['stage'], 0),
+                     'calls': histogram.count, 'total_seconds': round(histogram.sum, 6)}
+                    for labels, histogram in self._histograms.get('stage_seconds', {}).items()
+                ),
+                key=lambda stage: -stage['total_seconds']
+            )
+            slowest = sorted(self._spans, key=lambda span: -span['seconds'])[:10]
+        return {
+            'started_at': self.started_at.isoformat(),
+            'duration_seconds': round(time.perf_counter() - self._started, 6),
+            'stages': stages,
+            'counters': counters,
+            'histograms': histograms,
+            'slowest_spans': slowest,
+        }
+
+    def write_prometheus(self, path: str) -> None:
+        """Write the Prometheus text to `path`, e.g. for node_exporter's textfile collector."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+    def write_summary(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def serve(self, port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+        """Serve `/metrics` from a background thread, for long-running workers."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+        logger.info(f"Serving metrics on port {port}")
+        return server
+
+
+metrics = Metrics(
+    span_limit=int(os.getenv('METRICS_SPAN_LIMIT', str(DEFAULT_SPAN_LIMIT))),
+    log_sample_every=int(os.getenv('METRICS_LOG_SAMPLE_EVERY', str(DEFAULT_LOG_SAMPLE_EVERY)))
+)
+metrics.describe('stage_seconds', 'Time spent in each pipeline stage')
+metrics.describe('stage_items_total', 'Users or rows handled by each pipeline stage')
+metrics.describe('stage_errors_total', 'Pipeline stage passes that raised')
+metrics.describe('span_seconds', 'Duration of traced spans such as one embedding batch')
+metrics.describe('embedding_requests_total', 'Embedding API requests sent')
+metrics.describe('embedding_retries_total', 'Embedding batches retried after a transient error')
+metrics.describe('embedding_tokens_total', 'Tokens billed by the embedding API')
+metrics.describe('embedding_estimated_tokens_total', 'Estimated tokens sent to the embedding API')
+metrics.describe('rate_limited_total', 'HTTP 429 responses from the embedding API')
+metrics.describe('write_failures_total', 'Rows that failed to write after the row-by-row retry')
+metrics.describe('log_events_total', 'Per-user events logged only by sampling')
+
+
+def export_metrics() -> None:
+    """Write the run's metrics to METRICS_SUMMARY_PATH (JSON) and METRICS_PROMETHEUS_PATH, if set."""
+    try:
+        summary_path = os.getenv('METRICS_SUMMARY_PATH')
+        if summary_path:
+            metrics.write_summary(summary_path)
+            logger.info(f"Wrote run summary to {summary_path}")
+        prometheus_path = os.getenv('METRICS_PROMETHEUS_PATH')
+        if prometheus_path:
+            metrics.write_prometheus(prometheus_path)
+            logger.info(f"Wrote Prometheus metrics to {prometheus_path}")
+    except Exception as e:
+        logger.error(f"Error exporting metrics: {str(e)}")
+    stages = metrics.summary()['stages']
+    if stages:
+        slowest = stages[0]
+        logger.info(f"Slowest stage: {slowest['stage']} ({slowest['total_seconds']:.2f}s over {slowest['calls']} calls)")
@@ -0,0 +1,264 @@
+import os
+import argparse
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+import clients
+from embedding_batcher import EmbeddingBatcher, openai_embed_fn
+from embedding_cache import cache_from_env
+from embedding_models import (
+    BACKFILLED, COMPLETED, RUNNING,
+    active_model, embedding_row, pinecone_namespace, set_active_model
+)
+from metrics import export_metrics
+from rate_limiter import RateLimiter, rate_limited
+from survey_format import format_survey
+from vector_loader import iter_keyset_pages, parse_timestamp
+from vector_snapshot import snapshot_writer_from_env
+from write_buffer import PineconeUpsertBuffer, SupabaseUpsertBuffer
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 500
+
+
+class ModelMigration:
+    """
+    Re-embed every user with a new model in the background, then switch the match job to it.
+
+    Users with a `source` vector are walked in user id order, a page at a
+    time, through a rate-limited batcher. The last user id of every page is
+    checkpointed in `embedding_migrations`, so an interrupted migration
+    resumes where it stopped. While the migration runs, the embedding
+    pipelines also write new surveys with the target model (see
+    `embedding_models.write_models`).
+
+    `switch` first re-embeds anyone whose target vector is missing or older
+    than their source vector. It then flips `embedding_settings.active_model`
+    in one update, and catches up once more on writes that raced the switch.
+    """
+
+    def __init__(
+        self,
+        supabase,
+        source: str,
+        target: str,
+        batcher: EmbeddingBatcher,
+        pinecone_index=None,
+        pinecone_prefix: Optional[str] = None,
+        page_size: int = DEFAULT_PAGE_SIZE
+    ):
+        self.supabase = supabase
+        self.source = source
+        self.target = target
+        self.batcher = batcher
+        self.page_size = page_size
+        self.writes = SupabaseUpsertBuffer(
+            supabase, 'user_embeddings',
+            on_conflict='user_id,model',
+            chunk_size=page_size,
+            on_written=snapshot_writer_from_env()
+        )
+        self.index_writes = None
+        if pinecone_index is not None:
+            self.index_writes = PineconeUpsertBuffer(
+                pinecone_index,
+                namespace=pinecone_namespace(target, pinecone_prefix),
+                chunk_size=page_size
+            )
+
+    def state(self) -> Optional[Dict]:
+        """The migration's row in `embedding_migrations`, if it was ever started."""
+        rows = self.supabase.table('embedding_migrations') \
+            .select('*') \
+            .eq('target_model', self.target) \
+            .execute().data
+        return rows[0] if rows else None
+
+    def _save_state(self, **values) -> None:
+        self.supabase.table('embedding_migrations') \
+            .update({**values, 'updated_at': datetime.now(timezone.utc).isoformat()}) \
+            .eq('target_model', self.target) \
+            .execute()
+
+    def start(self) -> Dict:
+        """Start the migration, or return the checkpoint of an unfinished one."""
+        state = self.state()
+        if state and state['status'] != COMPLETED:
+            if state['source_model'] != self.source:
+                raise ValueError(
+                    f"A migration to {self.target} from {state['source_model']} is already in progress"
+                )
+            logger.info(
+                f"Resuming migration to {self.target} after user {state['last_user_id']} "
+                f"({state['migrated']} users done)"
+            )
+            return state
+
+        now = datetime.now(timezone.utc).isoformat()
+        state = {
+            'target_model': self.target,
+            'source_model': self.source,
+            'status': RUNNING,
+            'last_user_id': None,
+            'migrated': 0,
+            'started_at': now,
+            'updated_at': now
+        }
+        self.supabase.table('embedding_migrations').upsert(state).execute()
+        logger.info(f"Started migrating embeddings from {self.source} to {self.target}")
+        return state
+
+    def reembed(self, user_ids: List[str]) -> int:
+        """Embed the given users' surveys with the target model and store them; return how many were stored."""
+        if not user_ids:
+            return 0
+        surveys = self.supabase.table('survey_responses') \
+            .select('user_id, responses') \
+            .in_('user_id', user_ids) \
+            .execute().data
+        texts = {str(survey['user_id']): format_survey(survey['responses'])
+                 for survey in surveys if survey.get('responses')}
+
+        embeddings, failures = self.batcher.embed(texts)
+        for user_id, error in failures.items():
+            logger.error(f"Error embedding user {user_id} with {self.target}: {error}")
+
+        rows = [embedding_row(user_id, embedding, self.target) for user_id, embedding in embeddings.items()]
+        failed = {key for chunk in self.writes.write(rows) for key in chunk.failed_keys}
+        stored = [row for row in rows if row['user_id'] not in failed]
+
+        if self.index_writes is not None and stored:
+            profiles = self.supabase.table('profiles') \
+                .select('id, university') \
+                .in_('id', [row['user_id'] for row in stored]) \
+                .execute().data
+            universities = {str(profile['id']): profile.get('university') for profile in profiles}
+            self.index_writes.write([
+                {
+                    'id': row['user_id'],
+                    'values': row['embedding'],
+                    'metadata': {'university_id': universities[row['user_id']]}
+                    if universities.get(row['user_id']) else {}
+                }
+                for row in stored
+            ])
+        return len(stored)
+
+    def backfill(self) -> int:
+        """Re-embed every user with a source vector, resuming from the last checkpoint."""
+        state = self.start()
+        if state['status'] == BACKFILLED:
+            return 0
+        migrated = state['migrated']
+        total = 0
+        pages = iter_keyset_pages(
+            self.supabase, 'user_embeddings', 'user_id',
+            page_size=self.page_size,
+            apply_filters=lambda query: query.eq('model', self.source),
+            start_after=state['last_user_id']
+        )
+        for page in pages:
+            stored = self.reembed([str(row['user_id']) for row in page])
+            migrated += stored
+            total += stored
+            self._save_state(last_user_id=page[-1]['user_id'], migrated=migrated)
+            logger.info(f"Migrated {migrated} users to {self.target} (checkpoint {page[-1]['user_id']})")
+        self._save_state(status=BACKFILLED)
+        logger.info(f"Backfill to {self.target} finished: {total} users re-embedded in this run")
+        return total
+
+    def _updated_at(self, model: str) -> Dict[str, datetime]:
+        updated_at = {}
+        # Rows without a timestamp count as the oldest possible
+        pages = iter_keyset_pages(
+            self.supabase, 'user_embeddings', 'user_id, updated_at',
+            page_size=self.page_size * 10,
+            apply_filters=lambda query: query.eq('model', model)
+        )
+        for page in pages:
+            for row in page:
+                value = row.get('updated_at')
+                updated_at[str(row['user_id'])] = parse_timestamp(value) if value else datetime.min.replace(tzinfo=timezone.utc)
+        return updated_at
+
+    def missing_users(self) -> List[str]:
+        """Users whose target vector is missing or older than their source vector."""
+        source = self._updated_at(self.source)
+        target = self._updated_at(self.target)
+        return sorted(user_id for user_id, updated_at in source.items()
+                      if user_id not in target or target[user_id] < updated_at)
+
+    def catch_up(self) -> int:
+        """Re-embed every user missing an up-to-date target vector."""
+        missing = self.missing_users()
+        stored = sum(self.reembed(missing[start:start + self.page_size])
+                     for start in range(0, len(missing), self.page_size))
+        if missing:
+            logger.info(f"Caught up {stored} of {len(missing)} users missing a {self.target} embedding")
+        return stored
+
+    def switch(self, max_missing: int = 0) -> None:
+        """Make the target the active model once (nearly) every user has a target vector."""
+        state = self.state()
+        if not state or state['status'] != BACKFILLED:
+            raise RuntimeError(f"The backfill to {self.target} has to finish before switching")
+        self.catch_up()
+        missing = self.missing_users()
+        if len(missing) > max_missing:
+            raise RuntimeError(f"{len(missing)} users still have no {self.target} embedding, not switching")
+        set_active_model(self.supabase, self.target)
+        self._save_state(status=COMPLETED)
+        self.catch_up()
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Re-embed all users with a new embedding model.")
+    parser.add_argument('--target', required=True, help="model to migrate to, e.g. text-embedding-3-large")
+    parser.add_argument('--source', help="model to migrate from (default: the active model)")
+    parser.add_argument('--switch', action='store_true', help="switch the match job over once backfilled")
+    parser.add_argument('--status', action='store_true', help="print the migration's progress and exit")
+    args = parser.parse_args()
+
+    supabase = clients.supabase_client()
+    # Give the migration its own slice of the OpenAI quota so live embedding isn't starved
+    limiter = RateLimiter(float(os.getenv('MIGRATION_RPM', '0')) or None,
+                          float(os.getenv('MIGRATION_TPM', '0')) or None)
+    batcher = EmbeddingBatcher(
+        rate_limited(openai_embed_fn(clients.openai_client(), args.target), limiter),
+        cache=cache_from_env(args.target)
+    )
+    index = None
+    if os.getenv('PINECONE_API_KEY') and os.getenv('PINECONE_INDEX'):
+        index = clients.pinecone_index()
+
+    migration = ModelMigration(
+        supabase,
+        args.source or active_model(supabase),
+        args.target,
+        batcher,
+        pinecone_index=index,
+        pinecone_prefix=os.getenv('PINECONE_NAMESPACE'),
+        page_size=int(os.getenv('MIGRATION_PAGE_SIZE', str(DEFAULT_PAGE_SIZE)))
+    )
+    if args.status:
+        logger.info(f"Migration state: {migration.state()}")
+        return
+    try:
+        migration.backfill()
+        if args.switch:
+            migration.switch(max_missing=int(os.getenv('MIGRATION_MAX_MISSING', '0')))
+    finally:
+        export_metrics()
+
+
+if __name__ == "__main__":
+    main()
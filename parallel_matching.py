@@ -0,0 +1,224 @@
+import os
+import mmap
+import shutil
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from match_engine import MatchEngine
+from quantization import QuantizedMatrix
+
+logger = logging.getLogger(__name__)
+
+SHARD_BY_ROWS = 'rows'
+SHARD_BY_UNIVERSITY = 'university'
+# Shards per worker; more, smaller shards even out uneven partitions
+SHARDS_PER_WORKER = 4
+# Rows copied at a time when writing a shared matrix
+COPY_CHUNK_SIZE = 8192
+# Each worker's BLAS gets an equal share of the cores so workers x threads doesn't oversubscribe them
+BLAS_THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+def share_array(array: np.ndarray, directory: str, name: str) -> Dict:
+    """
+    Describe a file `array` can be memory-mapped from.
+
+    A read-only memory map of a whole file region, such as a vector
+    snapshot segment, is shared as it is; anything else is written once
+    to `directory`.
+    """
+    if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.flags.c_contiguous:
+        return {'path': array.filename, 'offset': array.offset, 'shape': array.shape, 'dtype': array.dtype.str}
+    path = os.path.join(directory, f'{name}.npy')
+    copy = np.lib.format.open_memmap(path, mode='w+', dtype=array.dtype, shape=array.shape)
+    for start in range(0, len(array), COPY_CHUNK_SIZE):
+        copy[start:start + COPY_CHUNK_SIZE] = array[start:start + COPY_CHUNK_SIZE]
+    copy.flush()
+    return {'path': path, 'offset': copy.offset, 'shape': array.shape, 'dtype': array.dtype.str}
+
+
+def open_shared(spec: Dict) -> np.ndarray:
+    """Memory-map an array described by `share_array`, read-only."""
+    return np.memmap(spec['path'], dtype=np.dtype(spec['dtype']), mode='r',
+                     offset=spec['offset'], shape=tuple(spec['shape']))
+
+
+# The engine of a worker process, opened once by _init_worker
+_engine: Optional[MatchEngine] = None
+
+
+def _init_worker(spec: Dict) -> None:
+    global _engine
+    engine = MatchEngine(
+        range(spec['count']),
+        open_shared(spec['matrix']),
+        spec['partitions'],
+        block_size=spec['block_size'],
+        ann_threshold=None,
+        normalized=True,
+        scorer=spec['scorer'],
+        rerank_factor=spec['rerank_factor']
+    )
+    if spec['codes'] is not None:
+        scales = open_shared(spec['scales']) if spec['scales'] is not None else None
+        engine.quantized = QuantizedMatrix(open_shared(spec['codes']), scales)
+    if spec['ivf'] is not None:
+        engine.ivf = spec['ivf']
+        engine.ivf.matrix = engine.matrix
+    _engine = engine
+
+
+def _worker_pid(_) -> int:
+    return os.getpid()
+
+
+def _match_shard(k: int, rows: np.ndarray,
+                 candidates: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if candidates is None:
+        indices, scores = _engine.top_k(k, rows)
+    else:
+        indices, scores = _engine.top_k_among(k, rows, candidates)
+    return rows, indices, scores
+
+
+class ParallelMatcher:
+    """
+    Top-k matching for a MatchEngine spread over a pool of worker processes.
+
+    The engine's normalized matrix (and its quantized codes) are shared
+    with the workers as read-only memory maps: a vector snapshot segment
+    is mapped as it is, anything else is written once to a temporary
+    directory. Every worker opens them when it starts, so no vectors are
+    pickled per task, and the pages are shared through the page cache.
+
+    Query rows are split into shards, either contiguous row blocks or,
+    with `shard_by='university'`, one group of partitions at a time. A
+    university shard is matched exactly against its own partition only,
+    which also skips the cross-campus dot products. Shard results come
+    back as row indices and are merged in the parent, in query order.
+
+    Use as a context manager, so the pool and the shared files are
+    cleaned up:
+
+        with ParallelMatcher(engine, workers=4) as matcher:
+            results = matcher.matches(4)
+    """
+
+    def __init__(self, engine: MatchEngine, workers: int, shard_by: str = SHARD_BY_ROWS,
+                 directory: Optional[str] = None):
+        if shard_by not in (SHARD_BY_ROWS, SHARD_BY_UNIVERSITY):
+            raise ValueError(f"Unknown shard_by {shard_by!r}, expected '{SHARD_BY_ROWS}' or '{SHARD_BY_UNIVERSITY}'")
+        if shard_by == SHARD_BY_UNIVERSITY and engine.partitions is None:
+            raise ValueError("Sharding by university needs an engine partitioned by university")
+        self.engine = engine
+        self.workers = workers
+        self.shard_by = shard_by
+        self.directory = directory
+        self._workdir: Optional[str] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _spec(self) -> Dict:
+        self._workdir = tempfile.mkdtemp(prefix='roomnet-match-', dir=self.directory)
+        engine = self.engine
+        quantized = engine.quantized
+        return {
+            'count': len(engine.ids),
+            'matrix': share_array(engine.matrix, self._workdir, 'matrix'),
+            'codes': share_array(quantized.codes, self._workdir, 'codes') if quantized is not None else None,
+            'scales': share_array(quantized.scales, self._workdir, 'scales')
+            if quantized is not None and quantized.scales is not None else None,
+            'partitions': engine.partitions,
+            'scorer': engine.scorer,
+            'ivf': engine.ivf,
+            'block_size': engine.block_size,
+            'rerank_factor': engine.rerank_factor,
+        }
+
+    def start(self) -> None:
+        """Share the engine's arrays and start the worker processes."""
+        spec = self._spec()
+        threads = str(max(1, (os.cpu_count() or 1) // self.workers))
+        previous = {name: os.environ.get(name) for name in BLAS_THREAD_VARS}
+        for name in BLAS_THREAD_VARS:
+            os.environ.setdefault(name, threads)
+        try:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(spec,)
+            )
+            # Start every worker now, while the environment holds their thread counts
+            list(self._executor.map(_worker_pid, range(self.workers)))
+        except Exception:
+            self.close()
+            raise
+        finally:
+            for name, value in previous.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+        logger.info(f"Started {self.workers} match workers over {len(self.engine.ids)} shared embeddings")
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._workdir is not None:
+            shutil.rmtree(self._workdir, ignore_errors=True)
+            self._workdir = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def shards(self, rows: np.ndarray) -> List[Tuple[np.ndarray, Optional[np.ndarray]]]:
+        """Split query rows into (rows, candidates) shards; candidates None means every user."""
+        target = max(1, -(-len(rows) // (self.workers * SHARDS_PER_WORKER)))
+        if self.shard_by == SHARD_BY_ROWS:
+            return [(rows[start:start + target], None) for start in range(0, len(rows), target)]
+
+        partitions = self.engine.partitions
+        members = {code: np.flatnonzero(partitions == code) for code in np.unique(partitions[rows])}
+        shards = []
+        for code, candidates in members.items():
+            queries = rows[partitions[rows] == code]
+            # Split big campuses into query blocks that all search the whole campus
+            for start in range(0, len(queries), target):
+                shards.append((queries[start:start + target], candidates))
+        return shards
+
+    def top_k(self, k: int, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Same as `MatchEngine.top_k`, computed shard by shard in the worker processes."""
+        if self._executor is None:
+            raise RuntimeError("ParallelMatcher has to be started first")
+        if rows is None:
+            rows = np.arange(len(self.engine.ids))
+        rows = np.asarray(rows, dtype=np.int64)
+        position = np.empty(len(self.engine.ids), dtype=np.int64)
+        position[rows] = np.arange(len(rows))
+        indices = np.full((len(rows), k), -1, dtype=np.int64)
+        scores = np.full((len(rows), k), -np.inf, dtype=np.float32)
+        futures = [self._executor.submit(_match_shard, k, shard, candidates)
+                   for shard, candidates in self.shards(rows)]
+        for future in futures:
+            shard, shard_indices, shard_scores = future.result()
+            indices[position[shard]] = shard_indices
+            scores[position[shard]] = shard_scores
+        return indices, scores
+
+    def matches(self, k: int, rows: Optional[np.ndarray] = None) -> Dict[str, List[Tuple[str, float]]]:
+        """Same as `MatchEngine.matches`, computed in the worker processes."""
+        if rows is None:
+            rows = np.arange(len(self.engine.ids))
+        indices, scores = self.top_k(k, rows)
+        return self.engine.results(rows, indices, scores)
@@ -0,0 +1,105 @@
+import logging
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FLOAT16 = 'float16'
+INT8 = 'int8'
+QUANTIZATIONS = (FLOAT16, INT8)
+
+# Rows converted to float32 at a time; keeps the scratch space in cache-sized pieces
+DEFAULT_CHUNK_SIZE = 8192
+
+
+class QuantizedMatrix:
+    """
+    A float32 matrix compressed with scalar quantization.
+
+    `float16` codes halve the size. `int8` codes take a quarter of the size
+    and come with a per-row float32 scale, so that
+    `row ≈ codes[row] * scales[row]`. Dot products are computed straight from
+    the codes, converting `chunk_size` rows at a time, so no full-precision
+    copy of the matrix is ever materialized.
+    """
+
+    def __init__(self, codes: np.ndarray, scales: Optional[np.ndarray] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.codes = codes
+        self.scales = scales
+        self.chunk_size = chunk_size
+
+    @property
+    def kind(self) -> str:
+        return INT8 if self.codes.dtype == np.int8 else FLOAT16
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @classmethod
+    def from_float(cls, matrix: np.ndarray, kind: str = INT8, chunk_size: int = DEFAULT_CHUNK_SIZE) -> 'QuantizedMatrix':
+        """Quantize the rows of a float32 matrix, chunk by chunk."""
+        if kind not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {kind!r}, expected one of {QUANTIZATIONS}")
+        n, dim = matrix.shape
+        if kind == FLOAT16:
+            codes = np.empty((n, dim), dtype=np.float16)
+            for start in range(0, n, chunk_size):
+                codes[start:start + chunk_size] = matrix[start:start + chunk_size]
+            return cls(codes, chunk_size=chunk_size)
+
+        codes = np.empty((n, dim), dtype=np.int8)
+        scales = np.empty(n, dtype=np.float32)
+        for start in range(0, n, chunk_size):
+            block = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+            scale = np.abs(block).max(axis=1) / 127
+            scale[scale == 0] = 1.0
+            codes[start:start + len(block)] = np.rint(block / scale[:, None])
+            scales[start:start + len(block)] = scale
+        return cls(codes, scales, chunk_size=chunk_size)
+
+    def dequantize(self, rows: np.ndarray) -> np.ndarray:
+        """Return the given rows as approximate float32 vectors."""
+        vectors = self.codes[rows].astype(np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows][..., None]
+        return vectors
+
+    def dot(self, queries: np.ndarray, candidates: Optional[np.ndarray] = None) -> np.ndarray:
+        """Approximate `queries @ matrix[candidates].T` for float32 queries."""
+        if candidates is None:
+            candidates = np.arange(len(self.codes))
+        scores = np.empty((len(queries), len(candidates)), dtype=np.float32)
+        for start in range(0, len(candidates), self.chunk_size):
+            chunk = candidates[start:start + self.chunk_size]
+            scores[:, start:start + len(chunk)] = queries @ self.dequantize(chunk).T
+        return scores
+
+    def save(self, path: str) -> None:
+        """Write the codes (and scales) as .npy files next to `path`."""
+        np.save(f"{path}.codes.npy", self.codes)
+        if self.scales is not None:
+            np.save(f"{path}.scales.npy", self.scales)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'QuantizedMatrix':
+        """Open a matrix written by `save`, memory-mapped read-only by default."""
+        mode = 'r' if mmap else None
+        codes = np.load(f"{path}.codes.npy", mmap_mode=mode)
+        scales = np.load(f"{path}.scales.npy", mmap_mode=mode) if codes.dtype == np.int8 else None
+        return cls(codes, scales)
+
+
+def recall_at_k(expected: np.ndarray, actual: np.ndarray) -> float:
+    """Fraction of the valid indices in `expected` that also appear in the same row of `actual`."""
+    hits = total = 0
+    for expected_row, actual_row in zip(expected, actual):
+        wanted = set(expected_row[expected_row >= 0].tolist())
+        hits += len(wanted & set(actual_row.tolist()))
+        total += len(wanted)
+    return hits / total if total else 1.0
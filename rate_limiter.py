@@ -0,0 +1,164 @@
+import re
+import time
+import logging
+import threading
+from typing import Mapping, Optional
+
+from embedding_batcher import EmbedFn, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Share of the provider's advertised limits the buckets aim for, leaving
+# room for token estimates running low and for other clients on the key
+DEFAULT_HEADROOM = 0.9
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Whether an API error is an HTTP 429."""
+    return getattr(error, 'status_code', None) == 429
+
+
+def retry_after_seconds(error: Exception, default: float = 1.0) -> float:
+    """Read the Retry-After header of a rate-limit error, if the client exposes it."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after', default))
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Parse an OpenAI reset duration such as `1s`, `20ms` or `6m0s` into seconds."""
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value or '')
+    if not parts:
+        return None
+    scale = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def _header_number(headers: Mapping[str, str], name: str) -> Optional[float]:
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """
+    Thread-safe token buckets for requests and tokens per minute.
+
+    `acquire` blocks until a request of the given token cost fits in both
+    buckets. After a 429, `penalize` holds back every caller until the
+    provider's Retry-After has passed, so concurrent workers slow down
+    together instead of each hammering the API into more 429s.
+
+    `observe_headers` tunes the buckets from the provider's rate-limit
+    headers on every response: the advertised limits (scaled by `headroom`)
+    become the bucket sizes unless configured lower, and the remaining
+    counts cap what the buckets hold, so other processes sharing the key
+    are accounted for before they cause a 429.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 headroom: float = DEFAULT_HEADROOM):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.configured_requests_per_minute = requests_per_minute
+        self.configured_tokens_per_minute = tokens_per_minute
+        self.headroom = headroom
+        self._requests = requests_per_minute or 0.0
+        self._tokens = tokens_per_minute or 0.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._tuned = False
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _wait_time(self, tokens: int) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self._paused_until - now)
+        if self.requests_per_minute and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute:
+            # A single request larger than the whole bucket only waits for a full bucket
+            needed = min(tokens, self.tokens_per_minute)
+            if self._tokens < needed:
+                wait = max(wait, (needed - self._tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    def acquire(self, tokens: int = 1) -> None:
+        """Block until one request costing `tokens` tokens may be sent."""
+        while True:
+            with self._lock:
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    if self.requests_per_minute:
+                        self._requests -= 1
+                    if self.tokens_per_minute:
+                        self._tokens -= tokens
+                    return
+            time.sleep(wait)
+
+    def _tune(self, now: float, limit: Optional[float], remaining: Optional[float], reset: Optional[float],
+              configured: Optional[float], current: Optional[float], level: float):
+        """Return the new (per-minute limit, bucket level) for one bucket."""
+        if limit:
+            limit *= self.headroom
+            current = min(limit, configured) if configured else limit
+        if current and remaining is not None:
+            level = min(level if self._tuned else current, remaining * self.headroom)
+            if remaining < 1 and reset:
+                self._paused_until = max(self._paused_until, now + reset)
+        return current, level
+
+    def observe_headers(self, headers: Mapping[str, str]) -> None:
+        """Tune the buckets from OpenAI's `x-ratelimit-*` response headers."""
+        if _header_number(headers, 'x-ratelimit-limit-requests') is None \
+                and _header_number(headers, 'x-ratelimit-limit-tokens') is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.requests_per_minute, self._requests = self._tune(
+                now,
+                _header_number(headers, 'x-ratelimit-limit-requests'),
+                _header_number(headers, 'x-ratelimit-remaining-requests'),
+                parse_duration(headers.get('x-ratelimit-reset-requests')),
+                self.configured_requests_per_minute, self.requests_per_minute, self._requests
+            )
+            self.tokens_per_minute, self._tokens = self._tune(
+                now,
+                _header_number(headers, 'x-ratelimit-limit-tokens'),
+                _header_number(headers, 'x-ratelimit-remaining-tokens'),
+                parse_duration(headers.get('x-ratelimit-reset-tokens')),
+                self.configured_tokens_per_minute, self.tokens_per_minute, self._tokens
+            )
+            self._tuned = True
+
+    def penalize(self, seconds: float) -> None:
+        """Hold back every caller for `seconds`, e.g. after a 429."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        logger.warning(f"Rate limited, pausing requests for {seconds:.1f}s")
+
+
+def rate_limited(embed_fn: EmbedFn, limiter: RateLimiter) -> EmbedFn:
+    """Wrap an embed function so every call is paced by the limiter."""
+    def embed(texts):
+        limiter.acquire(sum(estimate_tokens(text) for text in texts))
+        try:
+            return embed_fn(texts)
+        except Exception as e:
+            if is_rate_limit_error(e):
+                limiter.penalize(retry_after_seconds(e))
+            raise
+    return embed
@@ -0,0 +1,133 @@
+import logging
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from vector_loader import DEFAULT_PAGE_SIZE, iter_keyset_pages
+
+logger = logging.getLogger(__name__)
+
+# Ordinal codes for the Quiz.jsx options; -1 means unanswered
+SLEEP_TIMES = {'early_bird': 0, 'average': 1, 'night_owl': 2}
+WAKE_TIMES = {'very_early': 0, 'average': 1, 'late': 2}
+CLEANLINESS = {'very_clean': 0, 'moderately_clean': 1, 'relaxed_cleaning': 2, 'minimal_effort': 3}
+VISITORS = {'always_welcome': 0, 'sometimes_ok': 1, 'rarely_preferred': 2, 'no_visitors': 3}
+
+# Smoking answers as bit flags
+SMOKES = 1
+NO_SMOKING = 2
+OUTSIDE_ONLY = 4
+SMOKING_FLAGS = {
+    'non_smoker_only': NO_SMOKING,
+    'outside_ok': OUTSIDE_ONLY,
+    'smoking_ok': 0,
+    'smoker': SMOKES,
+}
+
+# Penalty for the largest possible gap on each ordinal field, subtracted
+# from the cosine similarity; smaller gaps are penalized proportionally.
+DEFAULT_WEIGHTS = {
+    'sleepTime': 0.06,
+    'wakeTime': 0.04,
+    'cleanliness': 0.08,
+    'visitors': 0.04,
+    'smoking': 0.05,
+}
+
+_ORDINAL_FIELDS = {
+    'sleepTime': SLEEP_TIMES,
+    'wakeTime': WAKE_TIMES,
+    'cleanliness': CLEANLINESS,
+    'visitors': VISITORS,
+}
+
+
+def _university(responses: Dict) -> Optional[str]:
+    university = responses.get('university')
+    if isinstance(university, list):
+        university = university[0] if university else None
+    return university or None
+
+
+class StructuredProfiles:
+    """
+    The structured Quiz answers of every user, encoded as compact NumPy arrays.
+
+    Ordinal answers are int8 codes, smoking is a uint8 bit mask and the
+    university is an int32 code, all aligned with the match engine's rows.
+    """
+
+    def __init__(self, ids: List[str]):
+        self.ids = ids
+        self.ordinals = {name: np.full(len(ids), -1, dtype=np.int8) for name in _ORDINAL_FIELDS}
+        self.smoking = np.zeros(len(ids), dtype=np.uint8)
+        self.university = np.full(len(ids), -1, dtype=np.int32)
+        self._university_codes: Dict[str, int] = {}
+
+    def set(self, row: int, responses: Dict) -> None:
+        """Encode one user's survey responses into row `row`."""
+        for name, codes in _ORDINAL_FIELDS.items():
+            self.ordinals[name][row] = codes.get(responses.get(name), -1)
+        self.smoking[row] = SMOKING_FLAGS.get(responses.get('smoking'), 0)
+        university = _university(responses)
+        if university:
+            self.university[row] = self._university_codes.setdefault(university, len(self._university_codes))
+
+    @classmethod
+    def from_responses(cls, ids: List[str], responses: Dict[str, Dict]) -> 'StructuredProfiles':
+        profiles = cls(ids)
+        for row, user_id in enumerate(ids):
+            if user_id in responses:
+                profiles.set(row, responses[user_id] or {})
+        return profiles
+
+    @classmethod
+    def load(cls, supabase, ids: List[str], page_size: int = DEFAULT_PAGE_SIZE) -> 'StructuredProfiles':
+        """Page through `survey_responses` and encode the answers of the given users."""
+        profiles = cls(ids)
+        index_of = {user_id: row for row, user_id in enumerate(ids)}
+        for page in iter_keyset_pages(supabase, 'survey_responses', 'user_id, responses', page_size=page_size):
+            for survey in page:
+                row = index_of.get(str(survey['user_id']))
+                if row is not None:
+                    profiles.set(row, survey.get('responses') or {})
+        logger.info(f"Encoded structured answers for {len(ids)} users")
+        return profiles
+
+
+class CompatibilityScorer:
+    """
+    Adjust cosine scores with hard constraints and structured penalties.
+
+    Hard constraints set a candidate's score to -inf: students at different
+    universities, or a smoker paired with someone who wants no smoking.
+    Penalties subtract `weight * gap / max_gap` for each ordinal answer where
+    both users answered, plus the smoking weight when a smoker is paired with
+    someone who only accepts smoking outside. Everything runs on whole
+    blocks of scores at once.
+    """
+
+    def __init__(self, profiles: StructuredProfiles, weights: Optional[Dict[str, float]] = None,
+                 same_university: bool = True):
+        self.profiles = profiles
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.same_university = same_university
+
+    def adjust(self, scores: np.ndarray, rows: np.ndarray, candidates: np.ndarray) -> None:
+        """Apply constraints and penalties in place to a (rows x candidates) score block."""
+        profiles = self.profiles
+        if self.same_university:
+            a, b = profiles.university[rows][:, None], profiles.university[candidates][None, :]
+            scores[(a >= 0) & (b >= 0) & (a != b)] = -np.inf
+
+        a, b = profiles.smoking[rows][:, None], profiles.smoking[candidates][None, :]
+        smokes_a, smokes_b = (a & SMOKES) != 0, (b & SMOKES) != 0
+        scores[(smokes_a & ((b & NO_SMOKING) != 0)) | (smokes_b & ((a & NO_SMOKING) != 0))] = -np.inf
+        outside = (smokes_a & ((b & OUTSIDE_ONLY) != 0)) | (smokes_b & ((a & OUTSIDE_ONLY) != 0))
+        scores -= self.weights['smoking'] * outside.astype(np.float32)
+
+        for name, codes in _ORDINAL_FIELDS.items():
+            a = profiles.ordinals[name][rows][:, None].astype(np.int16)
+            b = profiles.ordinals[name][candidates][None, :].astype(np.int16)
+            gap = np.where((a >= 0) & (b >= 0), np.abs(a - b), 0)
+            scores -= (self.weights[name] / (len(codes) - 1)) * gap.astype(np.float32)
@@ -0,0 +1,9 @@
+-- Version of the survey text format (survey_format.FORMAT_VERSION) each
+-- embedding was built from. NULL means it predates versioning; stale rows
+-- are re-embedded by embedding_generator.reembed_stale_formats().
+
+ALTER TABLE user_embeddings
+    ADD COLUMN IF NOT EXISTS format_version INTEGER;
+
+CREATE INDEX IF NOT EXISTS user_embeddings_format_version
+    ON user_embeddings (format_version, user_id);
@@ -0,0 +1,49 @@
+-- Claim/lease columns for running several embedding workers over survey_responses.
+-- embedding_status: NULL (pending), 'claimed', 'completed', 'error' (retry after
+-- next_attempt_at), 'dead' (gave up after max attempts).
+
+ALTER TABLE survey_responses
+    ADD COLUMN IF NOT EXISTS claimed_by TEXT,
+    ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ,
+    ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMPTZ,
+    ADD COLUMN IF NOT EXISTS last_error TEXT;
+
+CREATE INDEX IF NOT EXISTS survey_responses_claimable
+    ON survey_responses (embedding_status, next_attempt_at, lease_expires_at);
+
+CREATE OR REPLACE FUNCTION claim_embedding_jobs(
+    p_worker_id TEXT,
+    p_batch_size INTEGER,
+    p_lease_seconds INTEGER,
+    p_max_attempts INTEGER
+)
+RETURNS TABLE (user_id UUID, responses JSONB, attempts INTEGER)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- Expired leases on jobs that have used up their attempts are dead-lettered
+    UPDATE survey_responses s
+    SET embedding_status = 'dead', claimed_by = NULL
+    WHERE s.embedding_status = 'claimed'
+      AND s.lease_expires_at <= NOW()
+      AND s.attempts >= p_max_attempts;
+
+    RETURN QUERY
+    UPDATE survey_responses s
+    SET embedding_status = 'claimed',
+        claimed_by = p_worker_id,
+        lease_expires_at = NOW() + make_interval(secs => p_lease_seconds),
+        attempts = s.attempts + 1
+    WHERE s.user_id IN (
+        SELECT c.user_id FROM survey_responses c
+        WHERE c.embedding_status IS NULL
+           OR (c.embedding_status = 'error' AND c.next_attempt_at <= NOW())
+           OR (c.embedding_status = 'claimed' AND c.lease_expires_at <= NOW())
+        ORDER BY c.user_id
+        LIMIT p_batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING s.user_id, s.responses, s.attempts;
+END;
+$$;
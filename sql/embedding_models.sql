@@ -0,0 +1,45 @@
+-- Tag every embedding with the model that produced it, so vectors from
+-- different models are never compared. Rows written before tagging are
+-- marked 'legacy' and re-embedded by a migration (model_migration.py).
+
+ALTER TABLE user_embeddings
+    ADD COLUMN IF NOT EXISTS model TEXT NOT NULL DEFAULT 'legacy',
+    ADD COLUMN IF NOT EXISTS dimensions INTEGER;
+
+UPDATE user_embeddings SET dimensions = vector_dims(embedding) WHERE dimensions IS NULL;
+
+-- Untyped (vector rather than vector(1536)) so vectors from models of
+-- different sizes can coexist; the dimensions column records each size
+ALTER TABLE user_embeddings ALTER COLUMN embedding TYPE vector;
+
+-- One vector per user and model
+ALTER TABLE user_embeddings DROP CONSTRAINT IF EXISTS user_embeddings_pkey;
+ALTER TABLE user_embeddings ADD PRIMARY KEY (user_id, model);
+
+CREATE INDEX IF NOT EXISTS user_embeddings_model_user ON user_embeddings (model, user_id);
+CREATE INDEX IF NOT EXISTS user_embeddings_model_updated ON user_embeddings (model, updated_at);
+
+-- The model the match job reads; switching models is one update of this row
+CREATE TABLE IF NOT EXISTS embedding_settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Until the first migration switches models the untagged set stays active;
+-- the embedding jobs keep writing legacy vectors (with the configured
+-- model) for new users meanwhile, see embedding_models.write_models
+INSERT INTO embedding_settings (key, value) VALUES ('active_model', 'legacy')
+    ON CONFLICT (key) DO NOTHING;
+
+-- Progress of background re-embedding into a new model; last_user_id is
+-- the checkpoint an interrupted migration resumes from
+CREATE TABLE IF NOT EXISTS embedding_migrations (
+    target_model TEXT PRIMARY KEY,
+    source_model TEXT NOT NULL,
+    status TEXT NOT NULL,
+    last_user_id UUID,
+    migrated INTEGER NOT NULL DEFAULT 0,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
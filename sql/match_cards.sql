@@ -0,0 +1,64 @@
+-- Denormalized read model for the Matches page (match_cards.MatchCards).
+-- The match job writes one row per (user_id, match_id) with everything the
+-- card shows, so the page is a single indexed lookup on user_id.
+
+CREATE TABLE IF NOT EXISTS match_cards (
+    user_id UUID NOT NULL,
+    match_id UUID NOT NULL,
+    rank INTEGER NOT NULL,
+    match_percentage INTEGER NOT NULL,
+    name TEXT,
+    university TEXT,
+    sleep_habits TEXT,
+    cleanliness TEXT,
+    interests JSONB NOT NULL DEFAULT '[]',
+    image_url TEXT,
+    run_id UUID,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (user_id, match_id)
+);
+
+CREATE INDEX IF NOT EXISTS match_cards_user_rank
+    ON match_cards (user_id, rank);
+
+-- Finds every card showing a user when their profile changes
+CREATE INDEX IF NOT EXISTS match_cards_match_id
+    ON match_cards (match_id);
+
+ALTER TABLE match_cards ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Users can read their own match cards" ON match_cards;
+CREATE POLICY "Users can read their own match cards"
+    ON match_cards FOR SELECT
+    USING (auth.uid() = user_id);
+
+-- Users whose card fields changed; drained by MatchCards.refresh_queued()
+CREATE TABLE IF NOT EXISTS match_card_refresh (
+    user_id UUID PRIMARY KEY,
+    queued_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- TG_ARGV[0] names the user id column of the table the trigger is on
+CREATE OR REPLACE FUNCTION queue_match_card_refresh()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO match_card_refresh (user_id, queued_at)
+    VALUES ((to_jsonb(NEW) ->> TG_ARGV[0])::UUID, NOW())
+    ON CONFLICT (user_id) DO UPDATE SET queued_at = EXCLUDED.queued_at;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS profiles_match_card_refresh ON profiles;
+CREATE TRIGGER profiles_match_card_refresh
+    AFTER UPDATE OF full_name, university, profile_image_url ON profiles
+    FOR EACH ROW
+    EXECUTE FUNCTION queue_match_card_refresh('id');
+
+DROP TRIGGER IF EXISTS survey_responses_match_card_refresh ON survey_responses;
+CREATE TRIGGER survey_responses_match_card_refresh
+    AFTER UPDATE OF responses ON survey_responses
+    FOR EACH ROW
+    EXECUTE FUNCTION queue_match_card_refresh('user_id');
@@ -0,0 +1,20 @@
+-- Set-based match replacement (match_writer.MatchWriter): every run upserts
+-- users' new matches on (user_id, match_id), tagged with its run_id, and
+-- then deletes those users' rows from earlier runs.
+
+ALTER TABLE matches
+    ADD COLUMN IF NOT EXISTS run_id UUID;
+
+-- Drop duplicate pairs left by the old delete-then-insert writes, keeping the newest
+DELETE FROM matches a
+USING matches b
+WHERE a.user_id = b.user_id
+  AND a.match_id = b.match_id
+  AND (a.created_at, a.ctid) < (b.created_at, b.ctid);
+
+CREATE UNIQUE INDEX IF NOT EXISTS matches_user_id_match_id
+    ON matches (user_id, match_id);
+
+-- Finds the users listing a changed user in incremental runs (generate_matches.get_listing_users)
+CREATE INDEX IF NOT EXISTS matches_match_id_user_id
+    ON matches (match_id, user_id);
@@ -0,0 +1,21 @@
+-- Mutual roommate assignments (assignment.assign_roommates), one row per
+-- user in each direction of a pair. Every match run upserts its pairs on
+-- user_id, tagged with its run_id, then deletes rows from earlier runs.
+
+CREATE TABLE IF NOT EXISTS roommate_pairs (
+    user_id UUID PRIMARY KEY,
+    roommate_id UUID NOT NULL,
+    match_score DOUBLE PRECISION NOT NULL,
+    run_id UUID,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS roommate_pairs_run_id
+    ON roommate_pairs (run_id);
+
+ALTER TABLE roommate_pairs ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Users can read their own roommate pair" ON roommate_pairs;
+CREATE POLICY "Users can read their own roommate pair"
+    ON roommate_pairs FOR SELECT
+    USING (auth.uid() = user_id);
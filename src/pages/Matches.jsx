@@ -4,6 +4,40 @@ import { supabase } from '../lib/supabaseClient'
 // Development mode toggle - set to true to bypass authentication
 const DEVELOPMENT_MODE = false;
 
+// Shown instead of real matches in development mode
+const SAMPLE_MATCHES = [
+  {
+    id: 1,
+    name: 'Alex Johnson',
+    university: 'University of New Hampshire',
+    matchPercentage: 95,
+    sleepHabits: 'Night Owl',
+    cleanliness: 'Very Clean',
+    interests: ['Basketball', 'Gaming', 'Reading'],
+    imageUrl: 'https://randomuser.me/api/portraits/men/32.jpg',
+  },
+  {
+    id: 2,
+    name: 'Sam Taylor',
+    university: 'University of New Hampshire',
+    matchPercentage: 89,
+    sleepHabits: 'Early Bird',
+    cleanliness: 'Moderately Clean',
+    interests: ['Hiking', 'Cooking', 'Music'],
+    imageUrl: 'https://randomuser.me/api/portraits/women/44.jpg',
+  },
+  {
+    id: 3,
+    name: 'Jordan Smith',
+    university: 'University of New Hampshire',
+    matchPercentage: 84,
+    sleepHabits: 'Average',
+    cleanliness: 'Moderately Clean',
+    interests: ['Swimming', 'Photography', 'Movies'],
+    imageUrl: 'https://randomuser.me/api/portraits/men/62.jpg',
+  }
+]
+
 export default function Matches() {
   const [matches, setMatches] = useState([])
   const [loading, setLoading] = useState(true)
@@ -14,64 +48,49 @@ export default function Matches() {
       try {
         setLoading(true)
         
-        // In development mode, skip authentication check
-        if (!DEVELOPMENT_MODE) {
-          // Get current user
-          const { data: { user }, error: userError } = await supabase.auth.getUser()
-          
-          if (userError) {
-            throw userError
-          }
-
-          if (!user) {
-            throw new Error('No user logged in')
-          }
+        // In development mode, skip authentication and show sample cards
+        if (DEVELOPMENT_MODE) {
+          setMatches(SAMPLE_MATCHES)
+          return
         }
 
-        // In a real application, you would fetch actual matches here
-        // For now, we'll use mock data
-        const mockMatches = [
-          {
-            id: 1,
-            name: 'Alex Johnson',
-            university: 'University of New Hampshire',
-            matchPercentage: 95,
-            sleepHabits: 'Night Owl',
-            cleanliness: 'Very Clean',
-            interests: ['Basketball', 'Gaming', 'Reading'],
-            imageUrl: 'https://randomuser.me/api/portraits/men/32.jpg',
-          },
-          {
-            id: 2,
-            name: 'Sam Taylor',
-            university: 'University of New Hampshire',
-            matchPercentage: 89,
-            sleepHabits: 'Early Bird',
-            cleanliness: 'Moderately Clean',
-            interests: ['Hiking', 'Cooking', 'Music'],
-            imageUrl: 'https://randomuser.me/api/portraits/women/44.jpg',
-          },
-          {
-            id: 3,
-            name: 'Jordan Smith',
-            university: 'University of New Hampshire',
-            matchPercentage: 84,
-            sleepHabits: 'Average',
-            cleanliness: 'Moderately Clean',
-            interests: ['Swimming', 'Photography', 'Movies'],
-            imageUrl: 'https://randomuser.me/api/portraits/men/62.jpg',
-          }
-        ]
+        // Get current user
+        const { data: { user }, error: userError } = await supabase.auth.getUser()
         
-        // Simulate API delay
-        setTimeout(() => {
-          setMatches(mockMatches)
-          setLoading(false)
-        }, 1000)
+        if (userError) {
+          throw userError
+        }
+
+        if (!user) {
+          throw new Error('No user logged in')
+        }
+
+        // Cards are precomputed by the match job (see sql/match_cards.sql), best match first
+        const { data: cards, error: cardsError } = await supabase
+          .from('match_cards')
+          .select('match_id, match_percentage, name, university, sleep_habits, cleanliness, interests, image_url')
+          .eq('user_id', user.id)
+          .order('rank')
+
+        if (cardsError) {
+          throw cardsError
+        }
+
+        setMatches(cards.map(card => ({
+          id: card.match_id,
+          name: card.name || 'Anonymous',
+          university: card.university || '',
+          matchPercentage: card.match_percentage,
+          sleepHabits: card.sleep_habits || 'Not specified',
+          cleanliness: card.cleanliness || 'Not specified',
+          interests: card.interests || [],
+          imageUrl: card.image_url || 'https://via.placeholder.com/400x300?text=No+Image',
+        })))
         
       } catch (error) {
         console.error('Error fetching matches:', error)
         setError(error.message)
+      } finally {
         setLoading(false)
       }
     }
@@ -0,0 +1,93 @@
+from typing import Dict, List, Tuple
+
+from metrics import metrics
+
+# Bump whenever the text below changes; embeddings stored with an older
+# version are re-embedded by embedding_generator.reembed_stale_formats()
+FORMAT_VERSION = 1
+
+NOT_SPECIFIED = 'Not specified'
+
+# Quiz.jsx option ids and how they read in the embedded text
+AGE_LABELS = {'under_18': 'Under 18', '18_to_23': '18-23', 'over_23': 'Over 23'}
+YEAR_LABELS = {'freshman': 'Freshman', 'sophomore': 'Sophomore', 'junior': 'Junior', 'senior': 'Senior'}
+SLEEP_TIME_LABELS = {
+    'early_bird': 'Early bird (before 10 PM)',
+    'average': 'Average (10 PM - 12 AM)',
+    'night_owl': 'Night owl (after 12 AM)',
+}
+WAKE_TIME_LABELS = {
+    'very_early': 'Early bird (before 7 AM)',
+    'average': 'Average (7 AM - 9 AM)',
+    'late': 'Late riser (after 9 AM)',
+}
+CLEANLINESS_LABELS = {
+    'very_clean': 'Very clean',
+    'moderately_clean': 'Moderately clean',
+    'relaxed_cleaning': 'Relaxed about cleaning',
+    'minimal_effort': 'Minimal effort',
+}
+VISITOR_LABELS = {
+    'always_welcome': 'Always welcome, open to visitors anytime',
+    'sometimes_ok': 'Sometimes okay, with advance notice',
+    'rarely_preferred': 'Rarely, prefers minimal visitors',
+    'no_visitors': 'No visitors, private space only',
+}
+SMOKING_LABELS = {
+    'non_smoker_only': 'Non-smoker, no smoking at all',
+    'outside_ok': 'Smoking outside only',
+    'smoking_ok': 'Okay with smoking',
+    'smoker': 'Smokes regularly',
+}
+STUDY_HABIT_LABELS = {
+    'very_focused': 'Very focused, quiet study environment',
+    'moderate': 'Moderate noise and distractions okay',
+    'flexible': 'Flexible, adapts to different environments',
+    'social': 'Prefers studying with others or in groups',
+}
+MUSIC_LABELS = {
+    'always': 'Loves having music playing',
+    'sometimes': 'Sometimes, at moderate volume',
+    'quiet': 'Prefers a quiet environment',
+}
+
+# (Quiz.jsx field, line label, option labels); the name and photo are left out on purpose
+FIELDS: List[Tuple[str, str, Dict[str, str]]] = [
+    ('age', 'Age', AGE_LABELS),
+    ('year', 'Year', YEAR_LABELS),
+    ('university', 'University', {}),
+    ('countryOfOrigin', 'Country of origin', {}),
+    ('languages', 'Languages', {}),
+    ('sleepTime', 'Bedtime', SLEEP_TIME_LABELS),
+    ('wakeTime', 'Wake-up time', WAKE_TIME_LABELS),
+    ('cleanliness', 'Cleanliness', CLEANLINESS_LABELS),
+    ('visitors', 'Visitors', VISITOR_LABELS),
+    ('smoking', 'Smoking', SMOKING_LABELS),
+    ('studyHabits', 'Study habits', STUDY_HABIT_LABELS),
+    ('hobbies', 'Hobbies', {}),
+    ('musicPreference', 'Music', MUSIC_LABELS),
+    ('additionalInfo', 'About me', {}),
+]
+
+HEADER = 'Roommate profile:'
+# Each field's line prefix is built once at import, so formatting is one join per survey
+LINES = [(f"- {label}: ", key, labels) for key, label, labels in FIELDS]
+
+
+def _value(answer, labels: Dict[str, str]) -> str:
+    if isinstance(answer, list):
+        answer = ', '.join(labels.get(str(item), str(item)) for item in answer if item)
+    elif answer is not None:
+        answer = labels.get(str(answer), str(answer)).strip()
+    return answer or NOT_SPECIFIED
+
+
+def format_survey(responses: Dict) -> str:
+    """
+    Turn a user's Quiz responses into the text that gets embedded.
+
+    Option ids are spelled out as readable labels and missing answers read
+    "Not specified". `responses` is left untouched.
+    """
+    with metrics.stage('format', span=False):
+        return '\n'.join([HEADER] + [prefix + _value(responses.get(key), labels) for prefix, key, labels in LINES])
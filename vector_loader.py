@@ -0,0 +1,166 @@
+import json
+import logging
+from datetime import datetime, timezone
+from typing import Callable, Collection, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from metrics import metrics
+from quantization import QuantizedMatrix
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 1000
+
+
+def parse_timestamp(value: str) -> datetime:
+    """Parse a Postgres ISO timestamp into an aware datetime."""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def iter_keyset_pages(
+    supabase,
+    table: str,
+    columns: str,
+    key: str = 'user_id',
+    page_size: int = DEFAULT_PAGE_SIZE,
+    apply_filters: Optional[Callable] = None,
+    start_after=None
+) -> Iterator[List[Dict]]:
+    """
+    Yield pages of rows ordered by `key`, resuming each page after the last key seen.
+
+    Keyset pagination keeps every page an index range scan, unlike offsets
+    that get slower the deeper they go. `apply_filters` can add extra
+    filters to each page's query, and `start_after` resumes after a key.
+    """
+    last_key = start_after
+    while True:
+        query = supabase.table(table).select(columns).order(key).limit(page_size)
+        if apply_filters:
+            query = apply_filters(query)
+        if last_key is not None:
+            query = query.gt(key, last_key)
+        with metrics.stage('fetch', items=0, table=table) as stage:
+            rows = query.execute().data
+            stage['items'] = len(rows)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        last_key = rows[-1][key]
+
+
+class EmbeddingSet:
+    """
+    User ids, their embeddings as one float32 matrix, and when each was last updated.
+
+    `normalized` marks vectors that are already L2-normalized, such as a
+    read-only memory map of a vector snapshot, and `quantized` holds
+    precomputed quantized codes of exactly those rows, if any.
+    """
+
+    def __init__(self, ids: List[str], vectors: np.ndarray, updated_at: List[Optional[str]],
+                 normalized: bool = False, quantized: Optional[QuantizedMatrix] = None):
+        self.ids = ids
+        self.vectors = vectors
+        self.updated_at = updated_at
+        self.normalized = normalized
+        self.quantized = quantized
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def without(self, user_ids: Collection[str]) -> 'EmbeddingSet':
+        """Return a set without the given users' embeddings (this one if it holds none of them)."""
+        keep = [i for i, user_id in enumerate(self.ids) if user_id not in user_ids]
+        if len(keep) == len(self.ids):
+            return self
+        return EmbeddingSet([self.ids[i] for i in keep], self.vectors[keep],
+                            [self.updated_at[i] for i in keep], normalized=self.normalized)
+
+    def merge(self, delta: 'EmbeddingSet') -> 'EmbeddingSet':
+        """Return a new set with the delta's embeddings replacing or extending this one's."""
+        if not len(delta):
+            return self
+        if not len(self):
+            return delta
+        if self.normalized and not delta.normalized:
+            norms = np.linalg.norm(delta.vectors, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            delta = EmbeddingSet(delta.ids, delta.vectors / norms, delta.updated_at, normalized=True)
+        index_of = {user_id: i for i, user_id in enumerate(self.ids)}
+        ids = list(self.ids)
+        updated_at = list(self.updated_at)
+        new_rows = [i for i, user_id in enumerate(delta.ids) if user_id not in index_of]
+        vectors = np.concatenate([self.vectors, delta.vectors[new_rows]])
+        for i, user_id in enumerate(delta.ids):
+            if user_id in index_of:
+                vectors[index_of[user_id]] = delta.vectors[i]
+                updated_at[index_of[user_id]] = delta.updated_at[i]
+        ids.extend(delta.ids[i] for i in new_rows)
+        updated_at.extend(delta.updated_at[i] for i in new_rows)
+        return EmbeddingSet(ids, vectors, updated_at, normalized=self.normalized and delta.normalized)
+
+
+class VectorLoader:
+    """
+    Load every row of `user_embeddings` into memory once per run.
+
+    Rows are fetched page by page and parsed straight into a preallocated
+    float32 matrix, so only one page of raw JSON is alive at a time and the
+    vectors themselves cost 4 bytes per dimension.
+    """
+
+    def __init__(self, supabase, page_size: int = DEFAULT_PAGE_SIZE, table: str = 'user_embeddings',
+                 model: Optional[str] = None):
+        self.supabase = supabase
+        self.page_size = page_size
+        self.table = table
+        # Only load vectors from this embedding model
+        self.model = model
+
+    def _filters(self, query, updated_since: Optional[str]):
+        if self.model:
+            query = query.eq('model', self.model)
+        if updated_since:
+            query = query.gt('updated_at', updated_since)
+        return query
+
+    def load(self, updated_since: Optional[str] = None) -> EmbeddingSet:
+        """Load every embedding, or only those updated after `updated_since`."""
+        ids: List[str] = []
+        updated_at: List[Optional[str]] = []
+        matrix: Optional[np.ndarray] = None
+
+        pages = iter_keyset_pages(
+            self.supabase, self.table, 'user_id, embedding, updated_at',
+            page_size=self.page_size,
+            apply_filters=lambda query: self._filters(query, updated_since)
+        )
+        for page in pages:
+            for row in page:
+                embedding = row.get('embedding')
+                if not embedding:
+                    continue
+                if isinstance(embedding, str):
+                    embedding = json.loads(embedding)
+                if matrix is None:
+                    matrix = np.empty((self.page_size, len(embedding)), dtype=np.float32)
+                if len(embedding) != matrix.shape[1]:
+                    logger.warning(
+                        f"Skipping embedding for user {row['user_id']} with "
+                        f"{len(embedding)} dimensions (expected {matrix.shape[1]})"
+                    )
+                    continue
+                if len(ids) == len(matrix):
+                    matrix = np.resize(matrix, (len(matrix) * 2, matrix.shape[1]))
+                matrix[len(ids)] = embedding
+                ids.append(str(row['user_id']))
+                updated_at.append(row.get('updated_at'))
+
+        vectors = matrix[:len(ids)] if matrix is not None else np.empty((0, 0), dtype=np.float32)
+        logger.info(f"Loaded {len(ids)} embeddings ({vectors.nbytes / 1e6:.1f} MB)")
+        return EmbeddingSet(ids, vectors, updated_at)
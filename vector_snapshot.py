@@ -0,0 +1,312 @@
+import os
+import json
+import fcntl
+import struct
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Callable, Collection, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from match_engine import normalize_rows, parse_embedding
+from quantization import QuantizedMatrix
+from vector_loader import EmbeddingSet, parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'RNVSNAP1'
+FORMAT_VERSION = 1
+# magic, version, dim, count, vectors offset, ids offset, id width, metadata offset, metadata width
+HEADER = struct.Struct('<8sIIQQQIQI')
+HEADER_SIZE = 64
+MANIFEST = 'manifest.json'
+DEFAULT_COMPACT_AFTER = 16
+# Files QuantizedMatrix.save writes next to a segment
+CODE_SUFFIXES = ('.codes.npy', '.scales.npy')
+
+
+def write_segment(path: str, ids: Sequence[str], vectors: np.ndarray, updated_at: Sequence[Optional[str]]) -> None:
+    """
+    Write one segment file.
+
+    Layout: a 64-byte header, the L2-normalized float32 vectors as one
+    contiguous row-major block, the ids as fixed-width UTF-8 strings and
+    the `updated_at` metadata column in the same form. The file is written
+    next to `path` and renamed into place, so readers never see it half-written.
+    """
+    vectors = normalize_rows(np.array(vectors, dtype=np.float32, order='C'))
+    id_table = np.array([str(user_id).encode() for user_id in ids])
+    metadata = np.array([(value or '').encode() for value in updated_at])
+    count, dim = vectors.shape
+    ids_offset = HEADER_SIZE + vectors.nbytes
+    metadata_offset = ids_offset + id_table.nbytes
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, dim, count, HEADER_SIZE, ids_offset,
+                         id_table.itemsize, metadata_offset, metadata.itemsize)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+        f.write(vectors.tobytes())
+        f.write(id_table.tobytes())
+        f.write(metadata.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_segment(path: str) -> Tuple[List[str], np.ndarray, List[Optional[str]]]:
+    """Open a segment with its vector block memory-mapped read-only."""
+    with open(path, 'rb') as f:
+        (magic, version, dim, count, vectors_offset, ids_offset,
+         id_width, metadata_offset, metadata_width) = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"{path} is not a version {FORMAT_VERSION} vector snapshot segment")
+    vectors = np.memmap(path, dtype=np.float32, mode='r', offset=vectors_offset, shape=(count, dim))
+    ids = np.memmap(path, dtype=f'S{id_width}', mode='r', offset=ids_offset, shape=(count,))
+    metadata = np.memmap(path, dtype=f'S{metadata_width}', mode='r', offset=metadata_offset, shape=(count,))
+    return (
+        np.char.decode(ids, 'utf-8').tolist(),
+        vectors,
+        [value or None for value in np.char.decode(metadata, 'utf-8').tolist()]
+    )
+
+
+class VectorSnapshot:
+    """
+    Local on-disk copy of `user_embeddings` that the match job can map straight into memory.
+
+    The snapshot is a directory of append-only segment files plus a
+    manifest listing them in order. Writers append each batch of stored
+    embeddings as a new segment; later segments win when a user appears in
+    several. Once `compact_after` segments pile up, an append starts a
+    background compaction that merges them into one, and the match job
+    compacts with `compact` to drop deleted users; a compacted snapshot
+    opens as a single memory map with no parsing or copying. Appends and
+    manifest updates take an exclusive lock on the directory, so several
+    writers on one host can share it; a compaction only holds it to
+    reserve its segment name and to swap the merged segment in.
+
+    With `quantization` set, each compacted segment also gets its vectors'
+    quantized codes written next to it, which a single-segment snapshot
+    opens as memory maps too.
+    """
+
+    def __init__(self, path: str, compact_after: int = DEFAULT_COMPACT_AFTER, quantization: Optional[str] = None):
+        self.path = path
+        self.compact_after = compact_after
+        self.quantization = quantization
+        self._lock = threading.Lock()
+        self._compaction: Optional[threading.Thread] = None
+        os.makedirs(path, exist_ok=True)
+
+    def _read_manifest(self) -> Dict:
+        try:
+            with open(os.path.join(self.path, MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'segments': [], 'next_segment': 1, 'watermark': None}
+
+    def _write_manifest(self, manifest: Dict) -> None:
+        tmp_path = os.path.join(self.path, f"{MANIFEST}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+
+    @contextmanager
+    def _locked(self):
+        """Hold the directory lock for a read-modify-write of the manifest."""
+        with self._lock, open(os.path.join(self.path, 'lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @property
+    def watermark(self) -> Optional[str]:
+        """The newest `updated_at` in the snapshot."""
+        return self._read_manifest()['watermark']
+
+    @property
+    def segments(self) -> List[str]:
+        """Segment file names, oldest first."""
+        return self._read_manifest()['segments']
+
+    def append(self, ids: Sequence[str], vectors: np.ndarray, updated_at: Sequence[Optional[str]]) -> None:
+        """Add a batch of embeddings as a new segment, compacting in the background once enough pile up."""
+        if not len(ids):
+            return
+        with self._locked():
+            manifest = self._read_manifest()
+            name = f"segment-{manifest['next_segment']:08d}.seg"
+            write_segment(os.path.join(self.path, name), ids, vectors, updated_at)
+            manifest['segments'].append(name)
+            manifest['next_segment'] += 1
+            timestamps = [value for value in updated_at if value]
+            if manifest['watermark']:
+                timestamps.append(manifest['watermark'])
+            if timestamps:
+                manifest['watermark'] = max(timestamps, key=parse_timestamp)
+            self._write_manifest(manifest)
+            segments = len(manifest['segments'])
+        if segments >= self.compact_after and not (self._compaction and self._compaction.is_alive()):
+            # Not a daemon, so the process finishes the compaction before exiting
+            self._compaction = threading.Thread(target=self._background_compact, name='snapshot-compaction')
+            self._compaction.start()
+
+    def append_rows(self, rows: List[Dict]) -> None:
+        """Append `user_embeddings` rows, e.g. as a write buffer's `on_written` callback."""
+        rows = [row for row in rows if row.get('embedding')]
+        if not rows:
+            return
+        self.append(
+            [row['user_id'] for row in rows],
+            np.stack([parse_embedding(row['embedding']) for row in rows]),
+            [row.get('updated_at') for row in rows]
+        )
+
+    def _has_codes(self, name: str) -> bool:
+        return os.path.exists(os.path.join(self.path, name + CODE_SUFFIXES[0]))
+
+    def _remove_segment(self, name: str) -> None:
+        for suffix in ('',) + CODE_SUFFIXES:
+            try:
+                os.remove(os.path.join(self.path, name + suffix))
+            except FileNotFoundError:
+                pass
+
+    def _load_segments(self, segments: List[str]) -> EmbeddingSet:
+        if not segments:
+            return EmbeddingSet([], np.empty((0, 0), dtype=np.float32), [], normalized=True)
+        parts = [read_segment(os.path.join(self.path, name)) for name in segments]
+        if len(parts) == 1:
+            ids, vectors, updated_at = parts[0]
+            quantized = None
+            if self.quantization and self._has_codes(segments[0]):
+                quantized = QuantizedMatrix.load(os.path.join(self.path, segments[0]))
+                if quantized.kind != self.quantization:
+                    quantized = None
+            return EmbeddingSet(ids, vectors, updated_at, normalized=True, quantized=quantized)
+
+        # Later segments win: keep the last position of every id
+        ids = [user_id for part in parts for user_id in part[0]]
+        latest = {user_id: i for i, user_id in enumerate(ids)}
+        keep = np.fromiter(sorted(latest.values()), dtype=np.int64, count=len(latest))
+        vectors = np.concatenate([part[1] for part in parts])[keep]
+        updated_at = [value for part in parts for value in part[2]]
+        return EmbeddingSet([ids[i] for i in keep], vectors, [updated_at[i] for i in keep], normalized=True)
+
+    def load(self) -> EmbeddingSet:
+        """
+        Open the snapshot.
+
+        A single segment is returned as a read-only memory map, with its
+        quantized codes mapped alongside when it has them; several segments
+        are merged into memory.
+        """
+        for attempt in range(2):
+            try:
+                embeddings = self._load_segments(self._read_manifest()['segments'])
+                logger.info(f"Opened vector snapshot with {len(embeddings)} embeddings")
+                return embeddings
+            except FileNotFoundError:
+                # A compaction removed a segment between reading the manifest and opening it
+                if attempt:
+                    raise
+
+    def compact(self, drop: Collection[str] = ()) -> None:
+        """
+        Merge every current segment into one, leaving out the users in `drop`.
+
+        The merge runs outside the directory lock, so writers keep
+        appending meanwhile; their segments stay after the merged one. If
+        another compaction replaced the same segments first, this one is
+        abandoned. A lone segment is only rewritten to drop users or to add
+        the quantized codes it is missing.
+        """
+        drop = set(drop)
+        with self._locked():
+            manifest = self._read_manifest()
+            segments = list(manifest['segments'])
+            if not segments or (len(segments) == 1 and not drop
+                                and (not self.quantization or self._has_codes(segments[0]))):
+                return
+            name = f"segment-{manifest['next_segment']:08d}.seg"
+            manifest['next_segment'] += 1
+            self._write_manifest(manifest)
+
+        merged = self._load_segments(segments).without(drop)
+        path = os.path.join(self.path, name)
+        write_segment(path, merged.ids, merged.vectors, merged.updated_at)
+        if self.quantization and len(merged):
+            QuantizedMatrix.from_float(merged.vectors, self.quantization).save(path)
+
+        with self._locked():
+            manifest = self._read_manifest()
+            if manifest['segments'][:len(segments)] != segments:
+                self._remove_segment(name)
+                logger.info(f"Abandoned compaction into {name}: its segments were already compacted")
+                return
+            manifest['segments'] = [name] + manifest['segments'][len(segments):]
+            self._write_manifest(manifest)
+        for old in segments:
+            self._remove_segment(old)
+        logger.info(f"Compacted {len(segments)} snapshot segments into {name} ({len(merged)} embeddings)")
+
+    def _background_compact(self) -> None:
+        try:
+            self.compact()
+        except Exception as e:
+            logger.error(f"Background compaction of {self.path} failed: {str(e)}")
+
+    def wait_for_compaction(self) -> None:
+        """Wait for a background compaction started by `append` to finish."""
+        if self._compaction is not None:
+            self._compaction.join()
+
+
+def snapshot_overlap_since(watermark: Optional[str], overlap_seconds: float) -> Optional[str]:
+    """The `updated_at` to fetch changes after, reaching back `overlap_seconds` before the watermark."""
+    if not watermark:
+        return None
+    return (parse_timestamp(watermark) - timedelta(seconds=overlap_seconds)).isoformat()
+
+
+def snapshot_from_env(model: str) -> Optional[VectorSnapshot]:
+    """
+    Open a model's snapshot under VECTOR_SNAPSHOT_PATH, or return None when it is set empty.
+    """
+    path = os.getenv('VECTOR_SNAPSHOT_PATH', '.vector_snapshot')
+    if not path:
+        return None
+    return VectorSnapshot(os.path.join(path, model),
+                          int(os.getenv('VECTOR_SNAPSHOT_COMPACT_AFTER', str(DEFAULT_COMPACT_AFTER))),
+                          os.getenv('MATCH_QUANTIZATION') or None)
+
+
+def snapshot_writer_from_env() -> Optional[Callable[[List[Dict]], None]]:
+    """
+    Return an `on_written` callback that appends stored rows to the snapshot of each row's model.
+
+    Returns None when snapshots are disabled.
+    """
+    if not os.getenv('VECTOR_SNAPSHOT_PATH', '.vector_snapshot'):
+        return None
+    snapshots: Dict[str, VectorSnapshot] = {}
+    lock = threading.Lock()
+
+    def append_rows(rows: List[Dict]) -> None:
+        by_model: Dict[str, List[Dict]] = {}
+        for row in rows:
+            by_model.setdefault(row['model'], []).append(row)
+        for model, model_rows in by_model.items():
+            with lock:
+                if model not in snapshots:
+                    snapshots[model] = snapshot_from_env(model)
+            snapshots[model].append_rows(model_rows)
+
+    return append_rows
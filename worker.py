@@ -0,0 +1,174 @@
+import os
+import time
+import signal
+import logging
+from datetime import datetime
+from typing import Optional, Set
+
+from dotenv import load_dotenv
+
+import embedding_generator
+from generate_matches import MatchGenerator, parse_timestamp
+from job_queue import JobQueue, default_worker_id, queue_from_env
+from metrics import export_metrics, metrics
+from vector_loader import EmbeddingSet
+from vector_snapshot import snapshot_overlap_since
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+class Worker:
+    """
+    Resident embedding and matching service.
+
+    Clients, connection pools and the in-memory embedding matrix are built
+    once and reused for the life of the process. The worker polls the job
+    queue for new surveys; once one appears it waits `batch_window` seconds
+    so a burst of submissions is embedded as one micro-batch, then keeps
+    claiming until the queue is empty. New embeddings are merged into the
+    resident matrix and rematched incrementally, at most once every
+    `match_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        match_generator: MatchGenerator,
+        worker_id: Optional[str] = None,
+        batch_size: int = 100,
+        poll_interval: float = 2.0,
+        batch_window: float = 1.0,
+        match_interval: float = 10.0,
+        reconcile_interval: float = 300.0
+    ):
+        self.queue = queue
+        self.match_generator = match_generator
+        self.match_generator.incremental = True
+        self.worker_id = worker_id or default_worker_id()
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.batch_window = batch_window
+        self.match_interval = match_interval
+        self.reconcile_interval = reconcile_interval
+        self.embeddings: Optional[EmbeddingSet] = None
+        self._loaded_until: Optional[datetime] = None
+        self._rematch_pending = True
+        self._last_match = 0.0
+        self._last_reconcile = time.monotonic()
+        # Users dropped from the resident set whose listers haven't been rematched yet
+        self._removed: Set[str] = set()
+        self._stopping = False
+
+    def stop(self, *args) -> None:
+        """Finish the current cycle and exit."""
+        logger.info("Stopping worker")
+        self._stopping = True
+
+    def drain_queue(self) -> int:
+        """Claim and embed batches until the queue is empty; return how many jobs were processed."""
+        total = 0
+        while not self._stopping:
+            processed = embedding_generator.process_claimed_jobs(self.queue, self.worker_id, self.batch_size)
+            if not processed:
+                break
+            total += processed
+        return total
+
+    def refresh_embeddings(self) -> None:
+        """Merge embeddings written since the last refresh into the resident matrix."""
+        loader = self.match_generator.vector_loader
+        if self.match_generator.refresh_active_model():
+            # Vectors from different models can't be mixed; start over
+            self.embeddings = None
+            self._loaded_until = None
+        if self.embeddings is None:
+            self.embeddings = self.match_generator.load_embeddings()
+            self._removed |= self.match_generator.deleted_ids
+            self._last_reconcile = time.monotonic()
+        else:
+            # Re-read the overlap window so rows committed late with older timestamps aren't missed;
+            # merge replaces the ones already loaded
+            since = snapshot_overlap_since(self._loaded_until.isoformat() if self._loaded_until else None,
+                                           self.match_generator.snapshot_overlap)
+            self.embeddings = self.embeddings.merge(loader.load(since))
+            if time.monotonic() - self._last_reconcile >= self.reconcile_interval:
+                self.reconcile_embeddings()
+        timestamps = [parse_timestamp(value) for value in self.embeddings.updated_at if value]
+        if timestamps:
+            self._loaded_until = max(timestamps)
+
+    def reconcile_embeddings(self) -> None:
+        """Drop users whose embedding was deleted (e.g. with their profile) from the resident set."""
+        deleted = set(self.embeddings.ids) - self.match_generator.embedding_ids()
+        self._last_reconcile = time.monotonic()
+        if deleted:
+            logger.info(f"Dropping {len(deleted)} deleted users from the resident embeddings")
+            self.embeddings = self.embeddings.without(deleted)
+            self._removed |= deleted
+
+    def rematch(self) -> None:
+        """Rematch the users whose embeddings changed since the last match run."""
+        self.refresh_embeddings()
+        if len(self.embeddings):
+            self.match_generator.generate_incremental_matches(self.embeddings, self._removed)
+            self._removed = set()
+        self._rematch_pending = False
+        self._last_match = time.monotonic()
+
+    def run_once(self) -> int:
+        """Run one poll cycle and return the number of jobs processed."""
+        # With the SQLite queue, pick up surveys submitted since the last cycle
+        embedding_generator.sync_local_queue(self.queue)
+        processed = embedding_generator.process_claimed_jobs(self.queue, self.worker_id, self.batch_size)
+        if processed:
+            self._rematch_pending = True
+            # Let the rest of a burst arrive before claiming again
+            time.sleep(self.batch_window)
+            processed += self.drain_queue()
+        if self._rematch_pending and time.monotonic() - self._last_match >= self.match_interval:
+            self.rematch()
+        # Profile edits don't change embeddings, but the cards showing them need updating
+        self.match_generator.match_cards.refresh_queued()
+        return processed
+
+    def run(self) -> None:
+        logger.info(f"Worker {self.worker_id} started")
+        while not self._stopping:
+            try:
+                processed = self.run_once()
+            except Exception as e:
+                logger.error(f"Error in worker cycle: {str(e)}")
+                processed = 0
+            if not processed and not self._stopping:
+                time.sleep(self.poll_interval)
+        logger.info(f"Worker {self.worker_id} stopped")
+
+
+def main():
+    load_dotenv()
+    if embedding_generator.supabase is None:
+        embedding_generator.init_clients()
+    worker = Worker(
+        queue_from_env(embedding_generator.supabase),
+        MatchGenerator(),
+        worker_id=os.getenv('EMBEDDING_WORKER_ID'),
+        batch_size=int(os.getenv('WORKER_BATCH_SIZE', '100')),
+        poll_interval=float(os.getenv('WORKER_POLL_INTERVAL', '2')),
+        batch_window=float(os.getenv('WORKER_BATCH_WINDOW', '1')),
+        match_interval=float(os.getenv('WORKER_MATCH_INTERVAL', '10')),
+        reconcile_interval=float(os.getenv('WORKER_RECONCILE_INTERVAL', '300'))
+    )
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    if os.getenv('METRICS_PORT'):
+        metrics.serve(int(os.getenv('METRICS_PORT')))
+    worker.run()
+    export_metrics()
+
+
+if __name__ == "__main__":
+    main()
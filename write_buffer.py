@@ -0,0 +1,207 @@
+import time
+import logging
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Set
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 5.0
+
+
+@dataclass
+class ChunkResult:
+    """Outcome of writing one chunk of buffered rows."""
+    target: str
+    rows: int
+    failed_keys: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed_keys
+
+
+class WriteBuffer(ABC):
+    """
+    Collect rows and write them behind the caller as chunked bulk requests.
+
+    Rows are flushed once `chunk_size` rows are pending or the oldest
+    pending row has waited `flush_interval` seconds. Both are only checked
+    when a row is added, so a buffer that goes idle keeps its rows until
+    `flush` is called (or the `with` block exits). Every chunk is reported as its
+    own `ChunkResult`; when a chunk fails its rows are retried one at a time
+    so a single bad row doesn't sink the rest of the chunk. `on_written`,
+    if given, is called with the rows of each chunk that were written.
+    """
+
+    # Pipeline stage the writes are timed under, see metrics.py
+    stage = 'write'
+
+    def __init__(
+        self,
+        target: str,
+        key_column: str,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        on_written: Optional[Callable[[List[Dict]], None]] = None
+    ):
+        self.target = target
+        self.key_column = key_column
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.on_written = on_written
+        self.pending: List[Dict] = []
+        self.results: List[ChunkResult] = []
+        self._oldest_pending: Optional[float] = None
+
+    @abstractmethod
+    def _write(self, rows: List[Dict]) -> None:
+        """Write one chunk of rows in a single request, raising on failure."""
+
+    def add(self, row: Dict) -> None:
+        """Queue a row, flushing if the buffer is full or its oldest row has waited `flush_interval`."""
+        now = time.monotonic()
+        if not self.pending:
+            self._oldest_pending = now
+        self.pending.append(row)
+        if len(self.pending) >= self.chunk_size or now - self._oldest_pending >= self.flush_interval:
+            self.flush()
+
+    def _timed_write(self, rows: List[Dict]) -> None:
+        with metrics.stage(self.stage, items=len(rows), target=self.target):
+            self._write(rows)
+
+    def _notify_written(self, rows: List[Dict]) -> None:
+        if not self.on_written or not rows:
+            return
+        try:
+            self.on_written(rows)
+        except Exception as e:
+            logger.error(f"Error in on_written callback for {self.target}: {str(e)}")
+
+    def _write_chunk(self, rows: List[Dict]) -> ChunkResult:
+        try:
+            self._timed_write(rows)
+            self._notify_written(rows)
+            return ChunkResult(self.target, len(rows))
+        except Exception as e:
+            logger.warning(f"Bulk write of {len(rows)} rows to {self.target} failed, retrying row by row: {str(e)}")
+
+        failed = []
+        written = []
+        last_error = None
+        for row in rows:
+            try:
+                self._timed_write([row])
+                written.append(row)
+            except Exception as e:
+                failed.append(str(row[self.key_column]))
+                last_error = str(e)
+                logger.error(f"Error writing {row[self.key_column]} to {self.target}: {last_error}")
+        self._notify_written(written)
+        metrics.inc('write_failures_total', len(failed), target=self.target)
+        return ChunkResult(self.target, len(rows), failed, last_error)
+
+    def write(self, rows: List[Dict]) -> List[ChunkResult]:
+        """
+        Write rows immediately in chunks, bypassing the pending buffer.
+
+        Safe to call from several threads at once as long as the underlying
+        client is.
+        """
+        results = [
+            self._write_chunk(rows[start:start + self.chunk_size])
+            for start in range(0, len(rows), self.chunk_size)
+        ]
+        for result in results:
+            logger.info(
+                f"Wrote chunk of {result.rows} rows to {result.target} "
+                f"({len(result.failed_keys)} failed)"
+            )
+        return results
+
+    def flush(self) -> List[ChunkResult]:
+        """Write all pending rows and return the result of each chunk."""
+        rows, self.pending = self.pending, []
+        self._oldest_pending = None
+        results = self.write(rows)
+        self.results.extend(results)
+        return results
+
+    def failed_keys(self) -> Set[str]:
+        """Keys of every row that failed to write since the buffer was created."""
+        return {key for result in self.results for key in result.failed_keys}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+
+class SupabaseUpsertBuffer(WriteBuffer):
+    """Buffer rows for multi-row `upsert([...])` calls on a Supabase table."""
+
+    stage = 'supabase_write'
+
+    def __init__(self, supabase, table: str, key_column: str = 'user_id',
+                 on_conflict: Optional[str] = None, **kwargs):
+        super().__init__(table, key_column, **kwargs)
+        self.supabase = supabase
+        self.table = table
+        self.on_conflict = on_conflict
+
+    def _write(self, rows: List[Dict]) -> None:
+        if self.on_conflict:
+            self.supabase.table(self.table).upsert(rows, on_conflict=self.on_conflict).execute()
+        else:
+            self.supabase.table(self.table).upsert(rows).execute()
+
+
+class SupabaseUpdateBuffer(WriteBuffer):
+    """
+    Buffer column updates keyed by `key_column`.
+
+    Rows that set the same values (e.g. `embedding_status = 'completed'`)
+    are applied together as one `update(...).in_(key_column, [...])` call.
+    """
+
+    stage = 'supabase_write'
+
+    def __init__(self, supabase, table: str, key_column: str = 'user_id', **kwargs):
+        super().__init__(table, key_column, **kwargs)
+        self.supabase = supabase
+        self.table = table
+
+    def _write(self, rows: List[Dict]) -> None:
+        groups: Dict[tuple, List[str]] = {}
+        for row in rows:
+            values = tuple(sorted((k, v) for k, v in row.items() if k != self.key_column))
+            groups.setdefault(values, []).append(row[self.key_column])
+        for values, keys in groups.items():
+            self.supabase.table(self.table) \
+                .update(dict(values)) \
+                .in_(self.key_column, keys) \
+                .execute()
+
+
+class PineconeUpsertBuffer(WriteBuffer):
+    """Buffer vectors for `index.upsert(vectors=[...])` calls."""
+
+    stage = 'pinecone_write'
+
+    def __init__(self, index, namespace: Optional[str] = None, batch_size: int = 100, **kwargs):
+        super().__init__(f"pinecone:{namespace or 'default'}", 'id', **kwargs)
+        self.index = index
+        self.namespace = namespace
+        self.batch_size = batch_size
+
+    def _write(self, rows: List[Dict]) -> None:
+        if self.namespace:
+            self.index.upsert(vectors=rows, namespace=self.namespace, batch_size=self.batch_size)
+        else:
+            self.index.upsert(vectors=rows, batch_size=self.batch_size)